@@ -1,6 +1,9 @@
 import logging
 from pathlib import Path
+from typing import List, Tuple
 import pandas as pd
+from .annotation import saf_annotation
+from .count_store import CountStore
 from .command import run_command
 from .parser import remove_file
 import numpy as np
@@ -9,9 +12,14 @@ logger = logging.getLogger("MassiveQC")
 
 
 class FeatureCounts(object):
-    """Run FeatureCounts and extract count features"""
+    """Run FeatureCounts and extract count features
+
+    The GTF is converted once to a SAF file cached in Count_dir/annotation.
+    The gene and junction counts are appended to the count store in
+    Count_dir/matrix, with `remove_counts` the text files are removed then.
+    """
     def __init__(self, feature_path: str, SRR: str, Bam_dir: str, Count_dir: str,
-                 gtf: str, THREADS: int):
+                 gtf: str, THREADS: int, remove_counts: bool = False):
         self.feature_path = Path(feature_path)
         self.layout = self.feature_path / "layout" / f"{SRR}.parquet"
         self.strand = self.feature_path / "strand" / f"{SRR}.parquet"
@@ -20,39 +28,21 @@ class FeatureCounts(object):
         self.Count_dir = Path(Count_dir)
         self.gtf = gtf
         self.THREADS = THREADS
+        self.remove_counts = remove_counts
 
     def FeatureCounts(self):
         counts, jcounts = self.run_featureCounts()
         self.summarize(counts, jcounts)
+        self.store(counts, jcounts)
         return (self.Bam_dir / f"{self.SRR}.sorted.bam").as_posix()
 
     def run_featureCounts(self):
-        # Look up Layout
-        layout_ = pd.read_parquet(self.layout).layout[0]
-        if layout_ == "PE":
-            params = "-p -P -C -J -B "
-        else:
-            params = "-J "
-
-        # Look up strand
-        strand_ = pd.read_parquet(self.strand).strand[0]
-        if strand_ == "same_strand":
-            params += "-s 1"
-        elif strand_ == "opposite_strand":
-            params += "-s 2"
-        else:
-            params += "-s 0"
-
         counts = self.Count_dir / f"{self.SRR}.counts"
         jcounts = self.Count_dir / f"{self.SRR}.counts.jcounts"
         summary = self.Count_dir / f"{self.SRR}.counts.summary"
         bam = self.Bam_dir / f"{self.SRR}.sorted.bam"
 
-        cmd = (
-            f"featureCounts  -T {self.THREADS} {params} "
-            f"-a {self.gtf} -o {counts} "
-            f"{bam}"
-        )
+        cmd = self.featureCounts_cmd([bam], counts)
         logger.info(f"{cmd}")
         logger.info(f"{self.SRR} start featureCounts")
         _result = run_command(cmd)
@@ -61,6 +51,37 @@ class FeatureCounts(object):
         logger.info(f"{self.SRR} complete featureCounts")
         return counts, jcounts
 
+    def group_key(self) -> Tuple[str, str]:
+        """Layout and strand, which set the featureCounts parameters"""
+        layout_ = pd.read_parquet(self.layout).layout.iloc[0]
+        strand_ = pd.read_parquet(self.strand).strand.iloc[0]
+        return layout_, strand_
+
+    def featureCounts_cmd(self, bams: List[Path], counts: Path) -> str:
+        layout_, strand_ = self.group_key()
+        if layout_ == "PE":
+            params = "-p -P -C -J -B "
+        else:
+            params = "-J "
+        if strand_ == "same_strand":
+            params += "-s 1"
+        elif strand_ == "opposite_strand":
+            params += "-s 2"
+        else:
+            params += "-s 0"
+        annotation = saf_annotation(self.gtf, self.Count_dir / "annotation")
+        return (
+            f"featureCounts  -T {self.THREADS} {params} "
+            f"-F SAF -a {annotation} -o {counts} "
+            + " ".join(str(bam) for bam in bams)
+        )
+
+    def store(self, counts: Path, jcounts: Path):
+        CountStore((self.Count_dir / "matrix").as_posix()).append(self.SRR, counts, jcounts)
+        if self.remove_counts:
+            remove_file(counts.as_posix())
+            remove_file(jcounts.as_posix())
+
     def summarize(self, counts: Path, jcounts: Path):
         gene_counts = self._get_counts(counts)
         genic_reads = gene_counts.sum()
@@ -96,5 +117,92 @@ class FeatureCounts(object):
             raise FeatureCountsException(f"{SRR} not complete")
 
 
+class FeatureCountsBatch(object):
+    """Run featureCounts once on the BAM files of several samples
+
+    The samples must share the layout and strand. The counts of each sample
+    are split into its own counts and jcounts files, then summarized as if
+    it was counted alone. If the batch run fails, for instance on a bad BAM
+    file, each sample is counted alone so only the bad ones are lost.
+    """
+    # Columns before the counts of the BAM files
+    COUNTS_COLUMNS = 6
+    JCOUNTS_COLUMNS = 8
+
+    def __init__(self, feature_path: str, SRRs: List[str], Bam_dir: str, Count_dir: str,
+                 gtf: str, THREADS: int, remove_counts: bool = False):
+        self.samples = [
+            FeatureCounts(feature_path, SRR, Bam_dir, Count_dir, gtf, THREADS, remove_counts) for SRR in SRRs
+        ]
+        self.Count_dir = Path(Count_dir)
+        self.name = f"batch.{SRRs[0]}"
+
+    def FeatureCounts(self) -> List[str]:
+        """Count the samples, returns the BAM files of the counted ones"""
+        try:
+            counts, jcounts = self.run_featureCounts()
+        except FeatureCountsException as error:
+            logger.warning(f"{error}, counting its samples one by one")
+            return self.count_alone()
+        bams = []
+        for k, sample in enumerate(self.samples):
+            sample_counts, sample_jcounts = self.split(sample, k, counts, jcounts)
+            sample.summarize(sample_counts, sample_jcounts)
+            sample.store(sample_counts, sample_jcounts)
+            bams.append((sample.Bam_dir / f"{sample.SRR}.sorted.bam").as_posix())
+        remove_file(counts.as_posix())
+        remove_file(jcounts.as_posix())
+        return bams
+
+    def count_alone(self) -> List[str]:
+        bams = []
+        for sample in self.samples:
+            try:
+                bams.append(sample.FeatureCounts())
+            except Exception as error:
+                logger.error(f"{sample.SRR} FeatureCounts failed: {error}")
+        return bams
+
+    def run_featureCounts(self) -> Tuple[Path, Path]:
+        keys = set(sample.group_key() for sample in self.samples)
+        if len(keys) > 1:
+            raise FeatureCountsException(f"{self.name} mixes layouts or strands: {keys}")
+        counts = self.Count_dir / f"{self.name}.counts"
+        jcounts = self.Count_dir / f"{self.name}.counts.jcounts"
+        summary = self.Count_dir / f"{self.name}.counts.summary"
+        bams = [sample.Bam_dir / f"{sample.SRR}.sorted.bam" for sample in self.samples]
+        cmd = self.samples[0].featureCounts_cmd(bams, counts)
+        logger.info(f"{cmd}")
+        logger.info(f"{self.name} start featureCounts of {len(bams)} samples")
+        _result = run_command(cmd)
+        remove_file(summary.as_posix())
+        try:
+            FeatureCounts._check_log(_result, self.name)
+        except FeatureCountsException:
+            remove_file(counts.as_posix())
+            remove_file(jcounts.as_posix())
+            raise
+        logger.info(f"{self.name} complete featureCounts")
+        return counts, jcounts
+
+    def split(self, sample: FeatureCounts, k: int, counts: Path, jcounts: Path) -> Tuple[Path, Path]:
+        """Write the counts of the `k`th sample as featureCounts writes a single sample"""
+        sample_counts = sample.Count_dir / f"{sample.SRR}.counts"
+        sample_jcounts = sample.Count_dir / f"{sample.SRR}.counts.jcounts"
+        with open(counts) as fh:
+            program = fh.readline()
+        df = pd.read_table(counts, comment="#", dtype=str)
+        with open(sample_counts, "w") as out:
+            out.write(program)
+            df.iloc[:, list(range(self.COUNTS_COLUMNS)) + [self.COUNTS_COLUMNS + k]].to_csv(
+                out, sep="\t", index=False)
+        # A single sample only lists its junctions with reads
+        df = pd.read_table(jcounts, dtype=str, keep_default_na=False)
+        column = self.JCOUNTS_COLUMNS + k
+        df = df[df.iloc[:, column].astype(np.int64) > 0]
+        df.iloc[:, list(range(self.JCOUNTS_COLUMNS)) + [column]].to_csv(sample_jcounts, sep="\t", index=False)
+        return sample_counts, sample_jcounts
+
+
 class FeatureCountsException(Exception):
     """Fastq Screen Processing Exception"""
@@ -1,143 +1,279 @@
 import argparse
 import configparser
 import logging
-import os
 
 import pandas as pd
 
 logging.basicConfig(format='%(asctime)s %(message)s')
 logger = logging.getLogger("MassiveQC")
 logger.setLevel(logging.WARNING)
+from functools import partial
 from pathlib import Path
-from concurrent import futures
 from tqdm import tqdm
 
 # sys.path.insert(0, "/home/mwshi/github/MassiveQC")
 from .get_sra import get_sra
-from .check_fq import check_fq
+from .check_fq import check_fq, raise_if_rejected
 from .fastq_screen import fastq_screen
 from .atropos import atropos
+from .downsample import downsample
 from .hisat2 import Hisat2
 from .collectrnaseqmetrics import CollectRnaseqMetrics
 from .markduplicates import MarkDuplicates
-from .FeatureCounts import FeatureCounts
+from .picard_worker import start_worker, stop_worker
+from .FeatureCounts import FeatureCounts, FeatureCountsBatch
 from .feature_store import check_done_sample, feature_store
 from .detection import detection
+from .failures import PERMANENT, classify
+from .lifecycle import Lifecycle
 from .parser import remove_file
+from .run_config import RunConfig
+from .run_state import RunState
+from .scheduler import Scheduler, Task
 
-def init_wd():
-    Path(outdir).mkdir(exist_ok=True)
-    Path(download_path).mkdir(exist_ok=True)
+STAGES = ["download", "check_fq", "fastq_screen", "atropos", "hisat2", "strand", "collectrnaseqmetrics",
+          "markduplicates", "FeatureCounts"]
+
+def init_wd(config):
+    feature_path = config.feature_path
+    Path(config.outdir).mkdir(exist_ok=True)
+    Path(config.download_path).mkdir(exist_ok=True)
     feature_path.mkdir(exist_ok=True)
     (feature_path / "layout").mkdir(exist_ok=True)
-    Path(QC_dir).mkdir(exist_ok=True)
+    (feature_path / "readstats").mkdir(exist_ok=True)
+    Path(config.QC_dir).mkdir(exist_ok=True)
     (feature_path / "fastq_screen").mkdir(exist_ok=True)
     (feature_path / "atropos").mkdir(exist_ok=True)
-    Path(Bam_dir).mkdir(exist_ok=True)
+    Path(config.Bam_dir).mkdir(exist_ok=True)
+    if config.bam_profile.tmp_dir:
+        Path(config.bam_profile.tmp_dir).mkdir(parents=True, exist_ok=True)
     (feature_path / "hisat2").mkdir(exist_ok=True)
     (feature_path / "aln_stats").mkdir(exist_ok=True)
+    (feature_path / "bam_profile").mkdir(exist_ok=True)
     (feature_path / "strand").mkdir(exist_ok=True)
     (feature_path / "rnaseqmetrics").mkdir(exist_ok=True)
     (feature_path / "genebody_coverage").mkdir(exist_ok=True)
     (feature_path / "markduplicates").mkdir(exist_ok=True)
     (feature_path / "count_summary").mkdir(exist_ok=True)
-    Path(Count_dir).mkdir(exist_ok=True)
-    (feature_path / "DoneSample").mkdir(exist_ok=True)
+    Path(config.Count_dir).mkdir(exist_ok=True)
 
 
-def process(SRR):
+def download_stage(config, SRR):
     logger.info(f"Start download {SRR}")
-    if not skip_download:
-        fq_mode = get_sra(SRR, download_path, ascp_key)
-        logger.info(f"Complete download {SRR}")
-    if only_download:
-        return
+    get_sra(SRR, config.download_path, config.ascp_key)
+    logger.info(f"Complete download {SRR}")
+
 
-    # check_fq
+def check_stage(config, SRR):
     # Check if the result file exists.
     logger.info(f"Start check {SRR} fastq file")
-    summary_file = feature_path / "layout" / f"{SRR}.parquet"
+    summary_file = config.feature_path / "layout" / f"{SRR}.parquet"
     if summary_file.exists():
         logger.info(f"{SRR} fastq file has been checked")
+        raise_if_rejected(summary_file)
     else:
-        raw_fqs = check_fq(SRR, download_path, QC_dir, feature_path)
-        # remove the raw fastq
-        if remove_fastq:
-            for k in raw_fqs:
-                logger.info(f"Remove {k}")
-                remove_file(k)
-
-    # fastq_screen
-    fastq_screen_output = feature_path / "fastq_screen" / f"{SRR}.parquet"
+        # The lifecycle removes the raw fastq
+        check_fq(SRR, config.download_path, config.QC_dir, config.feature_path, config.fastq_engine,
+                 config.THREADS, config.compression, not config.no_prescreen, config.fuse_atropos)
+
+
+def screen_stage(config, SRR):
+    fastq_screen_output = config.feature_path / "fastq_screen" / f"{SRR}.parquet"
     if fastq_screen_output.exists():
         logger.info(f"{SRR} fastq_screen step has been done")
     else:
-        fastq_screen(SRR, QC_dir, feature_path.as_posix(), fastq_screen_config, THREADS)
+        fastq_screen(SRR, config.QC_dir, config.feature_path.as_posix(), config.fastq_screen_config, config.THREADS,
+                     config.screen_engine, config.screen_index)
+
 
-    # atropos
-    atropos_output = feature_path / "atropos" / f"{SRR}.parquet"
+def atropos_stage(config, SRR):
+    atropos_output = config.feature_path / "atropos" / f"{SRR}.parquet"
     if atropos_output.exists():
         logger.info(f"{SRR} atropos step has been done")
     else:
-        atropos(feature_path.as_posix(), SRR, QC_dir, THREADS)
+        atropos(config.feature_path.as_posix(), SRR, config.QC_dir, config.THREADS, config.compression)
+
 
-    # hisat2
-    _hisat2 = Path(feature_path) / "hisat2" / f"{SRR}.parquet"
-    _alnStat = Path(feature_path) / "aln_stats" / f"{SRR}.parquet"
+def hisat2_stage(config, SRR):
+    _hisat2 = config.feature_path / "hisat2" / f"{SRR}.parquet"
+    _alnStat = config.feature_path / "aln_stats" / f"{SRR}.parquet"
     if _hisat2.exists() and _alnStat.exists():
         logger.info(f"{SRR} hisat2 step has been done")
     else:
-        hisat_runner = Hisat2(feature_path.as_posix(), SRR, QC_dir, Bam_dir, THREADS, reference, splice=splice)
-        trim_fqs = hisat_runner.hisat2()
-        if remove_fastq:
-            for k in trim_fqs:
-                logger.info(f"Remove {k}")
-                remove_file(k)
-
-    # metrics
-    strand = feature_path / "strand" / f"{SRR}.parquet"
-    table = feature_path / "rnaseqmetrics" / f"{SRR}.parquet"
-    coverage = feature_path / "genebody_coverage" / f"{SRR}.parquet"
-    if strand.exists() and table.exists() and coverage.exists():
+        if config.max_reads:
+            downsample(config.feature_path.as_posix(), SRR, config.QC_dir, config.max_reads, config.compression)
+        hisat_runner = Hisat2(config.feature_path.as_posix(), SRR, config.QC_dir, config.Bam_dir, config.THREADS,
+                              config.reference, splice=config.splice, stream=config.stream_alignment,
+                              profile=config.bam_profile)
+        hisat_runner.hisat2()
+
+
+def strand_stage(config, SRR):
+    CollectRnaseqMetrics(config.feature_path.as_posix(), SRR, config.Bam_dir, config.THREADS, config.ref_flat,
+                         config.picard).infer_strand()
+
+
+def rnaseqmetrics_stage(config, SRR):
+    table = config.feature_path / "rnaseqmetrics" / f"{SRR}.parquet"
+    coverage = config.feature_path / "genebody_coverage" / f"{SRR}.parquet"
+    if table.exists() and coverage.exists():
         logger.info(f"{SRR} collectrnaseqmetrics step has been done")
     else:
-        metrics_runner = CollectRnaseqMetrics(feature_path.as_posix(), SRR, Bam_dir, THREADS, ref_flat, picard)
-        metrics_runner.collectrnaseqmetrics()
+        CollectRnaseqMetrics(config.feature_path.as_posix(), SRR, config.Bam_dir, config.THREADS, config.ref_flat,
+                             config.picard).collectrnaseqmetrics()
+
 
-    # markduplicates
-    markdup = feature_path / "markduplicates" / f"{SRR}.parquet"
+def markduplicates_stage(config, SRR):
+    markdup = config.feature_path / "markduplicates" / f"{SRR}.parquet"
     if markdup.exists():
         logger.info(f"{SRR} markduplicates step has been done")
     else:
-        markdup_runner = MarkDuplicates(feature_path.as_posix(), SRR, Bam_dir, THREADS, picard)
-        markdup_runner.markduplicates()
+        MarkDuplicates(config.feature_path.as_posix(), SRR, config.Bam_dir, config.THREADS, config.picard,
+                       engine=config.duplicates_engine).markduplicates()
+
 
-    # FeatureCounts
-    count_summary = feature_path / "count_summary" / f"{SRR}.parquet"
+def count_stage(config, SRR):
+    count_summary = config.feature_path / "count_summary" / f"{SRR}.parquet"
     if count_summary.exists():
         logger.info(f"{SRR} FeatureCounts step has been done")
     else:
-        count_runner = FeatureCounts(feature_path.as_posix(), SRR, Bam_dir, Count_dir, gtf, THREADS)
-        bam_file = count_runner.FeatureCounts()
-        if remove_bam:
-            remove_file(bam_file)
+        FeatureCounts(config.feature_path.as_posix(), SRR, config.Bam_dir, config.Count_dir, config.gtf,
+                      config.THREADS, config.remove_counts).FeatureCounts()
 
-    # complete one srr, touch one file
-    (feature_path / "DoneSample" / SRR).touch()
-    return SRR
 
+def sample_tasks(config, SRR):
+    """The stages of a sample, the stages they come after and what they hold of the pools
 
-def local_thread(SRRs):
-    init_wd()
-    down_samples = os.listdir(feature_path / "DoneSample")
-    pre_SRRs = [x for x in SRRs if x not in down_samples]
-    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        tasks = [executor.submit(process, srr) for srr in pre_SRRs]
-        for r in tqdm(futures.as_completed(tasks), total=len(tasks)):
-            if r.exception():
-                logger.error("One sample failed")
-            else:
-                res = r.result()
+    The downloads and the Picard jobs wait on the network or on the Picard
+    worker of this process, they run in threads with any executor. The
+    feature files of each stage are recorded in the run database.
+    """
+    def feature(name):
+        return config.feature_path / name / f"{SRR}.parquet"
+
+    tasks = []
+    checked_after = []
+    if not config.skip_download:
+        tasks.append(Task(SRR, "download", partial(download_stage, config, SRR), {"network": 1}, in_thread=True))
+        checked_after = ["download"]
+    if config.only_download:
+        return tasks
+    cores = {"cpu": config.THREADS}
+    # Picard runs with a 3 GB heap, the streamed duplicates need no JVM
+    picard_job = {"cpu": 1, "jvm": 3}
+    markdup_job = picard_job
+    if config.duplicates_engine == "stream":
+        markdup_job = {"cpu": config.THREADS}
+    elif config.duplicates_engine == "validate":
+        markdup_job = {"cpu": config.THREADS, "jvm": 3}
+    # fastq_screen reads the untrimmed reads that atropos removes, unless check_fq left a sample of them
+    trimmed_after = ["check_fq"]
+    if (config.feature_path / "layout" / f"{SRR}.parquet").exists() \
+            and not list((Path(config.QC_dir) / "screen").glob(f"{SRR}[._]*")):
+        trimmed_after.append("fastq_screen")
+    tasks += [
+        Task(SRR, "check_fq", partial(check_stage, config, SRR), cores, checked_after,
+             outputs=[feature("layout"), feature("readstats")]),
+        Task(SRR, "fastq_screen", partial(screen_stage, config, SRR),
+             {"cpu": 1} if config.screen_engine == "kmer" else cores, ["check_fq"],
+             outputs=[feature("fastq_screen")]),
+        Task(SRR, "atropos", partial(atropos_stage, config, SRR), cores, trimmed_after,
+             outputs=[feature("atropos")]),
+        Task(SRR, "hisat2", partial(hisat2_stage, config, SRR), cores, ["atropos"],
+             outputs=[feature("hisat2"), feature("aln_stats"), feature("bam_profile")]),
+        # strand, featureCounts needs it, reads the BAM with one samtools process
+        Task(SRR, "strand", partial(strand_stage, config, SRR), {"cpu": 1}, ["hisat2"],
+             outputs=[feature("strand")]),
+        # The post-alignment stages read the sorted BAM concurrently
+        Task(SRR, "collectrnaseqmetrics", partial(rnaseqmetrics_stage, config, SRR), picard_job, ["strand"],
+             in_thread=True, outputs=[feature("rnaseqmetrics"), feature("genebody_coverage")]),
+        Task(SRR, "markduplicates", partial(markduplicates_stage, config, SRR), markdup_job, ["hisat2"],
+             in_thread=config.duplicates_engine != "stream", outputs=[feature("markduplicates")]),
+    ]
+    if config.count_batch == 1:
+        tasks.append(Task(SRR, "FeatureCounts", partial(count_stage, config, SRR), cores, ["strand"],
+                          outputs=[feature("count_summary")]))
+    return tasks
+
+
+def finish_sample(state, lifecycle, SRR):
+    # The BAM is removed once it is counted
+    lifecycle.stage_done(SRR, "FeatureCounts")
+    lifecycle.sample_end(SRR)
+    # complete one srr, record it in the run database
+    state.sample_done([SRR])
+
+
+def count_batch_samples(config, SRRs):
+    """Count samples sharing layout and strand with one featureCounts run
+
+    Samples that could not be counted are left for the next run.
+    """
+    try:
+        FeatureCountsBatch(config.feature_path.as_posix(), SRRs, config.Bam_dir, config.Count_dir, config.gtf,
+                           config.THREADS, config.remove_counts).FeatureCounts()
+    except Exception as error:
+        logger.error(f"FeatureCounts of {', '.join(SRRs)} failed: {error}")
+
+
+def local_thread(config, state, SRRs):
+    init_wd(config)
+    done_samples = set(state.done_samples())
+    rejected = state.rejected()
+    for SRR in [x for x in SRRs if x in rejected and x not in done_samples]:
+        logger.info(f"Skip {SRR}, rejected in an earlier run: {rejected[SRR]}")
+    pre_SRRs = [x for x in SRRs if x not in done_samples and x not in rejected]
+    # Samples waiting for featureCounts, by layout and strand
+    batches = {}
+    # Samples of each featureCounts run
+    batch_tasks = {}
+    progress = tqdm(total=len(pre_SRRs))
+    lifecycle = Lifecycle(config, ["download"] if config.only_download else STAGES, config.disk_budget)
+
+    def count_batch_task(batch):
+        name = f"batch{len(batch_tasks)}"
+        batch_tasks[name] = batch
+        # The samples of the batch are recorded once it is over
+        return Task(name, "FeatureCounts", partial(count_batch_samples, config, batch), {"cpu": config.THREADS},
+                    record=False)
+
+    def sample_done(SRR, done):
+        if SRR in batch_tasks:
+            for batch_SRR in batch_tasks[SRR]:
+                count_summary = config.feature_path / "count_summary" / f"{batch_SRR}.parquet"
+                if count_summary.exists():
+                    state.done(batch_SRR, "FeatureCounts", [count_summary])
+                    finish_sample(state, lifecycle, batch_SRR)
+                else:
+                    # Counted again by the next run, with its BAM
+                    lifecycle.sample_end(batch_SRR)
+            lifecycle.sample_end(SRR)
+            return
+        progress.update()
+        if not done:
+            error = scheduler.failed.get(SRR)
+            logger.error(f"{SRR} failed: {type(error).__name__} {error}")
+            lifecycle.sample_end(SRR, rejected=classify(error) == PERMANENT)
+        elif config.only_download:
+            lifecycle.sample_end(SRR)
+        elif (config.feature_path / "count_summary" / f"{SRR}.parquet").exists():
+            finish_sample(state, lifecycle, SRR)
+        else:
+            key = FeatureCounts(config.feature_path.as_posix(), SRR, config.Bam_dir, config.Count_dir, config.gtf,
+                                config.THREADS).group_key()
+            batches.setdefault(key, []).append(SRR)
+            if len(batches[key]) >= config.count_batch:
+                scheduler.add([count_batch_task(batches.pop(key))])
+
+    pools = {"network": config.network_slots, "cpu": config.cores, "jvm": config.jvm_memory}
+    scheduler = Scheduler(pools, config.scratch_samples, sample_done, config.executor, state, config.retries,
+                          config.retry_delay, lifecycle)
+    for srr in pre_SRRs:
+        scheduler.add(sample_tasks(config, srr))
+    scheduler.run()
+    progress.close()
+    scheduler.add([count_batch_task(batch) for batch in batches.values()])
+    scheduler.run()
 
 
 def get_arguments():
@@ -168,6 +304,56 @@ def get_arguments():
     parser.add_argument('--skip_download', action="store_true", help="Skip the download step", default=False)
     parser.add_argument('--remove_fastq', action="store_true", help="Don't remain the fastq after running hisat2", default=False)
     parser.add_argument('--remove_bam', action="store_true", help="Don't remain the bam after running FeatureCounts", default=False)
+    parser.add_argument('--fastq_engine', type=str, choices=["vector", "python"], default="vector",
+                        help="Engine used to validate fastq reads. 'python' checks read by read, 'vector' checks chunks of reads")
+    parser.add_argument('--qc_compression', type=str, choices=["gzip", "bgzf"], default="gzip",
+                        help="Compression of the fastq files in QC_dir, 'bgzf' needs bgzip")
+    parser.add_argument('--qc_compresslevel', type=int, choices=range(10), default=None,
+                        help="Compression level of the fastq files in QC_dir, 0 stores them uncompressed in gzip")
+    parser.add_argument('--no_prescreen', action="store_true", default=False,
+                        help="Don't reject hopeless samples from a quick look at their fastq files before checking them")
+    parser.add_argument('--fuse_atropos', action="store_true", default=False,
+                        help="Stream the checked reads to atropos instead of writing them to QC_dir")
+    parser.add_argument('--screen_engine', type=str, choices=["fastq_screen", "kmer"], default="fastq_screen",
+                        help="How contamination is screened, 'kmer' looks the reads up in k-mer indexes of the fastq_screen references")
+    parser.add_argument('--max-reads', dest="max_reads", type=int, default=None,
+                        help="Downsample the trimmed reads, or pairs, of deeper samples to about this number before hisat2. The count features are extrapolated")
+    parser.add_argument('--stream_alignment', action="store_true", default=False,
+                        help="Pipe hisat2 into samtools instead of writing a SAM file")
+    parser.add_argument('--bam_profile', type=str, choices=["auto", "archive", "ephemeral"], default="auto",
+                        help="How the sorted BAM is written, 'ephemeral' compresses fast, 'auto' picks it with --remove_bam")
+    parser.add_argument('--sort_memory', type=str, default=None,
+                        help="Memory per samtools sort thread, like 768M or 2G")
+    parser.add_argument('--sort_tmpdir', type=str, default=None,
+                        help="Directory of the samtools sort temporary files. The default is the Bam directory")
+    parser.add_argument('--duplicates_engine', type=str, choices=["picard", "stream", "validate"], default="picard",
+                        help="How duplicates are counted, 'stream' skips the deduplicated BAM, 'validate' compares it with picard")
+    parser.add_argument('--picard_worker', action="store_true", default=False,
+                        help="Run the Picard tools of all samples in one long-lived JVM instead of a java call per tool")
+    parser.add_argument('--count_batch', type=int, default=1,
+                        help="Number of samples with the same layout and strand counted by one featureCounts run")
+    parser.add_argument('--remove_counts', action="store_true", default=False,
+                        help="Keep the counts only in the count store, remove the featureCounts text files")
+    parser.add_argument('--network_slots', type=int, default=None,
+                        help="Number of downloads at once. The default is WORKERS")
+    parser.add_argument('--cores', type=int, default=None,
+                        help="Number of cores shared by the stages of all samples. The default is WORKERS * THREADS")
+    parser.add_argument('--jvm_memory', type=int, default=None,
+                        help="GB of heap shared by the Picard jobs, 3 GB each. The default is 6 GB per worker")
+    parser.add_argument('--scratch_samples', type=int, default=None,
+                        help="Number of samples holding intermediate files at once. The default is 2 * WORKERS")
+    parser.add_argument('--disk_budget', type=float, default=None,
+                        help="GB the intermediate files of the samples in progress may take, estimated from their downloads")
+    parser.add_argument('--executor', type=str, choices=["thread", "process"], default="thread",
+                        help="Run the stages in threads, or the CPU-bound ones in worker processes")
+    parser.add_argument('--rerun', type=str, nargs="+", choices=STAGES, default=[],
+                        help="Run these stages of the input samples again, even when the run database records them as done")
+    parser.add_argument('--retries', type=int, default=2,
+                        help="Number of times a stage failing for a transient reason, like a download, is tried again")
+    parser.add_argument('--retry_delay', type=float, default=60,
+                        help="Seconds before a failed stage is tried again, doubling at each retry")
+    parser.add_argument('--retry_rejected', action="store_true", default=False,
+                        help="Run the input samples rejected for their data in earlier runs again, they are skipped otherwise")
     parser.set_defaults(**config_args)
     if pre_args.conf:
         for action in parser._actions:
@@ -179,53 +365,10 @@ def get_arguments():
 
 def main():
     args = get_arguments()
-    global only_download
-    only_download = args.only_download
-    global skip_download
-    skip_download = args.skip_download
-    global remove_fastq
-    remove_fastq = args.remove_fastq
-    global remove_bam
-    remove_bam = args.remove_bam
     input_file = args.input.strip('"')
-    global ascp_key
-    ascp_key = args.ascp_key.strip('"')
-    global gtf
-    gtf = args.gtf.strip('"')
-    global fastq_screen_config
-    fastq_screen_config = args.fastq_screen_config.strip('"')
-    global reference
-    reference = args.ht2_idx.strip('"')
-    global splice
-    splice = args.known_splicesite_infile.strip('"')
-    global picard
-    picard = args.picard.strip('"')
-    global ref_flat
-    ref_flat = args.ref_flat.strip('"')
-    global outdir
-    outdir = args.outdir.strip('"')
-    global workers
-    workers = args.workers
-    global THREADS
-    THREADS = args.THREADS
-    global download_path
-    if args.download:
-        download_path = args.download
-    else:
-        download_path = os.path.join(outdir, "download")
-    global QC_dir
-    QC_dir = os.path.join(outdir, "QC_dir")
-    global Bam_dir
-    Bam_dir = os.path.join(outdir, "Bam")
-    global Count_dir
-    Count_dir = os.path.join(outdir, "Count")
-    global feature_path
-    feature_path = os.path.join(outdir, "Features")
-    feature_path = Path(feature_path)
-    global done_sample
-    done_sample = feature_path / "done_sample.txt"
+    config = RunConfig.from_args(args)
     # init workshop
-    init_wd()
+    init_wd(config)
     srr_df = pd.read_table(input_file, comment='#')
     if len(srr_df.columns) == 1:
         # only have srr column
@@ -235,13 +378,34 @@ def main():
         srr_df.columns = ["srx", "srr"]
 
     SRRs = srr_df["srr"].values.tolist()
+    state = RunState(config.feature_path.as_posix())
+    if args.retry_rejected:
+        # The samples rejected by the pre-screen are checked again
+        for SRR in set(SRRs).intersection(state.rejected()):
+            layout_file = config.feature_path / "layout" / f"{SRR}.parquet"
+            if layout_file.exists() and pd.read_parquet(layout_file).layout.iloc[0] == "rejected":
+                remove_file(layout_file.as_posix())
+        state.unreject(SRRs)
+    if args.rerun:
+        # The stages check their feature files before running, remove them
+        files = state.reset(args.rerun, SRRs)
+        logger.info(f"Rerun {', '.join(args.rerun)}, remove {len(files):,} feature files")
+        for file in files:
+            remove_file(file)
     logger.info(f"Start processing, {len(SRRs)} srrs will be processed")
     # run process local
-    local_thread(SRRs)
-    if not only_download:
-        done_samples = check_done_sample(outdir)
-        feature_store(done_samples, outdir)
-        detection((feature_path / "features.parquet").as_posix())
+    if config.picard_worker and not config.only_download:
+        # The JVM pool bounds the heap of the Picard jobs running at once
+        start_worker(config.picard, config.jvm_memory, (Path(config.outdir) / "picard_worker.log").as_posix())
+    try:
+        local_thread(config, state, SRRs)
+    finally:
+        stop_worker()
+        state.close()
+    if not config.only_download:
+        done_samples = check_done_sample(config.outdir)
+        feature_store(done_samples, config.outdir)
+        detection((config.feature_path / "features.parquet").as_posix())
 
 
 if __name__ == "__main__":
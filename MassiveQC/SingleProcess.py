@@ -10,34 +10,45 @@ from pathlib import Path
 
 # sys.path.insert(0, "/home/mwshi/github/MassiveQC")
 from .get_sra import get_sra
-from .check_fq import check_fq
+from .check_fq import check_fq, raise_if_rejected
+from .compression import OutputCompression
 from .fastq_screen import fastq_screen
 from .atropos import atropos
+from .downsample import downsample
 from .hisat2 import Hisat2
+from .bam_profile import BamProfile
 from .collectrnaseqmetrics import CollectRnaseqMetrics
 from .markduplicates import MarkDuplicates
+from .picard_worker import JOBS_PER_SAMPLE, start_worker, stop_worker
 from .FeatureCounts import FeatureCounts
+from .failures import PERMANENT, classify
 from .parser import remove_file
+from .run_state import SAMPLE, mark_done, mark_rejected, marked_rejected
+from .stages import run_stages
 
 
 def init_wd():
     Path(outdir).mkdir(exist_ok=True)
     Path(download_path).mkdir(exist_ok=True)
     feature_path.mkdir(exist_ok=True)
+    (feature_path / "DoneSample").mkdir(exist_ok=True)
     (feature_path / "layout").mkdir(exist_ok=True)
+    (feature_path / "readstats").mkdir(exist_ok=True)
     Path(QC_dir).mkdir(exist_ok=True)
     (feature_path / "fastq_screen").mkdir(exist_ok=True)
     (feature_path / "atropos").mkdir(exist_ok=True)
     Path(Bam_dir).mkdir(exist_ok=True)
+    if bam_profile.tmp_dir:
+        Path(bam_profile.tmp_dir).mkdir(parents=True, exist_ok=True)
     (feature_path / "hisat2").mkdir(exist_ok=True)
     (feature_path / "aln_stats").mkdir(exist_ok=True)
+    (feature_path / "bam_profile").mkdir(exist_ok=True)
     (feature_path / "strand").mkdir(exist_ok=True)
     (feature_path / "rnaseqmetrics").mkdir(exist_ok=True)
     (feature_path / "genebody_coverage").mkdir(exist_ok=True)
     (feature_path / "markduplicates").mkdir(exist_ok=True)
     (feature_path / "count_summary").mkdir(exist_ok=True)
     Path(Count_dir).mkdir(exist_ok=True)
-    (feature_path / "DoneSample").mkdir(exist_ok=True)
 
 
 def process(SRR):
@@ -54,8 +65,10 @@ def process(SRR):
     summary_file = feature_path / "layout" / f"{SRR}.parquet"
     if summary_file.exists():
         logger.info(f"{SRR} fastq file has been checked")
+        raise_if_rejected(summary_file)
     else:
-        raw_fqs = check_fq(SRR, download_path, QC_dir, feature_path)
+        raw_fqs = check_fq(SRR, download_path, QC_dir, feature_path, fastq_engine, THREADS, compression,
+                           not no_prescreen, fuse_atropos)
         # remove the raw fastq
         if remove_fastq:
             for k in raw_fqs:
@@ -67,14 +80,14 @@ def process(SRR):
     if fastq_screen_output.exists():
         logger.info(f"{SRR} fastq_screen step has been done")
     else:
-        fastq_screen(SRR, QC_dir, feature_path.as_posix(), fastq_screen_config, THREADS)
+        fastq_screen(SRR, QC_dir, feature_path.as_posix(), fastq_screen_config, THREADS, screen_engine, screen_index)
 
     # atropos
     atropos_output = feature_path / "atropos" / f"{SRR}.parquet"
     if atropos_output.exists():
         logger.info(f"{SRR} atropos step has been done")
     else:
-        atropos(feature_path.as_posix(), SRR, QC_dir, THREADS)
+        atropos(feature_path.as_posix(), SRR, QC_dir, THREADS, compression)
 
     # hisat2
     _hisat2 = Path(feature_path) / "hisat2" / f"{SRR}.parquet"
@@ -82,43 +95,57 @@ def process(SRR):
     if _hisat2.exists() and _alnStat.exists():
         logger.info(f"{SRR} hisat2 step has been done")
     else:
-        hisat_runner = Hisat2(feature_path.as_posix(), SRR, QC_dir, Bam_dir, THREADS, reference, splice=splice)
+        if max_reads:
+            downsample(feature_path.as_posix(), SRR, QC_dir, max_reads, compression)
+        hisat_runner = Hisat2(feature_path.as_posix(), SRR, QC_dir, Bam_dir, THREADS, reference, splice=splice,
+                             stream=stream_alignment, profile=bam_profile)
         trim_fqs = hisat_runner.hisat2()
         if remove_fastq:
             for k in trim_fqs:
                 logger.info(f"Remove {k}")
                 remove_file(k)
 
-    # metrics
+    # strand, featureCounts needs it
     strand = feature_path / "strand" / f"{SRR}.parquet"
+    metrics_runner = CollectRnaseqMetrics(feature_path.as_posix(), SRR, Bam_dir, THREADS, ref_flat, picard)
+    if not strand.exists():
+        metrics_runner.infer_strand()
+
+    # The post-alignment stages read the sorted BAM concurrently
+    stages = {}
     table = feature_path / "rnaseqmetrics" / f"{SRR}.parquet"
     coverage = feature_path / "genebody_coverage" / f"{SRR}.parquet"
-    if strand.exists() and table.exists() and coverage.exists():
+    if table.exists() and coverage.exists():
         logger.info(f"{SRR} collectrnaseqmetrics step has been done")
     else:
-        metrics_runner = CollectRnaseqMetrics(feature_path.as_posix(), SRR, Bam_dir, THREADS, ref_flat, picard)
-        metrics_runner.collectrnaseqmetrics()
+        stages["collectrnaseqmetrics"] = metrics_runner.collectrnaseqmetrics
 
     # markduplicates
     markdup = feature_path / "markduplicates" / f"{SRR}.parquet"
     if markdup.exists():
         logger.info(f"{SRR} markduplicates step has been done")
     else:
-        markdup_runner = MarkDuplicates(feature_path.as_posix(), SRR, Bam_dir, THREADS, picard)
-        markdup_runner.markduplicates()
+        markdup_runner = MarkDuplicates(feature_path.as_posix(), SRR, Bam_dir, THREADS, picard,
+                                        engine=duplicates_engine)
+        stages["markduplicates"] = markdup_runner.markduplicates
 
     # FeatureCounts
     count_summary = feature_path / "count_summary" / f"{SRR}.parquet"
     if count_summary.exists():
         logger.info(f"{SRR} FeatureCounts step has been done")
     else:
-        count_runner = FeatureCounts(feature_path.as_posix(), SRR, Bam_dir, Count_dir, gtf, THREADS)
-        bam_file = count_runner.FeatureCounts()
-        if remove_bam:
-            remove_file(bam_file)
+        count_runner = FeatureCounts(feature_path.as_posix(), SRR, Bam_dir, Count_dir, gtf, THREADS,
+                                     remove_counts)
+        stages["FeatureCounts"] = count_runner.FeatureCounts
 
-    # complete one srr, touch one file
-    (feature_path / "DoneSample" / SRR).touch()
+    run_stages(SRR, stages)
+    if remove_bam:
+        bam_file = Path(Bam_dir) / f"{SRR}.sorted.bam"
+        logger.info(f"Remove {bam_file}")
+        remove_file(bam_file.as_posix())
+
+    # complete one srr, leave its marker for the run database
+    mark_done(feature_path.as_posix(), SRR)
     return SRR
 
 
@@ -150,6 +177,34 @@ def get_arguments():
     parser.add_argument('--skip_download', action="store_true", help="Skip the download step", default=False)
     parser.add_argument('--remove_fastq', action="store_true", help="Don't remain the fastq after running hisat2", default=False)
     parser.add_argument('--remove_bam', action="store_true", help="Don't remain the bam after running FeatureCounts", default=False)
+    parser.add_argument('--fastq_engine', type=str, choices=["vector", "python"], default="vector",
+                        help="Engine used to validate fastq reads. 'python' checks read by read, 'vector' checks chunks of reads")
+    parser.add_argument('--qc_compression', type=str, choices=["gzip", "bgzf"], default="gzip",
+                        help="Compression of the fastq files in QC_dir, 'bgzf' needs bgzip")
+    parser.add_argument('--qc_compresslevel', type=int, choices=range(10), default=None,
+                        help="Compression level of the fastq files in QC_dir, 0 stores them uncompressed in gzip")
+    parser.add_argument('--no_prescreen', action="store_true", default=False,
+                        help="Don't reject hopeless samples from a quick look at their fastq files before checking them")
+    parser.add_argument('--fuse_atropos', action="store_true", default=False,
+                        help="Stream the checked reads to atropos instead of writing them to QC_dir")
+    parser.add_argument('--screen_engine', type=str, choices=["fastq_screen", "kmer"], default="fastq_screen",
+                        help="How contamination is screened, 'kmer' looks the reads up in k-mer indexes of the fastq_screen references")
+    parser.add_argument('--max-reads', dest="max_reads", type=int, default=None,
+                        help="Downsample the trimmed reads, or pairs, of deeper samples to about this number before hisat2. The count features are extrapolated")
+    parser.add_argument('--stream_alignment', action="store_true", default=False,
+                        help="Pipe hisat2 into samtools instead of writing a SAM file")
+    parser.add_argument('--bam_profile', type=str, choices=["auto", "archive", "ephemeral"], default="auto",
+                        help="How the sorted BAM is written, 'ephemeral' compresses fast, 'auto' picks it with --remove_bam")
+    parser.add_argument('--sort_memory', type=str, default=None,
+                        help="Memory per samtools sort thread, like 768M or 2G")
+    parser.add_argument('--sort_tmpdir', type=str, default=None,
+                        help="Directory of the samtools sort temporary files. The default is the Bam directory")
+    parser.add_argument('--duplicates_engine', type=str, choices=["picard", "stream", "validate"], default="picard",
+                        help="How duplicates are counted, 'stream' skips the deduplicated BAM, 'validate' compares it with picard")
+    parser.add_argument('--picard_worker', action="store_true", default=False,
+                        help="Run the Picard tools of the sample in one JVM instead of a java call per tool")
+    parser.add_argument('--remove_counts', action="store_true", default=False,
+                        help="Keep the counts only in the count store, remove the featureCounts text files")
     parser.set_defaults(**config_args)
     if pre_args.conf:
         for action in parser._actions:
@@ -191,6 +246,28 @@ def main():
     workers = args.workers
     global THREADS
     THREADS = args.THREADS
+    global fastq_engine
+    fastq_engine = args.fastq_engine
+    global no_prescreen
+    no_prescreen = args.no_prescreen
+    global fuse_atropos
+    fuse_atropos = args.fuse_atropos
+    global screen_engine
+    screen_engine = args.screen_engine
+    global max_reads
+    max_reads = args.max_reads
+    global stream_alignment
+    stream_alignment = args.stream_alignment
+    global bam_profile
+    bam_profile = BamProfile.choose(args.bam_profile, remove_bam, args.sort_memory, args.sort_tmpdir)
+    global remove_counts
+    remove_counts = args.remove_counts
+    global duplicates_engine
+    duplicates_engine = args.duplicates_engine
+    global picard_worker
+    picard_worker = args.picard_worker
+    global compression
+    compression = OutputCompression(args.qc_compression, args.qc_compresslevel, THREADS)
     global download_path
     if args.download:
         download_path = args.download
@@ -200,6 +277,8 @@ def main():
     QC_dir = os.path.join(outdir, "QC_dir")
     global Bam_dir
     Bam_dir = os.path.join(outdir, "Bam")
+    global screen_index
+    screen_index = os.path.join(outdir, "screen_index")
     global Count_dir
     Count_dir = os.path.join(outdir, "Count")
     global feature_path
@@ -209,8 +288,24 @@ def main():
     done_sample = feature_path / "done_sample.txt"
     # init workshop
     init_wd()
+    # Jobs on other hosts of a cluster don't share the run database, they leave markers
+    rejected = marked_rejected(feature_path.as_posix(), srr)
+    if rejected is not None:
+        logger.info(f"Skip {srr}, rejected in an earlier run: {rejected}")
+        return
     # process srr
-    process(srr)
+    if picard_worker and not only_download:
+        # The JVM gets the heap of a java call for each Picard job running at once
+        start_worker(picard, 3 * JOBS_PER_SAMPLE, (Path(outdir) / "picard_worker.log").as_posix())
+    try:
+        process(srr)
+    except Exception as error:
+        # Later runs skip a sample rejected for its data
+        if classify(error) == PERMANENT:
+            mark_rejected(feature_path.as_posix(), srr, SAMPLE, error)
+        raise
+    finally:
+        stop_worker()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,97 @@
+"""GTF annotation converted once to the SAF format of featureCounts
+
+featureCounts parses the attributes of every GTF line on each run. The exons
+of the GTF are written once to a SAF file keyed by the checksum of the GTF,
+which featureCounts reads without parsing attributes.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import re
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+from .parser import remove_file
+
+logger = logging.getLogger("MassiveQC")
+
+# Same defaults as featureCounts, -t exon -g gene_id
+FEATURE_TYPE = "exon"
+GENE_ID = re.compile(r'gene_id "([^"]+)"')
+CHECKSUM_BLOCK = 1024 * 1024
+
+_lock = threading.Lock()
+
+
+def saf_annotation(gtf: str, cache_dir: str) -> Path:
+    """Path to the SAF file of `gtf`, written when it is not cached yet
+
+    **parameter**
+
+    gtf: str
+        The GTF file, may be gzip compressed.
+
+    cache_dir: str
+        Directory of the cached SAF files.
+
+    **return**
+
+    saf: Path
+        SAF file with the exons of each gene.
+    """
+    with _lock:
+        saf = Path(cache_dir) / f"{gtf_checksum(gtf)}.saf"
+        if not saf.exists():
+            saf.parent.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Convert {gtf} to {saf}")
+            tmp = saf.with_suffix(f".{os.getpid()}.tmp")
+            try:
+                write_saf(gtf, tmp)
+            except Exception:
+                remove_file(tmp.as_posix())
+                raise
+            # Other processes of the same run see a whole file or none
+            tmp.replace(saf)
+    return saf
+
+
+@lru_cache(maxsize=4)
+def _checksum(gtf: str, size: int, mtime: float) -> str:
+    digest = hashlib.sha1()
+    with open(gtf, "rb") as fh:
+        for block in iter(lambda: fh.read(CHECKSUM_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def gtf_checksum(gtf: str) -> str:
+    """SHA-1 of the GTF file, computed once per file version"""
+    stat = os.stat(gtf)
+    return _checksum(os.path.abspath(gtf), stat.st_size, stat.st_mtime)
+
+
+def write_saf(gtf: str, saf: Path) -> None:
+    """Write the exons of a GTF file in SAF format"""
+    opener = gzip.open if gtf.endswith(".gz") else open
+    n_exons = 0
+    with opener(gtf, "rt") as fh, open(saf, "w") as out:
+        out.write("GeneID\tChr\tStart\tEnd\tStrand\n")
+        for line in fh:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9 or fields[2] != FEATURE_TYPE:
+                continue
+            gene_id = GENE_ID.search(fields[8])
+            if gene_id is None:
+                continue
+            out.write(f"{gene_id.group(1)}\t{fields[0]}\t{fields[3]}\t{fields[4]}\t{fields[6]}\n")
+            n_exons += 1
+    if n_exons == 0:
+        raise AnnotationException(f"No {FEATURE_TYPE} with a gene_id in {gtf}")
+
+
+class AnnotationException(Exception):
+    """Basic exception for problems with the annotation"""
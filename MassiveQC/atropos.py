@@ -1,14 +1,29 @@
 from pathlib import Path
 import pandas as pd
 import logging
-from typing import Tuple
+from typing import Optional, Tuple
+import errno
+import os
+import queue
 import re
+import shlex
+import subprocess
+import threading
+import time
+from contextlib import ExitStack
 from .command import run_command
+from .compression import OutputCompression
 
 logger = logging.getLogger("MassiveQC")
 
+# Reads are fed to atropos in blocks, each input pipe buffers up to
+# FEED_BLOCKS blocks so one mate can run ahead of the other.
+FEED_SIZE = 1024 * 1024
+FEED_BLOCKS = 16
 
-def atropos(feature_path: str, SRR: str, QC_dir: str, THREADS: int):
+
+def atropos(feature_path: str, SRR: str, QC_dir: str, THREADS: int,
+            compression: Optional[OutputCompression] = None):
     """This function is main part which is used to trim the reads.
     Filter reads that are less than 25bp.
 
@@ -21,6 +36,8 @@ def atropos(feature_path: str, SRR: str, QC_dir: str, THREADS: int):
        The directory of result fastq file after check_fq.
     THREADS: int
         Thread number for atropos.
+    compression: OutputCompression or None
+        How the trimmed fastq files are compressed, atropos decides if None.
     **return**
     None
     """
@@ -29,7 +46,7 @@ def atropos(feature_path: str, SRR: str, QC_dir: str, THREADS: int):
         QC_dir = Path(QC_dir)
         layout = Path(feature_path) / "layout" / f"{SRR}.parquet"
         layout_ = pd.read_parquet(layout).layout[0]
-        results = run_atropos(layout_, SRR, QC_dir, THREADS)
+        results = run_atropos(layout_, SRR, QC_dir, THREADS, compression)
         output = Path(feature_path) / "atropos" / f"{SRR}.parquet"
         summarize(results, output, SRR)
         if layout_ == "PE":
@@ -38,11 +55,11 @@ def atropos(feature_path: str, SRR: str, QC_dir: str, THREADS: int):
             if r1_trim.exists() and r2_trim.exists():
                 (QC_dir / f"{SRR}_1.fastq.gz").unlink()
                 (QC_dir / f"{SRR}_2.fastq.gz").unlink()
-        elif layout_ == "Keep_R1":
+        elif layout_ == "keep_R1":
             r1_trim = QC_dir / f"{SRR}_1.trim.fastq.gz"
             if r1_trim.exists():
                 (QC_dir / f"{SRR}_1.fastq.gz").unlink()
-        elif layout_ == "Keep_R2":
+        elif layout_ == "keep_R2":
             r1_trim = QC_dir / f"{SRR}_2.trim.fastq.gz"
             if r1_trim.exists():
                 (QC_dir / f"{SRR}_2.fastq.gz").unlink()
@@ -53,47 +70,261 @@ def atropos(feature_path: str, SRR: str, QC_dir: str, THREADS: int):
         logger.info(f"Complete atropos {SRR}")
     except AtroposException as error:
         logger.warning(f"Flagging {SRR} as Atropos Bad")
-        raise AtroposException("Atropos Bad")
+        raise AtroposException(f"Atropos Bad: {error}")
+
 
+def run_atropos(layout_, SRR, QC_dir: Path, THREADS, compression: Optional[OutputCompression] = None) -> str:
+    """Run the atropos command in shell
 
-def run_atropos(layout_, SRR, QC_dir: Path, THREADS) -> str:
-    """Run the atropos command in shell"""
+    With non default compression settings atropos writes plain reads to named
+    pipes, which are compressed into the trimmed fastq files.
+    """
     # adapters = os.path.join(os.path.abspath(__file__), "sequencing_adapters.fa")
-    if layout_ == "PE":
-        r1 = QC_dir / f"{SRR}_1.fastq.gz"
-        r2 = QC_dir / f"{SRR}_2.fastq.gz"
-        r1_trim = QC_dir / f"{SRR}_1.trim.fastq.gz"
-        r2_trim = QC_dir / f"{SRR}_2.trim.fastq.gz"
-        cmd = f"atropos trim " \
-              f"-q 20 --minimum-length 25 " \
-              f"--threads {THREADS} " \
-              f"-pe1 {r1} -pe2 {r2} -o {r1_trim} -p {r2_trim}"
-    elif layout_ == "Keep_R1":
-        r1 = QC_dir / f"{SRR}_1.fastq.gz"
-        r1_trim = QC_dir / f"{SRR}_1.trim.fastq.gz"
-        cmd = f"atropos trim " \
-              "-q 20 -U 0 --minimum-length 25 " \
-              f"--threads {THREADS} " \
-              f"-se {r1} -o {r1_trim}"
-    elif layout_ == "Keep_R2":
-        r2 = QC_dir / f"{SRR}_2.fastq.gz"
-        r2_trim = QC_dir / f"{SRR}_2.trim.fastq.gz"
-        cmd = f"atropos trim " \
-              "-q 20 -U 0 --minimum-length 25 " \
-              f"--threads {THREADS} " \
-              f"-se {r2} -o {r2_trim}"
-    else:
-        r1 = QC_dir / f"{SRR}.fastq.gz"
-        r1_trim = QC_dir / f"{SRR}.trim.fastq.gz"
-        cmd = f"atropos trim " \
-              "-q 20 -U 0 --minimum-length 25 " \
-              f"--threads {THREADS} " \
-              f"-se {r1} -o {r1_trim}"
-    logger.info(f"running {cmd}")
-    results = run_command(cmd, verbose=True)
+    compression = compression or OutputCompression()
+    with ExitStack() as stack:
+        def output(path: Path) -> Path:
+            if compression.is_default:
+                return path
+            return stack.enter_context(compression.fifo(path))
+
+        if layout_ == "PE":
+            r1 = QC_dir / f"{SRR}_1.fastq.gz"
+            r2 = QC_dir / f"{SRR}_2.fastq.gz"
+            r1_trim = output(QC_dir / f"{SRR}_1.trim.fastq.gz")
+            r2_trim = output(QC_dir / f"{SRR}_2.trim.fastq.gz")
+            cmd = f"atropos trim " \
+                  f"-q 20 --minimum-length 25 " \
+                  f"--threads {THREADS} " \
+                  f"-pe1 {r1} -pe2 {r2} -o {r1_trim} -p {r2_trim}"
+        elif layout_ == "keep_R1":
+            r1 = QC_dir / f"{SRR}_1.fastq.gz"
+            r1_trim = output(QC_dir / f"{SRR}_1.trim.fastq.gz")
+            cmd = f"atropos trim " \
+                  "-q 20 -U 0 --minimum-length 25 " \
+                  f"--threads {THREADS} " \
+                  f"-se {r1} -o {r1_trim}"
+        elif layout_ == "keep_R2":
+            r2 = QC_dir / f"{SRR}_2.fastq.gz"
+            r2_trim = output(QC_dir / f"{SRR}_2.trim.fastq.gz")
+            cmd = f"atropos trim " \
+                  "-q 20 -U 0 --minimum-length 25 " \
+                  f"--threads {THREADS} " \
+                  f"-se {r2} -o {r2_trim}"
+        else:
+            r1 = QC_dir / f"{SRR}.fastq.gz"
+            r1_trim = output(QC_dir / f"{SRR}.trim.fastq.gz")
+            cmd = f"atropos trim " \
+                  "-q 20 -U 0 --minimum-length 25 " \
+                  f"--threads {THREADS} " \
+                  f"-se {r1} -o {r1_trim}"
+        logger.info(f"running {cmd}")
+        results = run_command(cmd, verbose=True)
     return results
 
 
+class AtroposStream:
+    """Run atropos on reads written to it, without an intermediate fastq file
+
+    Atropos reads named pipes that are fed from threads, while the trimmed
+    reads are written to the usual trimmed fastq files. The log of atropos
+    is in `log` once the stream is closed. If the block raises, atropos is
+    stopped and the trimmed files are removed.
+
+    **parameter**
+
+    SRR: str
+        SRR ID.
+
+    QC_dir: str
+        The directory of the trimmed fastq files.
+
+    THREADS: int
+        Thread number for atropos.
+
+    paired: bool
+        Whether pairs of reads are trimmed.
+
+    compression: OutputCompression or None
+        How the trimmed fastq files are compressed, atropos decides if None.
+    """
+    def __init__(self, SRR: str, QC_dir: str, THREADS: int, paired: bool,
+                 compression: Optional[OutputCompression] = None):
+        self.SRR = SRR
+        self.QC_dir = Path(QC_dir)
+        self.THREADS = THREADS
+        self.paired = paired
+        self.compression = compression or OutputCompression()
+        self.log = None
+        if paired:
+            self.trimmed = [self.QC_dir / f"{SRR}_1.trim.fastq.gz", self.QC_dir / f"{SRR}_2.trim.fastq.gz"]
+        else:
+            self.trimmed = [self.QC_dir / f"{SRR}.trim.fastq.gz"]
+        self.pipes = [path.with_name(path.name.replace(".trim.fastq.gz", ".fifo.fastq")) for path in self.trimmed]
+        self.inputs = []
+        self._stack = ExitStack()
+        self._process = None
+        self._log_lines = []
+
+    def __enter__(self):
+        try:
+            for pipe in self.pipes:
+                if pipe.exists():
+                    pipe.unlink()
+                os.mkfifo(pipe)
+                self._stack.callback(pipe.unlink)
+            outputs = [
+                path if self.compression.is_default else self._stack.enter_context(self.compression.fifo(path))
+                for path in self.trimmed
+            ]
+            if self.paired:
+                cmd = f"atropos trim " \
+                      f"-q 20 --minimum-length 25 " \
+                      f"--threads {self.THREADS} " \
+                      f"-pe1 {self.pipes[0]} -pe2 {self.pipes[1]} -o {outputs[0]} -p {outputs[1]}"
+            else:
+                cmd = f"atropos trim " \
+                      "-q 20 -U 0 --minimum-length 25 " \
+                      f"--threads {self.THREADS} " \
+                      f"-se {self.pipes[0]} -o {outputs[0]}"
+            logger.info(f"running {cmd}")
+            try:
+                self._process = subprocess.Popen(
+                    shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                )
+            except OSError as error:
+                raise AtroposException(f"Unable to run atropos: {error}")
+            self._logger = threading.Thread(target=self._read_log, daemon=True)
+            self._logger.start()
+            self.inputs = [_PipeFeeder(pipe, self._process) for pipe in self.pipes]
+        except BaseException:
+            self._abort()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._abort()
+            return False
+        try:
+            # Every pipe gets all its reads before waiting for any of them
+            for feeder in self.inputs:
+                feeder.finish()
+            for feeder in self.inputs:
+                feeder.join()
+        except BaseException:
+            self._abort()
+            raise
+        self._process.wait()
+        self._logger.join()
+        self._stack.close()
+        self.log = "".join(self._log_lines)
+        return False
+
+    def _read_log(self) -> None:
+        for line in self._process.stdout:
+            line = line.decode("utf-8").strip()
+            if line:
+                self._log_lines.append(line + "\n")
+
+    def _abort(self) -> None:
+        """Stop atropos and remove everything it wrote"""
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+        for feeder in self.inputs:
+            feeder.abort()
+        try:
+            self._stack.close()
+        finally:
+            for path in self.trimmed:
+                if path.exists():
+                    path.unlink()
+
+
+class _PipeFeeder:
+    """Write blocks of reads to a named pipe that a process reads, from a thread
+
+    Pair-end reads are fed to two pipes that atropos reads in its own order,
+    a thread for each pipe keeps one mate from blocking the other.
+    """
+    def __init__(self, pipe: Path, process: subprocess.Popen):
+        self.pipe = pipe
+        self.process = process
+        self.error = None
+        self._blocks = []
+        self._size = 0
+        self._queue = queue.Queue(FEED_BLOCKS)
+        self._thread = threading.Thread(target=self._feed, daemon=True)
+        self._thread.start()
+
+    def write(self, data) -> None:
+        self._blocks.append(data)
+        self._size += len(data)
+        if self._size >= FEED_SIZE:
+            self._put(b"".join(self._blocks))
+            self._blocks, self._size = [], 0
+
+    def finish(self) -> None:
+        """Send the last reads, the pipe is closed once they are written"""
+        if self._blocks:
+            self._put(b"".join(self._blocks))
+            self._blocks, self._size = [], 0
+        self._put(None)
+
+    def join(self) -> None:
+        self._thread.join()
+        if self.error is not None:
+            raise AtroposException(f"Unable to feed {self.pipe}: {self.error}")
+
+    def abort(self) -> None:
+        """Stop the thread once the process is gone"""
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+            self._thread.join(0.1)
+
+    def _put(self, block) -> None:
+        while self._thread.is_alive():
+            try:
+                self._queue.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise AtroposException(f"Atropos stopped reading {self.pipe}: {self.error}")
+
+    def _feed(self) -> None:
+        try:
+            with self._open() as fh:
+                while True:
+                    block = self._queue.get()
+                    if block is None:
+                        break
+                    fh.write(block)
+        except OSError as error:
+            self.error = error
+
+    def _open(self):
+        """Open the pipe for writing once the process opened it for reading"""
+        while True:
+            try:
+                fd = os.open(self.pipe, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as error:
+                if error.errno != errno.ENXIO:
+                    raise
+            if self.process.poll() is not None:
+                raise BrokenPipeError(errno.EPIPE, "Process exited without reading its input")
+            time.sleep(0.05)
+        os.set_blocking(fd, True)
+        return os.fdopen(fd, "wb")
+
+
 def summarize(log: str, output: Path, SRR: str) -> None:
     """Extract features from atropos result"""
     df = pd.DataFrame(
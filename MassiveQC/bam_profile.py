@@ -0,0 +1,70 @@
+"""Output settings of the sorted BAM files written after the alignment"""
+import logging
+import re
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+logger = logging.getLogger("MassiveQC")
+
+# Compression level of each profile. BAM files that are kept are compressed
+# as much as possible, BAM files removed after FeatureCounts as fast as possible.
+PROFILES = {"archive": 9, "ephemeral": 1}
+MEMORY_PATTERN = re.compile(r"^\d+[KMG]?$")
+
+
+class BamProfile:
+    """How samtools sort writes the sorted BAM file
+
+    **parameter**
+
+    name: str
+        "archive" or "ephemeral".
+
+    sort_memory: str or None
+        Memory per sort thread like "768M" or "2G", None keeps the samtools default.
+
+    tmp_dir: str or None
+        Directory of the temporary files of samtools sort, None writes them
+        next to the BAM file.
+    """
+    def __init__(self, name: str = "archive", sort_memory: Optional[str] = None, tmp_dir: Optional[str] = None):
+        if name not in PROFILES:
+            raise BamProfileException(f"Unknown BAM profile {name}")
+        if sort_memory is not None and not MEMORY_PATTERN.match(sort_memory):
+            raise BamProfileException(f"Invalid sort memory {sort_memory}")
+        self.name = name
+        self.level = PROFILES[name]
+        self.sort_memory = sort_memory
+        self.tmp_dir = tmp_dir
+
+    @classmethod
+    def choose(cls, name: str = "auto", remove_bam: bool = False, sort_memory: Optional[str] = None,
+               tmp_dir: Optional[str] = None) -> "BamProfile":
+        """Resolve the "auto" profile, "ephemeral" if the BAM files are removed"""
+        if name == "auto":
+            name = "ephemeral" if remove_bam else "archive"
+        return cls(name, sort_memory, tmp_dir)
+
+    def sort_options(self, SRR: str) -> str:
+        """Options of samtools sort for the BAM file of `SRR`"""
+        options = f"-l {self.level}"
+        if self.sort_memory is not None:
+            options += f" -m {self.sort_memory}"
+        if self.tmp_dir is not None:
+            options += f" -T {Path(self.tmp_dir) / SRR}"
+        return options
+
+    def save(self, output_file: Path, SRR: str) -> None:
+        """Record the profile used for the BAM file of `SRR`"""
+        df = pd.DataFrame(
+            [[self.name, self.level, self.sort_memory, self.tmp_dir]],
+            index=pd.Index([SRR], name="srr"),
+            columns=["profile", "level", "sort_memory", "tmp_dir"],
+        )
+        df.to_parquet(output_file)
+
+
+class BamProfileException(Exception):
+    """Basic exception for invalid BAM output settings"""
@@ -0,0 +1,146 @@
+"""Alignment statistics of a BAM file collected in a single pass
+
+Replaces `samtools stats` and `bamtools stats`, only the values kept in
+aln_stats are computed, with the definitions of those tools.
+"""
+import logging
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("MassiveQC")
+
+# Insert sizes are counted up to the `-i` default of samtools stats, the
+# average and deviation use the main bulk of 99% of the pairs.
+MAX_INSERT = 8000
+MAIN_BULK = 0.99
+# Qualities are summed in batches of reads
+BATCH_SIZE = 10_000
+
+
+class BamStats:
+    """Accumulate alignment statistics from SAM records
+
+    Records are added as the split fields of SAM lines, so they can come
+    from any stream of the alignments.
+    """
+    def __init__(self):
+        self.total = 0
+        self.reverse = 0
+        self.mq0 = 0
+        self.anomalous = 0
+        self.sum_qual = 0
+        self.total_len = 0
+        # Inward, outward and other orientation counts of each insert size
+        self.isize = np.zeros((3, MAX_INSERT), dtype=np.int64)
+        self._quals = []
+
+    def add(self, fields: list) -> None:
+        """Add a record from its first 11 SAM fields"""
+        flag = int(fields[1])
+        # bamtools counts the strand of every record
+        self.total += 1
+        if flag & 0x10:
+            self.reverse += 1
+        # samtools skips secondary alignments and reads without sequence
+        if flag & 0x100 or fields[9] == b"*":
+            return
+        qual = fields[10].rstrip(b"\n")
+        self.total_len += len(qual)
+        if qual != b"*":
+            self._quals.append(qual)
+            if len(self._quals) >= BATCH_SIZE:
+                self._sum_quals()
+        if flag & 0x4:
+            return
+        if fields[4] == b"0":
+            self.mq0 += 1
+        if not flag & 0x1 or flag & 0x8:
+            return
+        same_ref = fields[6] == b"=" or fields[6] == fields[2]
+        if not same_ref:
+            self.anomalous += 1
+        isize = min(abs(int(fields[8])), MAX_INSERT - 1)
+        if isize > 0 or same_ref:
+            self._add_orientation(flag, int(fields[7]) - int(fields[3]), isize)
+
+    def _add_orientation(self, flag: int, pos_fst: int, isize: int) -> None:
+        """Count a read as samtools stats does, each pair is seen twice"""
+        is_fst = 1 if flag & 0x40 else -1
+        is_fwd = -1 if flag & 0x10 else 1
+        is_mfwd = -1 if flag & 0x20 else 1
+        if is_fwd * is_mfwd > 0:
+            self.isize[2, isize] += 1
+        elif is_fst * pos_fst > 0:
+            self.isize[0 if is_fst * is_fwd > 0 else 1, isize] += 1
+        elif is_fst * pos_fst < 0:
+            self.isize[1 if is_fst * is_fwd > 0 else 0, isize] += 1
+
+    def _sum_quals(self) -> None:
+        quals = b"".join(self._quals)
+        self._quals = []
+        self.sum_qual += int(np.frombuffer(quals, dtype=np.uint8).sum(dtype=np.int64)) - 33 * len(quals)
+
+    def to_frame(self, SRR: str) -> pd.DataFrame:
+        """Summarize as the columns of aln_stats"""
+        self._sum_quals()
+        isize = self.isize // 2
+        inward, outward, other = isize.sum(axis=1)
+        num = isize.sum(axis=0)
+        n_pairs = num.sum()
+        avg_isize, sd_isize = 0.0, 0.0
+        if n_pairs:
+            bulk = np.cumsum(num)
+            ibulk = int(np.argmax(bulk / n_pairs > MAIN_BULK)) + 1
+            n_bulk = bulk[ibulk - 1]
+            sizes = np.arange(ibulk)
+            avg_isize = (sizes * num[:ibulk]).sum() / n_bulk
+            sd_isize = np.sqrt((num[1:ibulk] * (sizes[1:] - avg_isize) ** 2).sum() / n_bulk)
+        average_quality = self.sum_qual / self.total_len if self.total_len else 0.0
+        return pd.DataFrame({
+            "reads_MQ0": self.mq0,
+            "average_quality": round(average_quality, 1),
+            "insert_size_average": round(float(avg_isize), 1),
+            "insert_size_standard_deviation": round(float(sd_isize), 1),
+            "inward_oriented_pairs": int(inward),
+            "outward_oriented_pairs": int(outward),
+            "pairs_with_other_orientation": int(other),
+            "pairs_on_different_chromosomes": self.anomalous // 2,
+            "Percent Forward": (self.total - self.reverse) / self.total * 100 if self.total else np.nan,
+            "Percent Reverse": self.reverse / self.total * 100 if self.total else np.nan,
+        }, index=pd.Index([SRR]))
+
+
+def bam_stats(bam: Path, SRR: str, THREADS: int = 1) -> pd.DataFrame:
+    """Read a BAM file once with samtools view and summarize its alignments
+
+    **parameter**
+
+    bam: Path
+        The BAM file.
+
+    SRR: str
+        Index of the returned row.
+
+    THREADS: int
+        Number of samtools decompression threads.
+
+    **return**
+
+    stats: DataFrame
+        One row with the columns of aln_stats.
+    """
+    stats = BamStats()
+    cmd = ["samtools", "view", "-@", str(THREADS), str(bam)]
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+        for line in process.stdout:
+            stats.add(line.split(b"\t", 11))
+    if process.returncode != 0:
+        raise BamStatsException(f"samtools view exited with status {process.returncode}")
+    return stats.to_frame(SRR)
+
+
+class BamStatsException(Exception):
+    """Basic exception for problems reading a BAM file"""
@@ -1,8 +1,11 @@
 from pathlib import Path
 from multiprocessing import Pool
 import os, argparse
+import logging
 import pandas as pd
 
+logger = logging.getLogger("MassiveQC")
+
 THREADS = 3
 
 # NOTE: features commented out are being dropped because they are repetitive or not important.
@@ -30,6 +33,23 @@ FEATURE_AGG = {
     "gene_body_three_prime": "mean",
 }
 
+# Summary metrics of the readstats table, used when the readstats feature exists
+READSTATS_AGG = {
+    "mean_quality": "mean",
+    "mean_gc": "mean",
+    "n_rate": "mean",
+}
+
+# Counts of the aligned reads, extrapolated for the samples downsampled with --max-reads.
+# number_junctions_on counts distinct junctions, it does not grow in proportion to the reads.
+EXTRAPOLATED = [
+    "num_reads",
+    "num_multimappers",
+    "reads_MQ0",
+    "number_genic_reads",
+    "number_junction_reads",
+]
+
 FEATURE_RENAME = {
     "rRNA_pct_reads_mapped": "percent_rrna_reads",
     "too_short": "number_reads_too_short",
@@ -61,6 +81,11 @@ def build_features(input: str, Features: Path):
         * Percent reads mapping to rRNA.
     * FeatureCounts
         * Number of reads mapping to junction
+    * Read statistics of check_fq, if they were collected
+        * Mean quality, GC content and N rate
+
+    The counts of samples downsampled before the alignment are divided by
+    their sampling fraction.
 
     **parameter**
     input: str
@@ -82,6 +107,10 @@ def build_features(input: str, Features: Path):
         "markduplicates": Features / "markduplicates.parquet",
         "count_summary": Features / "count_summary.parquet"
     }
+    feature_agg = dict(FEATURE_AGG)
+    if (Features / "readstats.parquet").exists():
+        feature_dict["readstats"] = Features / "readstats.parquet"
+        feature_agg.update(READSTATS_AGG)
     done_sample_file = Features / "done_sample.txt"
     srr_df = pd.read_table(input, comment="#")
     if len(srr_df.columns) == 1:
@@ -93,22 +122,32 @@ def build_features(input: str, Features: Path):
     srr_df = srr_df.set_index("srr", drop=False)
     done_sample_df = pd.read_table(done_sample_file, comment="#")
     done_srrs = done_sample_df["srr"].values.tolist()
+    data = workflow_data(done_srrs, feature_dict)
+    if "readstats" in feature_dict:
+        # Samples checked before the read statistics were collected have none
+        missing = data.reindex(columns=list(READSTATS_AGG)).isna().any(axis=1)
+        if missing.any():
+            logger.warning(f"{missing.sum():,} samples have no read statistics, "
+                           f"the read statistics are left out of the features")
+            data = data.drop(columns=list(READSTATS_AGG), errors="ignore")
+            feature_agg = dict(FEATURE_AGG)
+    data = extrapolate_counts(data)
     if len(srr_df.columns) == 2:
         (
-            workflow_data(done_srrs, feature_dict)
+            data
                 .join(srr_df)
                 .pipe(aggregate_gene_body_coverage)
                 .groupby("srx")
-                .agg(FEATURE_AGG)
+                .agg(feature_agg)
                 .rename(columns=FEATURE_RENAME)
                 .to_parquet(Features / "features.parquet")
         )
     else:
         (
-            workflow_data(done_srrs, feature_dict)
+            data
                 .join(srr_df)
                 .pipe(aggregate_gene_body_coverage)
-                .loc[:, FEATURE_AGG.keys()]
+                .loc[:, feature_agg.keys()]
                 .rename(columns=FEATURE_RENAME)
                 .to_parquet(Features / "features.parquet")
         )
@@ -118,7 +157,7 @@ def workflow_data(srrs: list, workflow_folders: dict) -> pd.DataFrame:
     pool = Pool(THREADS)
     df = (
         pd.concat(
-            pool.map(pd.read_parquet, [path for _, path in workflow_folders.items()]),
+            pool.map(load_features, [path for _, path in workflow_folders.items()]),
             axis=1,
             sort=False,
         )
@@ -130,6 +169,30 @@ def workflow_data(srrs: list, workflow_folders: dict) -> pd.DataFrame:
     return df
 
 
+def load_features(path: Path) -> pd.DataFrame:
+    """Read an aggregated feature file, one row per srr
+
+    The readstats table holds one row per metric, its summary metrics become
+    columns.
+    """
+    df = pd.read_parquet(path)
+    if path.stem == "readstats":
+        df = (
+            df[df.metric.isin(READSTATS_AGG.keys())]
+                .reset_index()
+                .pivot(index="srr", columns="metric", values="value")
+        )
+    return df
+
+
+def extrapolate_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """Scale the counts of downsampled samples back to all of their reads"""
+    if "sampling_fraction" not in df.columns:
+        return df
+    fraction = df.sampling_fraction.fillna(1.0)
+    return df.assign(**{col: df[col] / fraction for col in EXTRAPOLATED if col in df.columns})
+
+
 def aggregate_gene_body_coverage(df: pd.DataFrame) -> pd.DataFrame:
     """Sum gene body coverage to tertile.
     GBC is reported as a centile, with positions next to each other being
@@ -1,9 +1,13 @@
 import os
-from xopen import xopen
+import shutil
 import logging
 from pathlib import Path
 from typing import Optional
-from .fastq import Fastq, MixedUpReadsException, UnequalNumberReadsException
+from .fastq import Fastq
+from .atropos import AtroposException, AtroposStream, summarize as summarize_atropos
+from .compression import OutputCompression
+from .prescreen import prescreen_fastq
+from .subset import ReadSubset
 import pandas as pd
 from .parser import remove_file
 
@@ -18,7 +22,19 @@ class AbiException(Exception):
     """Basic exception when ABI file was downloaded from SRA"""
 
 
-def check_and_compress_fastq(r1: str, QC_dir: str, r2: Optional[str] = None):
+class _KeptMateException(Exception):
+    """A pair-end sample keeps a single mate, which can not be trimmed as pairs"""
+
+
+# Exceptions raised for the reasons the pre-screen rejects a sample
+REJECTS = {
+    "abi_solid": (AbiException, ""),
+    "small_library": (DownloadException, "<100,000 reads"),
+}
+
+
+def check_and_compress_fastq(r1: str, QC_dir: str, r2: Optional[str] = None, engine: str = "vector",
+                             THREADS: int = 1, compression: Optional[OutputCompression] = None):
     """Check the reads quality and compress them in a new fastq file
 
     **parameter**
@@ -32,6 +48,15 @@ def check_and_compress_fastq(r1: str, QC_dir: str, r2: Optional[str] = None):
     r2: str or None
         The second fastq file
 
+    engine: str
+        The validation engine of Fastq, "vector" or "python".
+
+    THREADS: int
+        Number of processes that check chunks of reads with the vector engine.
+
+    compression: OutputCompression or None
+        How the result fastq files are compressed, gzip with default level if None.
+
     **return**
 
     r1_gz: str
@@ -40,22 +65,115 @@ def check_and_compress_fastq(r1: str, QC_dir: str, r2: Optional[str] = None):
 
     fq: Fastq class
     """
-    fq = Fastq(r1, r2)
+    # Accepted reads are written straight from the input buffer
+    fq = Fastq(r1, r2, engine=engine, passthrough=True, workers=THREADS, readstats=True)
     r1_gz = os.path.join(QC_dir, os.path.basename(r1))
     if r2 is None:
         logger.info("Processing FASTQ as Single-End")
-        run_as_se(fq, r1_gz)
+        run_as_se(fq, r1_gz, compression)
         return r1_gz, fq
     else:
         logger.info("Processing FASTQ as Pair-End")
         r2_gz = os.path.join(QC_dir, os.path.basename(r2))
-        run_as_pe(fq, r1_gz, r2_gz)
+        run_as_pe(fq, r1_gz, r2_gz, compression)
         return r1_gz, r2_gz, fq
 
 
-def run_as_se(fq: Fastq, R1_out: str) -> None:
+def check_and_trim_fastq(r1: str, QC_dir: str, SRR: str, r2: Optional[str] = None, engine: str = "vector",
+                         THREADS: int = 1, compression: Optional[OutputCompression] = None):
+    """Check the reads quality and trim them with atropos in the same pass
+
+    The accepted reads are streamed to atropos instead of being written to
+    QC_dir, only the trimmed fastq files are written. A sample of the
+    accepted reads is written to QC_dir/screen for fastq_screen. A pair-end
+    sample that keeps a single mate can not be streamed as pairs, it is
+    stopped as soon as this is known.
+
+    **parameter**
+
+    r1: str
+        The first fastq file
+
+    QC_dir: str
+        The directory of the trimmed fastq files.
+
+    SRR: str
+        SRR ID.
+
+    r2: str or None
+        The second fastq file
+
+    engine: str
+        The validation engine of Fastq, "vector" or "python".
+
+    THREADS: int
+        Number of processes that check chunks of reads, and of atropos threads.
+
+    compression: OutputCompression or None
+        How the trimmed and sampled fastq files are compressed.
+
+    **return**
+
+    fq: Fastq class or None
+        None if a mate is kept as single-end, the sample must be checked again.
+
+    log: str or None
+        The atropos log.
+    """
+    fq = Fastq(r1, r2, engine=engine, passthrough=True, workers=THREADS, readstats=True)
+    subset = ReadSubset()
+    reads = fq.process()
+    try:
+        with AtroposStream(SRR, QC_dir, THREADS, r2 is not None, compression) as stream:
+            if r2 is None:
+                logger.info("Processing and trimming FASTQ as Single-End")
+                for read in reads:
+                    stream.inputs[0].write(read)
+                    subset.add(read)
+            else:
+                logger.info("Processing and trimming FASTQ as Pair-End")
+                for read1, read2 in reads:
+                    if "PE" not in fq.flags:
+                        raise _KeptMateException
+                    if read1 is None or read2 is None:
+                        continue
+                    stream.inputs[0].write(read1)
+                    stream.inputs[1].write(read2)
+                    subset.add(read1)
+    except _KeptMateException:
+        return None, None
+    finally:
+        reads.close()
+    if r2 is not None and fq.flags.intersection({"keep_R1", "keep_R2"}):
+        # The fall back happened on the last reads, no pair came after it
+        for trimmed in stream.trimmed:
+            remove_file(trimmed)
+        return None, None
+    if "abi_solid" in fq.flags or "download_bad" in fq.flags or fq.libsize < 100_000:
+        for trimmed in stream.trimmed:
+            remove_file(trimmed)
+        if "abi_solid" in fq.flags:
+            raise AbiException
+        if "download_bad" in fq.flags:
+            raise DownloadException("Empty FASTQ")
+        raise DownloadException("<100,000 reads")
+    write_subset(subset, r1, QC_dir, compression)
+    return fq, stream.log
+
+
+def write_subset(subset: ReadSubset, fastq: str, QC_dir: str, compression: Optional[OutputCompression] = None):
+    """Write the sample of the reads of `fastq` that fastq_screen maps instead of the whole file"""
+    screen_dir = Path(QC_dir) / "screen"
+    screen_dir.mkdir(exist_ok=True)
+    subset.write((screen_dir / os.path.basename(fastq)).as_posix(), compression)
+
+
+def run_as_se(fq: Fastq, R1_out: str, compression: Optional[OutputCompression] = None) -> None:
     """Check the reads quality and compress for single-end RNA-seq
 
+    A sample of the written reads is kept for fastq_screen in the screen
+    directory next to `R1_out`.
+
     **parameter**
 
     fq: Fastq
@@ -64,14 +182,20 @@ def run_as_se(fq: Fastq, R1_out: str) -> None:
     R1_out: Path
         The result R1 fastq path
 
+    compression: OutputCompression or None
+        How the result fastq file is compressed
+
     **return**
 
     None
 
     """
-    with xopen(R1_out, "wb") as file_out1:
+    compression = compression or OutputCompression()
+    subset = ReadSubset()
+    with compression.open(R1_out) as file_out1:
         for read in fq.process():
             file_out1.write(read)
+            subset.add(read)
     if "abi_solid" in fq.flags:
         remove_file(R1_out)
         raise AbiException
@@ -81,11 +205,19 @@ def run_as_se(fq: Fastq, R1_out: str) -> None:
     if fq.libsize < 100_000:
         remove_file(R1_out)
         raise DownloadException("<100,000 reads")
+    write_subset(subset, R1_out, os.path.dirname(R1_out), compression)
 
 
+def run_as_pe(fq: Fastq, R1_out: str, R2_out: str, compression: Optional[OutputCompression] = None) -> None:
+    """Check the reads quality and compress for pair-end RNA-seq
+
+    Valid reads whose mate was rejected are written to a side file of each
+    mate. If the files turn out to have an unequal number of reads or mixed
+    up pairs, the kept mate continues as single-end in the same pass and its
+    side file is appended to its output, so the input is read only once.
+    A sample of the first mates, or of the kept mate, is written for
+    fastq_screen in the screen directory next to the outputs.
 
-def run_as_pe(fq: Fastq, R1_out: str, R2_out: str) -> None:
-    """Check the reads quality and compress for single-end RNA-seq
     **parameter**
 
     fq: Fastq
@@ -97,28 +229,59 @@ def run_as_pe(fq: Fastq, R1_out: str, R2_out: str) -> None:
     R2_out: Path
         The result R2 fastq path
 
+    compression: OutputCompression or None
+        How the result fastq files are compressed
+
     **return**
 
     None
     """
-    try:
-        with xopen(R1_out, "wb") as file_out1, xopen(R2_out, "wb") as file_out2:
-            for read1, read2 in fq.process():
+    compression = compression or OutputCompression()
+    outputs = [R1_out, R2_out]
+    solos = [os.path.join(os.path.dirname(out), f"solo.{os.path.basename(out)}") for out in outputs]
+    # Samples of the mates of the pairs and of the side files
+    subsets = [ReadSubset(), ReadSubset()]
+    solo_subsets = [ReadSubset(), ReadSubset()]
+    with compression.open(R1_out) as file_out1, compression.open(R2_out) as file_out2, \
+            compression.open(solos[0]) as solo_out1, compression.open(solos[1]) as solo_out2:
+        for read1, read2 in fq.process():
+            if read2 is None:
+                solo_out1.write(read1)
+                solo_subsets[0].add(read1)
+            elif read1 is None:
+                solo_out2.write(read2)
+                solo_subsets[1].add(read2)
+            else:
                 file_out1.write(read1)
                 file_out2.write(read2)
-        if "abi_solid" in fq.flags:
-            raise AbiException
-        if "download_bad" in fq.flags:
-            raise DownloadException("Empty FASTQ")
-        if fq.libsize < 100_000:
-            raise DownloadException("<100,000 reads")
-    except (UnequalNumberReadsException, MixedUpReadsException):
-        remove_file(R1_out)
-        remove_file(R2_out)
-        if "keep_R1" in fq.flags:
-            run_as_se(fq, R1_out)
-        elif "keep_R2" in fq.flags:
-            run_as_se(fq, R2_out)
+                subsets[0].add(read1)
+                subsets[1].add(read2)
+    if "keep_R1" in fq.flags or "keep_R2" in fq.flags:
+        keep = 0 if "keep_R1" in fq.flags else 1
+        logger.info(f"Keeping R{keep + 1} as Single-End")
+        # gzip and BGZF files can be concatenated
+        with open(solos[keep], "rb") as solo, open(outputs[keep], "ab") as output:
+            shutil.copyfileobj(solo, output)
+        remove_file(outputs[1 - keep])
+        outputs = [outputs[keep]]
+        subset = ReadSubset.merge(subsets[keep], solo_subsets[keep])
+    else:
+        subset = subsets[0]
+    for solo in solos:
+        remove_file(solo)
+    if "abi_solid" in fq.flags:
+        for output in outputs:
+            remove_file(output)
+        raise AbiException
+    if "download_bad" in fq.flags:
+        for output in outputs:
+            remove_file(output)
+        raise DownloadException("Empty FASTQ")
+    if fq.libsize < 100_000:
+        for output in outputs:
+            remove_file(output)
+        raise DownloadException("<100,000 reads")
+    write_subset(subset, outputs[0], os.path.dirname(outputs[0]), compression)
 
 
 def save_output(feature_path, fq, SRR):
@@ -150,7 +313,75 @@ def save_output(feature_path, fq, SRR):
     df.to_parquet(summary_file)
 
 
-def run_check_fq(SRR, SRA_path, QC_dir, feature_path):
+def save_readstats(feature_path, fq, SRR):
+    """Save the read-level statistics collected while checking the reads
+    **parameter**
+
+    feature_path: str
+        The Feature dir path.
+
+    fq: Fastq
+        Fastq class.
+
+    SRR: str
+        SRR ID.
+
+    **return**
+
+    None
+    """
+    readstats_file = os.path.join(feature_path, "readstats", f"{SRR}.parquet")
+    fq.readstats.to_frame(SRR).to_parquet(readstats_file)
+
+
+def save_reject(feature_path, SRR, reason):
+    """Save the layout of a sample rejected by the pre-screen and raise its exception
+    **parameter**
+
+    feature_path: str
+        The Feature dir path.
+
+    SRR: str
+        SRR ID.
+
+    reason: str
+        Why the pre-screen rejected the sample.
+    """
+    summary_file = os.path.join(feature_path, "layout", f"{SRR}.parquet")
+    idx = pd.Index([SRR], name="srr")
+    df = pd.DataFrame([["rejected", None, None, None, reason]], index=[idx],
+                      columns=["layout", "libsize", "avgLen_R1", "avgLen_R2", "reject"])
+    df.to_parquet(summary_file)
+    raise_if_rejected(summary_file)
+
+
+def raise_if_rejected(summary_file):
+    """Raise the exception of a sample the pre-screen rejected, also in a later run"""
+    df = pd.read_parquet(summary_file)
+    if df.layout.iloc[0] != "rejected":
+        return
+    exception, message = REJECTS[df.reject.iloc[0]]
+    raise exception(message)
+
+
+def check_reads(SRR, r1, QC_dir, r2=None, engine="vector", THREADS=1, compression=None, fuse_atropos=False):
+    """Check the reads, and trim them in the same pass if `fuse_atropos`
+
+    Returns the Fastq class and the atropos log, None if they were not trimmed.
+    """
+    if fuse_atropos:
+        fq, log = check_and_trim_fastq(r1=r1, QC_dir=QC_dir, SRR=SRR, r2=r2, engine=engine, THREADS=THREADS,
+                                       compression=compression)
+        if fq is not None:
+            return fq, log
+        logger.info(f"{SRR} keeps a single mate, checking it again before atropos")
+    result = check_and_compress_fastq(r1=r1, QC_dir=QC_dir, r2=r2, engine=engine, THREADS=THREADS,
+                                      compression=compression)
+    return result[-1], None
+
+
+def run_check_fq(SRR, SRA_path, QC_dir, feature_path, engine="vector", THREADS=1, compression=None,
+                 prescreen=True, fuse_atropos=False):
     """Determine the layout of RNA-seq and Run check_and_compress_fastq
     **parameter**
     SRR: str
@@ -161,6 +392,20 @@ def run_check_fq(SRR, SRA_path, QC_dir, feature_path):
        The directory of result fastq file after check_fq.
     feature_path: str
         The directory of Feartures
+    engine: str
+        The validation engine of Fastq, "vector" or "python".
+
+    THREADS: int
+        Number of processes that check chunks of reads with the vector engine.
+
+    compression: OutputCompression or None
+        How the result fastq files are compressed.
+
+    prescreen: bool
+        Reject hopeless samples from a quick look at their files before the full check.
+
+    fuse_atropos: bool
+        Stream the accepted reads to atropos instead of writing them to QC_dir.
 
     **return**
     None
@@ -173,24 +418,50 @@ def run_check_fq(SRR, SRA_path, QC_dir, feature_path):
         r1 = Path(SRA_path, f"{SRR}_1.fastq.gz")
         r2 = Path(SRA_path, f"{SRR}_2.fastq.gz")
         if os.path.exists(summary_file):
+            raise_if_rejected(summary_file)
             return [r1.as_posix(), r2.as_posix()]
-        r1_gz, r2_gz, fq = check_and_compress_fastq(r1=r1.as_posix(), QC_dir=QC_dir, r2=r2.as_posix())
+        if prescreen:
+            reason = prescreen_fastq(r1.as_posix(), r2.as_posix())
+            if reason:
+                save_reject(feature_path, SRR, reason)
+        fq, atropos_log = check_reads(SRR, r1.as_posix(), QC_dir, r2.as_posix(), engine, THREADS, compression,
+                                      fuse_atropos)
         raw_fqs.append(r1)
         raw_fqs.append(r2)
     elif len(file_list) == 1:
         logger.info("Single-End QC")
         r1 = Path(SRA_path, f"{SRR}.fastq.gz")
         if os.path.exists(summary_file):
+            raise_if_rejected(summary_file)
             return [r1]
-        r1_gz, fq = check_and_compress_fastq(r1=r1.as_posix(), QC_dir=QC_dir)
+        if prescreen:
+            reason = prescreen_fastq(r1.as_posix())
+            if reason:
+                save_reject(feature_path, SRR, reason)
+        fq, atropos_log = check_reads(SRR, r1.as_posix(), QC_dir, None, engine, THREADS, compression,
+                                      fuse_atropos)
         raw_fqs.append(r1)
     elif len(file_list) == 0:
         raise DownloadException
+    if atropos_log is not None:
+        try:
+            summarize_atropos(atropos_log, Path(feature_path, "atropos", f"{SRR}.parquet"), SRR)
+        except Exception as error:
+            if not (isinstance(error, AtroposException) and "<1,000 reads" in str(error)):
+                # Without a layout the next attempt checks and trims the reads again
+                for mate in ("", "_1", "_2"):
+                    remove_file(os.path.join(QC_dir, f"{SRR}{mate}.trim.fastq.gz"))
+                raise
+            save_output(feature_path, fq, SRR)
+            save_readstats(feature_path, fq, SRR)
+            raise
     save_output(feature_path, fq, SRR)
+    save_readstats(feature_path, fq, SRR)
     return raw_fqs
 
 
-def check_fq(SRR, SRA_path, QC_dir, feature_path):
+def check_fq(SRR, SRA_path, QC_dir, feature_path, engine="vector", THREADS=1, compression=None,
+             prescreen=True, fuse_atropos=False):
     """This is the main function for checking the reads quality
 
     **parameter**
@@ -206,9 +477,25 @@ def check_fq(SRR, SRA_path, QC_dir, feature_path):
 
     feature_path: str
         The directory of Features.
+
+    engine: str
+        The validation engine of Fastq, "vector" or "python".
+
+    THREADS: int
+        Number of processes that check the reads.
+
+    compression: OutputCompression or None
+        How the result fastq files are compressed.
+
+    prescreen: bool
+        Reject hopeless samples from a quick look at their files before the full check.
+
+    fuse_atropos: bool
+        Trim the reads with atropos while they are checked.
     """
     try:
-        raw_fqs = run_check_fq(SRR, SRA_path, QC_dir, feature_path)
+        raw_fqs = run_check_fq(SRR, SRA_path, QC_dir, feature_path, engine, THREADS, compression, prescreen,
+                               fuse_atropos)
         logger.info(f"Complete check {SRR} fastq file")
         return raw_fqs
     except AbiException:
@@ -216,4 +503,7 @@ def check_fq(SRR, SRA_path, QC_dir, feature_path):
         raise AbiException
     except DownloadException as error:
         logger.warning(f"Flagging {SRR} as Download Bad: {error}")
-        raise DownloadException
+        raise DownloadException(str(error))
+    except AtroposException as error:
+        logger.warning(f"Flagging {SRR} as Atropos Bad")
+        raise AtroposException(f"Atropos Bad: {error}")
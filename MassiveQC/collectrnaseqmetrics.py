@@ -2,15 +2,28 @@ import logging
 import os.path
 from pathlib import Path
 import pandas as pd
-from .command import run_command
 from typing import Optional, Tuple
 from .parser import parse_picardCollect_summary, parse_picardCollect_hist, remove_file
+from .picard_worker import run_picard
+from .strand import infer_strand
 
 logger = logging.getLogger("MassiveQC")
 
+# Picard STRAND of each inferred strandness
+PICARD_STRAND = {
+    "same_strand": "FIRST_READ_TRANSCRIPTION_STRAND",
+    "opposite_strand": "SECOND_READ_TRANSCRIPTION_STRAND",
+    "unstranded": "NONE",
+}
+
 
 class CollectRnaseqMetrics(object):
-    """This class uses picard to extract RnaSeqMetrics information"""
+    """This class uses picard to extract RnaSeqMetrics information
+
+    The strandness is inferred from a sample of the reads first, so Picard
+    runs once with the matching STRAND. It is saved in strand/{SRR}.parquet
+    before Picard runs, as featureCounts needs it too.
+    """
     def __init__(self, feature_path: str, SRR: str, Bam_dir: str,
                  THREADS: int, ref_flat: str, picard: str, MEM: Optional[int] = 3):
         self.feature_path = Path(feature_path)
@@ -24,69 +37,50 @@ class CollectRnaseqMetrics(object):
 
     def collectrnaseqmetrics(self):
         bam = self.Bam_dir / f"{self.SRR}.sorted.bam"
-        unstranded, first, second = self.run_picard(bam)
-        self.summarize(unstranded, first, second)
-        remove_file(unstranded.as_posix())
-        remove_file(first.as_posix())
-        remove_file(second.as_posix())
+        strand_ = self.infer_strand()
+        metrics = self.run_picard(bam, strand_)
+        self.summarize(metrics)
+        remove_file(metrics.as_posix())
         logger.info(f"{self.SRR} Complete metrics")
 
-    def run_picard(self, bam: Path):
-        cmd = (
-            f"java -Xmx{self.MEM}g "
-            f"-jar {self.picard} CollectRnaSeqMetrics "
-            f"REF_FLAT={self.ref_flat} "
-            f"INPUT={bam} OUTPUT={{out_file}} "
-            f"STRAND={{strand}}"
-        )
-        logger.info(f"{self.SRR} Start CollectRnaSeqMetrics")
-        # Unstranded
-        un_out = self.feature_path / f"{self.SRR}.unstranded.txt"
-        result_un = run_command(cmd.format(out_file=un_out, strand="NONE"))
-        self._check_log(result_un, self.SRR)
-
-        # First stranded
-        first_out = self.feature_path / f"{self.SRR}.first_stranded.txt"
-        result_first = run_command(cmd.format(out_file=first_out, strand="FIRST_READ_TRANSCRIPTION_STRAND"))
-        self._check_log(result_first, self.SRR)
-
-        # Second stranded
-        second_out = self.feature_path / f"{self.SRR}.second_stranded.txt"
-        result_second = run_command(cmd.format(out_file=second_out, strand="SECOND_READ_TRANSCRIPTION_STRAND"))
-        self._check_log(result_second, self.SRR)
-        return un_out, first_out, second_out
-
-    def summarize(self, unstranded: Path, first: Path, second: Path):
-        # Parse the flags
-        if self._parse_stranded(first):
-            strand_ = "same_strand"
-        elif self._parse_stranded(second):
-            strand_ = "opposite_strand"
-        else:
-            strand_ = "unstranded"
-
-        idx = pd.Index([self.SRR], name="srr")
-        # Write strand flag
+    def infer_strand(self) -> str:
+        """Infer and save the strandness, unless it was saved before"""
         strand = self.feature_path / "strand" / f"{self.SRR}.parquet"
-        strand_df = pd.DataFrame([[strand_]], index=idx, columns=["strand"])
+        if strand.exists():
+            return pd.read_parquet(strand).strand.iloc[0]
+        bam = self.Bam_dir / f"{self.SRR}.sorted.bam"
+        logger.info(f"{self.SRR} Start strand inference")
+        strand_, _ = infer_strand(bam, self.ref_flat, self.THREADS)
+        strand_df = pd.DataFrame([[strand_]], index=pd.Index([self.SRR], name="srr"), columns=["strand"])
         strand_df.to_parquet(strand)
+        return strand_
+
+    def run_picard(self, bam: Path, strand_: str) -> Path:
+        out_file = self.feature_path / f"{self.SRR}.rnaseqmetrics.txt"
+        args = [
+            f"REF_FLAT={self.ref_flat}",
+            f"INPUT={bam}", f"OUTPUT={out_file}",
+            f"STRAND={PICARD_STRAND[strand_]}",
+        ]
+        logger.info(f"{self.SRR} Start CollectRnaSeqMetrics")
+        result = run_picard(self.picard, "CollectRnaSeqMetrics", args, self.MEM)
+        self._check_log(result, self.SRR)
+        return out_file
 
+    def summarize(self, metrics: Path):
+        idx = pd.Index([self.SRR], name="srr")
         # Parse main table
         table = self.feature_path / "rnaseqmetrics" / f"{self.SRR}.parquet"
-        table_df = self._parse_table(unstranded)
+        table_df = self._parse_table(metrics)
         table_df.index = idx
         table_df.to_parquet(table)
 
         # Parse genome coverage histogram
         coverage = self.feature_path / "genebody_coverage" / f"{self.SRR}.parquet"
-        coverage_df = parse_picardCollect_hist(unstranded)
+        coverage_df = parse_picardCollect_hist(metrics)
         coverage_df.index = idx
         coverage_df.to_parquet(coverage)
 
-    @staticmethod
-    def _parse_stranded(file_name: Path) -> bool:
-        return (parse_picardCollect_summary(file_name).PCT_CORRECT_STRAND_READS >= 0.75)[0]
-
     @staticmethod
     def _parse_table(file_name: Path) -> pd.DataFrame:
         df = parse_picardCollect_summary(file_name)[
@@ -0,0 +1,126 @@
+"""Compression settings for the intermediate FASTQ files of QC_dir"""
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from xopen import xopen
+
+logger = logging.getLogger("MassiveQC")
+
+METHODS = ("gzip", "bgzf")
+COPY_SIZE = 1024 * 1024
+
+
+class OutputCompression:
+    """How the FASTQ files written to QC_dir are compressed
+
+    Both gzip and BGZF files are plain gzip to every downstream tool. Level 0
+    stores the reads without compressing them, which suits files that are
+    deleted by the next step anyway.
+
+    **parameter**
+
+    method: str
+        "gzip" or "bgzf" (needs bgzip in $PATH).
+
+    level: int or None
+        Compression level from 0 to 9, None keeps the default of the compressor.
+
+    THREADS: int
+        Number of compression threads.
+    """
+    def __init__(self, method: str = "gzip", level: Optional[int] = None, THREADS: int = 1):
+        if method not in METHODS:
+            raise CompressionException(f"Unknown compression method {method}")
+        if level is not None and not 0 <= level <= 9:
+            raise CompressionException(f"Compression level {level} is not between 0 and 9")
+        if method == "bgzf" and shutil.which("bgzip") is None:
+            raise CompressionException("bgzip is required for BGZF compression")
+        self.method = method
+        self.level = level
+        self.THREADS = THREADS
+
+    @property
+    def is_default(self) -> bool:
+        """Whether the settings match what the tools do on their own"""
+        return self.method == "gzip" and self.level is None
+
+    def open(self, path: str):
+        """Open `path` for writing binary data compressed with these settings"""
+        if self.method == "bgzf":
+            command = ["bgzip", "-c", "-@", str(self.THREADS)]
+            if self.level is not None:
+                command += ["-l", str(self.level)]
+            return _PipedWriter(command, path)
+        return xopen(path, "wb", compresslevel=self.level, threads=self.THREADS)
+
+    @contextmanager
+    def fifo(self, path: Path) -> Iterator[Path]:
+        """Named pipe for a tool that writes plain FASTQ, compressed into `path`
+
+        The pipe keeps the ".fastq" extension so tools can still tell the
+        format from the file name. It is removed on exit.
+        """
+        path = Path(path)
+        pipe = path.with_name(path.name.replace(".fastq.gz", ".fifo.fastq"))
+        if pipe.exists():
+            pipe.unlink()
+        os.mkfifo(pipe)
+        errors = []
+
+        def drain():
+            try:
+                with open(pipe, "rb") as reader, self.open(path.as_posix()) as writer:
+                    shutil.copyfileobj(reader, writer, COPY_SIZE)
+            except Exception as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=drain, daemon=True)
+        thread.start()
+        try:
+            yield pipe
+        finally:
+            # If the tool never opened the pipe, the reader is still waiting
+            # for a writer. Open and close the pipe once to let it finish.
+            while thread.is_alive():
+                try:
+                    os.close(os.open(pipe, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                thread.join(0.1)
+            pipe.unlink()
+        if errors:
+            raise CompressionException(f"Unable to compress {path}: {errors[0]}")
+
+
+class _PipedWriter:
+    """Write binary data to a compressor process that writes to `path`"""
+    def __init__(self, command, path: str):
+        self.command = command
+        self._output = open(path, "wb")
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self._output)
+
+    def write(self, data) -> int:
+        return self.process.stdin.write(data)
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        rc = self.process.wait()
+        self._output.close()
+        if rc != 0:
+            raise CompressionException(f"{self.command[0]} exited with status {rc}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CompressionException(Exception):
+    """Basic exception for problems compressing the QC_dir files"""
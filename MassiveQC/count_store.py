@@ -0,0 +1,242 @@
+"""Gene by sample count matrix kept as sparse parquet chunks
+
+The counts of each sample are appended once featureCounts finishes, as a
+part file holding the non-zero counts. At the end of a run the parts are
+merged into chunks of many samples, sorted by gene, so a subset of samples
+or genes is read without loading the whole matrix.
+
+Layout of the store directory::
+
+    genes.parquet                 gene ids, the row number is the gene index
+    genes/parts/{SRR}.parquet     non-zero gene counts of one sample
+    genes/chunk-{n}.parquet       merged parts
+    genes/index.parquet           chunk of each merged sample
+    junctions/...                 the same for the junction counts
+"""
+import logging
+import threading
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .parser import remove_file
+
+logger = logging.getLogger("MassiveQC")
+
+KINDS = ("genes", "junctions")
+CHUNK_SAMPLES = 500
+JUNCTION_COLUMNS = [
+    "PrimaryGene",
+    "SecondaryGenes",
+    "Site1_chr",
+    "Site1_location",
+    "Site1_strand",
+    "Site2_chr",
+    "Site2_location",
+    "Site2_strand",
+]
+
+_lock = threading.Lock()
+
+
+class CountStore(object):
+    """Sparse gene and junction count matrices of the samples
+
+    **parameter**
+
+    path: str
+        Directory of the store, created when missing.
+    """
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._genes = None
+
+    def append(self, SRR: str, counts: Path, jcounts: Path) -> None:
+        """Add the featureCounts output of a sample"""
+        col_name = pd.read_table(counts, comment="#", nrows=1).columns[-1]
+        df = pd.read_table(counts, comment="#", usecols=["Geneid", col_name], dtype={col_name: np.int64})
+        self._check_genes(df.Geneid)
+        nonzero = df[col_name].to_numpy() > 0
+        part = pd.DataFrame({
+            "gene": np.flatnonzero(nonzero).astype(np.int32),
+            "count": df[col_name].to_numpy()[nonzero],
+        })
+        self._write_part("genes", SRR, part)
+
+        junctions = pd.read_table(jcounts, dtype=str, keep_default_na=False)
+        junctions.columns = JUNCTION_COLUMNS + ["count"]
+        junctions = junctions.astype({"Site1_location": np.int64, "Site2_location": np.int64, "count": np.int64})
+        self._write_part("junctions", SRR, junctions)
+
+    def _check_genes(self, gene_ids: pd.Series) -> None:
+        genes_file = self.path / "genes.parquet"
+        with _lock:
+            if not genes_file.exists():
+                self.path.mkdir(parents=True, exist_ok=True)
+                pd.DataFrame({"gene_id": gene_ids.to_numpy()}).to_parquet(genes_file)
+        genes = self.genes()
+        if len(genes) != len(gene_ids) or not (genes.to_numpy() == gene_ids.to_numpy()).all():
+            raise CountStoreException(f"The genes of {self.path} come from another annotation")
+
+    def _write_part(self, kind: str, SRR: str, part: pd.DataFrame) -> None:
+        parts = self.path / kind / "parts"
+        parts.mkdir(parents=True, exist_ok=True)
+        tmp = parts / f"{SRR}.parquet.tmp"
+        part.to_parquet(tmp, index=False)
+        tmp.replace(parts / f"{SRR}.parquet")
+
+    def genes(self) -> pd.Series:
+        """Gene ids in the order of the gene index"""
+        if self._genes is None:
+            self._genes = pd.read_parquet(self.path / "genes.parquet").gene_id
+        return self._genes
+
+    def samples(self, kind: str = "genes") -> List[str]:
+        """Samples in the store, merged ones first"""
+        return list(dict.fromkeys(list(self._index(kind).srr) + sorted(self._parts(kind))))
+
+    def _index(self, kind: str) -> pd.DataFrame:
+        index_file = self.path / kind / "index.parquet"
+        if index_file.exists():
+            return pd.read_parquet(index_file)
+        return pd.DataFrame({"srr": pd.Series([], dtype=str), "chunk": pd.Series([], dtype=str)})
+
+    def _parts(self, kind: str) -> List[str]:
+        parts = self.path / kind / "parts"
+        if not parts.exists():
+            return []
+        return [part.stem for part in parts.glob("*.parquet")]
+
+    def compact(self, samples_per_chunk: int = CHUNK_SAMPLES) -> None:
+        """Merge the part files into chunks, the parts are removed afterwards
+
+        A sample counted again after it was merged moves to the new chunk,
+        the rows of the old chunk are no longer indexed.
+        """
+        for kind in KINDS:
+            new_samples = sorted(self._parts(kind))
+            if not new_samples:
+                continue
+            index = self._index(kind)
+            index = index[~index.srr.isin(new_samples)]
+            n_chunks = len(list((self.path / kind).glob("chunk-*.parquet")))
+            chunks = []
+            for start in range(0, len(new_samples), samples_per_chunk):
+                samples = new_samples[start:start + samples_per_chunk]
+                name = f"chunk-{n_chunks + len(chunks):05d}.parquet"
+                df = pd.concat(
+                    [self._read_part(kind, SRR) for SRR in samples], ignore_index=True, sort=False
+                )
+                sort_by = ["gene", "srr"] if kind == "genes" else ["Site1_chr", "Site1_location", "srr"]
+                df = df.sort_values(sort_by, kind="stable").reset_index(drop=True)
+                df.to_parquet(self.path / kind / name, index=False)
+                chunks.append(pd.DataFrame({"srr": samples, "chunk": name}))
+            index = pd.concat([index] + chunks, ignore_index=True)
+            index.to_parquet(self.path / kind / "index.parquet", index=False)
+            for SRR in new_samples:
+                remove_file((self.path / kind / "parts" / f"{SRR}.parquet").as_posix())
+            logger.info(f"Merged {len(new_samples):,} samples into {len(chunks)} {kind} chunks")
+
+    def _read_part(self, kind: str, SRR: str) -> pd.DataFrame:
+        df = pd.read_parquet(self.path / kind / "parts" / f"{SRR}.parquet")
+        df.insert(0, "srr", SRR)
+        return df
+
+    def read_long(self, kind: str = "genes", samples: Optional[Iterable[str]] = None,
+                  genes: Optional[Iterable[str]] = None) -> pd.DataFrame:
+        """Non-zero counts of the selected samples and genes, one row per count
+
+        Only the chunks holding the samples are read, and the selection is
+        passed to the parquet reader as filters. Part files of samples not
+        merged yet are read as they are.
+        """
+        index = self._index(kind)
+        parts = set(self._parts(kind))
+        samples = self.samples(kind) if samples is None else list(dict.fromkeys(samples))
+        genes = None if genes is None else list(genes)
+        missing = set(samples) - set(index.srr) - parts
+        if missing:
+            raise CountStoreException(f"Samples not in {self.path}: {', '.join(sorted(missing))}")
+
+        gene_filters = []
+        gene_idx = None
+        if genes is not None and kind == "genes":
+            gene_idx = self._gene_index(genes)
+            gene_filters.append(("gene", "in", gene_idx.tolist()))
+        elif genes is not None:
+            gene_filters.append(("PrimaryGene", "in", list(genes)))
+
+        frames = []
+        merged = index[index.srr.isin(samples) & ~index.srr.isin(parts)]
+        for chunk, rows in merged.groupby("chunk"):
+            chunk_samples = list(rows.srr)
+            df = pd.read_parquet(self.path / kind / chunk, filters=[("srr", "in", chunk_samples)] + gene_filters)
+            frames.append(df[df.srr.isin(chunk_samples)])
+        for SRR in samples:
+            if SRR in parts:
+                frames.append(self._read_part(kind, SRR))
+        if not frames:
+            return pd.DataFrame(columns=["srr"])
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        if gene_idx is not None:
+            df = df[df.gene.isin(gene_idx)]
+        elif genes is not None:
+            df = df[df.PrimaryGene.isin(list(genes))]
+        return df.reset_index(drop=True)
+
+    def _gene_index(self, genes: Iterable[str]) -> np.ndarray:
+        all_genes = self.genes()
+        selected = all_genes.isin(list(genes)).to_numpy()
+        return np.flatnonzero(selected).astype(np.int32)
+
+    def read(self, samples: Optional[Iterable[str]] = None, genes: Optional[Iterable[str]] = None,
+             sparse: bool = False) -> pd.DataFrame:
+        """Gene by sample count matrix of the selected samples and genes
+
+        **parameter**
+
+        samples: list or None
+            Samples to read, all when None.
+
+        genes: list or None
+            Gene ids to read, all when None.
+
+        sparse: bool
+            Return sparse columns instead of dense ones.
+
+        **return**
+
+        counts: DataFrame
+            Counts indexed by gene id in the order of the store, one column
+            per sample.
+        """
+        samples = self.samples() if samples is None else list(dict.fromkeys(samples))
+        genes = None if genes is None else list(genes)
+        long = self.read_long("genes", samples, genes)
+        all_genes = self.genes()
+        gene_idx = np.arange(len(all_genes), dtype=np.int32) if genes is None else self._gene_index(genes)
+        # Row of each gene index in the returned matrix
+        rows = np.full(len(all_genes), -1, dtype=np.int64)
+        rows[gene_idx] = np.arange(len(gene_idx))
+        data = {}
+        for SRR in samples:
+            data[SRR] = np.zeros(len(gene_idx), dtype=np.int64)
+        if len(long):
+            for SRR, df in long.groupby("srr", sort=False):
+                data[SRR][rows[df.gene.to_numpy()]] = df["count"].to_numpy()
+        if sparse:
+            data = {SRR: pd.arrays.SparseArray(column, fill_value=0) for SRR, column in data.items()}
+        return pd.DataFrame(data, index=pd.Index(all_genes.to_numpy()[gene_idx], name="gene_id"))
+
+
+def count_store(outdir: str) -> None:
+    """Merge the count parts of a run, if it has a count store"""
+    store = Path(outdir) / "Count" / "matrix"
+    if store.exists():
+        CountStore(store.as_posix()).compact()
+
+
+class CountStoreException(Exception):
+    """Basic exception for problems with the count store"""
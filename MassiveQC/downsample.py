@@ -0,0 +1,159 @@
+"""Downsample the trimmed reads of deep samples before the alignment
+
+The alignment and every step after it cost time in proportion to the reads.
+With `max_reads`, a sample with more trimmed reads (or pairs) keeps each of
+them with the same probability, so that about `max_reads` are aligned. The
+fraction that is kept is saved in the layout file, the count features are
+extrapolated with it when the features are built.
+"""
+import logging
+import os
+import zlib
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from xopen import xopen
+
+from .compression import OutputCompression
+from .fastq_chunk import ChunkReader, RecordChunk
+from .parser import remove_file
+
+logger = logging.getLogger("MassiveQC")
+
+CHUNK_READS = 100_000
+
+
+def trimmed_fastqs(layout_: str, SRR: str, QC_dir: Path) -> List[Path]:
+    """The fastq files written by atropos, in the order of the mates"""
+    if layout_ == "PE":
+        return [QC_dir / f"{SRR}_1.trim.fastq.gz", QC_dir / f"{SRR}_2.trim.fastq.gz"]
+    elif layout_ == "keep_R1":
+        return [QC_dir / f"{SRR}_1.trim.fastq.gz"]
+    elif layout_ == "keep_R2":
+        return [QC_dir / f"{SRR}_2.trim.fastq.gz"]
+    return [QC_dir / f"{SRR}.trim.fastq.gz"]
+
+
+def sampled_fastq(fastq: Path) -> str:
+    """Path of the downsampled reads of `fastq`, with the extension that tells they are compressed"""
+    return fastq.with_name(fastq.name.replace(".fastq.gz", ".sampled.fastq.gz")).as_posix()
+
+
+def keep_records(chunk: RecordChunk, keep: np.ndarray) -> bytes:
+    """Raw bytes of the records of the chunk where `keep` is True"""
+    record_starts, record_ends = chunk.starts[0::4], chunk.ends[3::4] + 1
+    data = np.frombuffer(chunk.buf, dtype=np.uint8)[:record_ends[-1]]
+    return data[np.repeat(keep, record_ends - record_starts)].tobytes()
+
+
+def downsample_fastqs(fastqs: List[Path], fraction: float, seed: int,
+                      compression: Optional[OutputCompression] = None) -> tuple:
+    """Keep each read, or each pair of reads of the mates, with probability `fraction`
+
+    The reads are written next to the inputs, see `sampled_fastq`. The same
+    seed keeps the same reads.
+
+    **return**
+
+    n_read: int
+        Number of reads, or pairs, of the inputs.
+
+    n_kept: int
+        Number of reads, or pairs, written.
+    """
+    compression = compression or OutputCompression()
+    rng = np.random.default_rng(seed)
+    handles = [xopen(fastq.as_posix(), "rb") for fastq in fastqs]
+    outputs = [compression.open(sampled_fastq(fastq)) for fastq in fastqs]
+    n_read = n_kept = 0
+    try:
+        readers = [ChunkReader(handle) for handle in handles]
+        while True:
+            chunks = [reader.read(CHUNK_READS) for reader in readers]
+            if chunks[0] is None:
+                break
+            if any(chunk is None or chunk.n_records != chunks[0].n_records for chunk in chunks):
+                raise DownsampleException(f"The mates of {fastqs[0]} have an unequal number of reads")
+            keep = rng.random(chunks[0].n_records) < fraction
+            for chunk, output in zip(chunks, outputs):
+                output.write(keep_records(chunk, keep))
+            n_read += chunks[0].n_records
+            n_kept += int(keep.sum())
+        if any(reader.read(1) is not None for reader in readers[1:]):
+            raise DownsampleException(f"The mates of {fastqs[0]} have an unequal number of reads")
+    finally:
+        for handle in handles + outputs:
+            handle.close()
+    return n_read, n_kept
+
+
+def downsample(feature_path: str, SRR: str, QC_dir: str, max_reads: int,
+               compression: Optional[OutputCompression] = None) -> float:
+    """Downsample the trimmed reads of SRR to about `max_reads` reads, or pairs of reads
+
+    The fraction of reads that is kept is saved as sampling_fraction in
+    layout/{SRR}.parquet, 1.0 when the sample has no more than `max_reads`.
+    A sample whose fraction was saved is left as it is. The downsampled
+    mates are all written, and the fraction saved as sampling_pending,
+    before they replace the trimmed reads, so a run stopped while they are
+    replaced is finished by the next one.
+
+    **parameter**
+
+    feature_path: str
+        The Feature dir path.
+
+    SRR: str
+        SRR ID.
+
+    QC_dir: str
+        The directory of the trimmed fastq files.
+
+    max_reads: int
+        Number of reads, or pairs of reads, that are aligned.
+
+    compression: OutputCompression or None
+        How the downsampled fastq files are compressed.
+
+    **return**
+
+    fraction: float
+    """
+    layout_file = Path(feature_path) / "layout" / f"{SRR}.parquet"
+    layout = pd.read_parquet(layout_file)
+    if "sampling_fraction" in layout.columns:
+        return layout.sampling_fraction.iloc[0]
+    fastqs = trimmed_fastqs(layout.layout.iloc[0], SRR, Path(QC_dir))
+    if "sampling_pending" in layout.columns:
+        # Stopped while the mates were replaced, those left are replaced now
+        fraction = layout.sampling_pending.iloc[0]
+        logger.info(f"Finish replacing the downsampled reads of {SRR}")
+    else:
+        n_trimmed = pd.read_parquet(Path(feature_path) / "atropos" / f"{SRR}.parquet").total_written.iloc[0]
+        fraction = 1.0
+        if n_trimmed > max_reads:
+            logger.info(f"Downsample {SRR} from {n_trimmed:,} to about {max_reads:,} reads")
+            try:
+                n_read, n_kept = downsample_fastqs(fastqs, max_reads / n_trimmed, zlib.crc32(SRR.encode()),
+                                                   compression)
+            except Exception:
+                for fastq in fastqs:
+                    remove_file(sampled_fastq(fastq))
+                raise
+            fraction = n_kept / n_read
+            logger.info(f"{SRR} keeps {fraction:.2%} of the trimmed reads")
+            layout["sampling_pending"] = fraction
+            layout.to_parquet(layout_file)
+    for fastq in fastqs:
+        if os.path.exists(sampled_fastq(fastq)):
+            os.replace(sampled_fastq(fastq), fastq)
+    layout = layout.drop(columns="sampling_pending", errors="ignore")
+    layout["sampling_fraction"] = fraction
+    layout.to_parquet(layout_file)
+    return fraction
+
+
+class DownsampleException(Exception):
+    """Basic exception for problems downsampling the reads"""
@@ -0,0 +1,205 @@
+"""Duplicate metrics of a coordinate sorted BAM file, without writing a BAM
+
+Follows the duplicate definition of Picard MarkDuplicates. Reads are
+compared on their unclipped 5' position and strand, pairs on the positions
+and strands of both mates. Optical duplicates are not detected, the read
+names of SRA runs hold no flowcell location.
+"""
+import heapq
+import logging
+import re
+import subprocess
+from math import exp
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+logger = logging.getLogger("MassiveQC")
+
+# Unmapped, secondary and supplementary reads are not examined
+EXCLUDE_FLAGS = 0x4 | 0x100 | 0x800
+# Positions are closed once the reads are this far past them, a future read
+# can not be clipped by more than that.
+MARGIN = 1000
+SWEEP_READS = 100_000
+CIGAR_PATTERN = re.compile(rb"(\d+)([MIDNSHP=X])")
+COLUMNS = [
+    "UNPAIRED_READS_EXAMINED",
+    "READ_PAIRS_EXAMINED",
+    "UNPAIRED_READ_DUPLICATES",
+    "READ_PAIR_DUPLICATES",
+    "PERCENT_DUPLICATION",
+    "ESTIMATED_LIBRARY_SIZE",
+]
+
+
+class DuplicateCounter:
+    """Count duplicates of reads added in coordinate order
+
+    Single-end reads and reads whose mate is unmapped are fragments. A
+    fragment is a duplicate of another fragment with the same 5' end, or of
+    any paired read with that 5' end. A pair is a duplicate of another pair
+    with the same 5' ends. In each group one read or pair is not a duplicate.
+    """
+    def __init__(self, ref_names: list):
+        self.rank = {name: k for k, name in enumerate(ref_names)}
+        self.unpaired_examined = 0
+        self.paired_examined = 0
+        self.unpaired_duplicates = 0
+        self.pair_duplicates = 0
+        self._ref = None
+        self._pos = 0
+        # (coordinate, reverse) -> [number of fragments, seen as a paired read]
+        self._fragments = {}
+        # (rank 1, coordinate 1, rank 2, coordinate 2, orientation) -> [number, last coordinate]
+        self._pairs = {}
+        # read name -> rank, coordinate and strand of the first mate
+        self._mates = {}
+        self._expected = []
+        self._added = 0
+
+    def add(self, flag: int, ref: str, pos: int, cigar: bytes, qname: bytes,
+            mate_ref: str, mate_pos: int) -> None:
+        """Add a primary mapped read, `pos` is the 1-based leftmost position"""
+        if ref != self._ref:
+            self._close(None)
+            self._ref = ref
+        self._pos = pos
+        reverse = bool(flag & 0x10)
+        coordinate = _unclipped_five_prime(pos, cigar, reverse)
+        paired = bool(flag & 0x1) and not flag & 0x8
+
+        fragment = self._fragments.setdefault((coordinate, reverse), [0, False])
+        if paired:
+            self.paired_examined += 1
+            fragment[1] = True
+            self._add_mate(qname, coordinate, reverse, mate_ref, mate_pos)
+        else:
+            self.unpaired_examined += 1
+            fragment[0] += 1
+
+        self._added += 1
+        if self._added % SWEEP_READS == 0:
+            self._close(pos - MARGIN)
+
+    def _add_mate(self, qname: bytes, coordinate: int, reverse: bool, mate_ref: str, mate_pos: int) -> None:
+        rank = self.rank[self._ref]
+        mate = self._mates.pop(qname, None)
+        if mate is None:
+            self._mates[qname] = (rank, coordinate, reverse)
+            mate_rank = rank if mate_ref == "=" else self.rank.get(mate_ref, -1)
+            heapq.heappush(self._expected, (mate_rank, mate_pos, qname))
+            return
+        first = mate
+        second = (rank, coordinate, reverse)
+        if first[:2] > second[:2]:
+            first, second = second, first
+        key = (first[0], first[1], second[0], second[1], (first[2], second[2]))
+        pair = self._pairs.setdefault(key, [0, 0])
+        pair[0] += 1
+        # The mate seen last is on the current reference
+        pair[1] = max(coordinate, mate[1]) if mate[0] == rank else coordinate
+
+    def _close(self, before: Optional[int]) -> None:
+        """Count the groups before `before` on the current reference, all if None"""
+        for key in [key for key in self._fragments if before is None or key[0] < before]:
+            count, with_paired = self._fragments.pop(key)
+            self.unpaired_duplicates += count if with_paired else max(count - 1, 0)
+        for key in [key for key, pair in self._pairs.items() if before is None or pair[1] < before]:
+            count, _ = self._pairs.pop(key)
+            self.pair_duplicates += count - 1
+        # Mates whose position was passed were not kept in the BAM
+        if self._ref is not None:
+            current = (self.rank[self._ref], self._pos)
+            while self._expected and self._expected[0][:2] < current:
+                _, _, qname = heapq.heappop(self._expected)
+                self._mates.pop(qname, None)
+
+    def metrics(self) -> pd.DataFrame:
+        """Metrics in the columns of the Picard metrics file"""
+        self._close(None)
+        pairs = self.paired_examined // 2
+        examined = self.unpaired_examined + 2 * pairs
+        percent = (self.unpaired_duplicates + 2 * self.pair_duplicates) / examined if examined else None
+        library_size = estimate_library_size(pairs, pairs - self.pair_duplicates)
+        return pd.DataFrame(
+            [[self.unpaired_examined, pairs, self.unpaired_duplicates, self.pair_duplicates,
+              None if percent is None else round(percent, 6), library_size]],
+            columns=COLUMNS,
+        )
+
+
+def _unclipped_five_prime(pos: int, cigar: bytes, reverse: bool) -> int:
+    """5' position of a read including its clipped bases"""
+    ops = CIGAR_PATTERN.findall(cigar)
+    if not reverse:
+        clipped = 0
+        for length, op in ops:
+            if op not in b"SH":
+                break
+            clipped += int(length)
+        return pos - clipped
+    end = pos - 1
+    for length, op in ops:
+        if op in b"MDN=XSH":
+            end += int(length)
+    return end
+
+
+def estimate_library_size(read_pairs: int, unique_pairs: int) -> Optional[int]:
+    """Library size from the Lander-Waterman equation, as Picard estimates it"""
+    if read_pairs <= 0 or read_pairs - unique_pairs <= 0:
+        return None
+
+    def f(x):
+        return unique_pairs / x - 1 + exp(-read_pairs / x)
+
+    m, M = 1.0, 100.0
+    if unique_pairs >= read_pairs or f(m * unique_pairs) < 0:
+        return None
+    while f(M * unique_pairs) > 0:
+        M *= 10.0
+    for _ in range(40):
+        r = (m + M) / 2.0
+        u = f(r * unique_pairs)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return int(unique_pairs * (m + M) / 2.0)
+
+
+def duplicate_metrics(bam: Path, THREADS: int = 1) -> pd.DataFrame:
+    """Stream a coordinate sorted BAM file with samtools and count its duplicates
+
+    **parameter**
+
+    bam: Path
+        The sorted BAM file.
+
+    THREADS: int
+        Number of samtools decompression threads.
+
+    **return**
+
+    metrics: DataFrame
+        One row with the columns of the Picard metrics file that are used.
+    """
+    header = subprocess.run(["samtools", "view", "-H", str(bam)], capture_output=True, check=True).stdout
+    ref_names = re.findall(rb"^@SQ\t.*?SN:([^\t\n]+)", header, flags=re.M)
+    counter = DuplicateCounter([name.decode() for name in ref_names])
+    cmd = ["samtools", "view", "-F", str(EXCLUDE_FLAGS), "-@", str(THREADS), str(bam)]
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+        for line in process.stdout:
+            qname, flag, ref, pos, _, cigar, mate_ref, mate_pos, _ = line.split(b"\t", 8)
+            counter.add(int(flag), ref.decode(), int(pos), cigar, qname, mate_ref.decode(), int(mate_pos))
+    if process.returncode != 0:
+        raise DuplicatesException(f"samtools view exited with status {process.returncode}")
+    return counter.metrics()
+
+
+class DuplicatesException(Exception):
+    """Basic exception for problems counting duplicates"""
@@ -0,0 +1,38 @@
+"""Tell the failures that happen again whenever a sample is run from the others
+
+A sample rejected for its data, like an ABI SOLiD library or too few reads,
+fails the same way in every run. Such failures are permanent, the sample is
+recorded in the run database and later runs skip it. Any other failure, like
+a download or a tool that crashed or ran out of memory, is transient and the
+stage can be tried again.
+"""
+from typing import Optional
+
+from .atropos import AtroposException
+from .check_fq import AbiException, DownloadException
+from .hisat2 import Hisat2Exception
+
+PERMANENT, TRANSIENT = "permanent", "transient"
+
+# Data-quality rejects, by exception and text of the message
+REJECTS = [
+    (AbiException, ""),
+    (DownloadException, "<100,000 reads"),
+    (AtroposException, "<1,000 reads"),
+    (Hisat2Exception, "Poor alignment"),
+]
+
+
+def classify(error: Optional[BaseException]) -> str:
+    """PERMANENT if the error, or an error it was raised from, is a data-quality reject, else TRANSIENT"""
+    while error is not None:
+        for exception, message in REJECTS:
+            if isinstance(error, exception) and message in str(error):
+                return PERMANENT
+        error = error.__cause__
+    return TRANSIENT
+
+
+def backoff(attempt: int, delay: float) -> float:
+    """Seconds before a stage is tried again after its `attempt`th failure, doubling each time"""
+    return delay * 2 ** (attempt - 1)
@@ -1,11 +1,15 @@
 import os
 import re
-from collections import namedtuple
+from collections import deque, namedtuple
+from multiprocessing import get_context
 from xopen import xopen
 from io import BytesIO
-from itertools import zip_longest
+from itertools import chain, zip_longest
 from typing import Optional, TextIO, Union
 from more_itertools import grouper
+import numpy as np
+from .fastq_chunk import ChunkReader, LineStream, RecordChunk
+from .readstats import ReadStats
 
 
 class UnequalNumberReadsException(Exception):
@@ -17,6 +21,19 @@ class MixedUpReadsException(Exception):
 
 
 Read = namedtuple("Read", "h1,seq,h2,qual")
+# `checked` and `mates` are only set for pair-end chunks: the number of pairs
+# checked before stopping and the single-end results of each mate. `stats`
+# holds the ReadStats of the accepted reads if they are collected.
+ChunkResult = namedtuple(
+    "ChunkResult",
+    "reads,libsize,total_len,unequal_len,bad_ecoding,incomplete_read,mixed_up,checked,mates,stats",
+    defaults=(None, None, None),
+)
+
+ENGINES = ("python", "vector")
+
+# Order in which the checks are applied, a pair is counted under the first hit.
+PROBLEMS = ("incomplete_read", "bad_ecoding", "unequal_len")
 
 
 def _strip_control_characters(string: str):
@@ -29,16 +46,48 @@ def _strip_control_characters(string: str):
 
 
 class Fastq:
-    """A simple FASTQ Parser"""
-    def __init__(self, R1: str, R2: Optional[str] = None):
+    """A simple FASTQ Parser
+
+    `engine` selects how reads are validated. "python" checks every read
+    character by character, "vector" checks whole chunks of records with
+    byte lookup tables and only falls back to the per read checks for records
+    that are not clean. Both report the same counts and flags.
+
+    With `passthrough` the vector engine yields accepted records as slices
+    of the input buffer, one slice for each run of records that need no
+    normalization, instead of re-encoding every read.
+
+    With more than one `workers` the vector engine checks the chunks in a
+    pool of processes. Results are merged in input order, R1 and R2 chunks of
+    pair-end data are sent together so that pairs stay in lockstep.
+
+    Pair-end data is checked in a single pass. Every mate is also counted as
+    if it was single-end, so when the files turn out to have an unequal
+    number of reads or mixed up pairs, the kept mate continues as single-end
+    from where the pair-end check stopped instead of starting over.
+
+    With `readstats` the statistics of the accepted reads are collected in
+    `readstats`, a ReadStats of the reads of the kept mates.
+    """
+    def __init__(self, R1: str, R2: Optional[str] = None, engine: str = "vector",
+                 passthrough: bool = False, workers: int = 1, readstats: bool = False):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown FASTQ engine {engine}, choose from {', '.join(ENGINES)}")
         self.R1 = R1
         self.R2 = R2
+        self.engine = engine
+        self.passthrough = passthrough and engine == "vector"
+        self.workers = workers
+        self.collect_stats = readstats
+        self.readstats = None
         self.libsize = None
         self.avgReadLen = None
         self.unequal_len = None
         self.bad_ecoding = None
         self.incomplete_read = None
         self.flags = set()
+        self._mates = None
+        self._mate_stats = None
 
     def process(self):
         """Process FASTQ File
@@ -53,13 +102,19 @@ class Fastq:
         problems.
         Yields
         ======
-        String representation of each read.
+        String representation of each read, or of a run of reads in
+        passthrough mode. Pair-end input yields a tuple for each pair. A valid
+        read whose mate is rejected, and every read once a mate is kept as
+        single-end, comes with None in place of the other mate.
         Raises
         ======
         NoReadsException: If FASTQ is empty.
         AbiException: If FASTQ is from ABI Solid.
         """
-        if self._is_abi():  # Ignore samples stored as colorspace
+        # Files too small to process are only checked for colorspace, the
+        # others are checked on their first read.
+        small = [fq for fq in (self.R1, self.R2) if fq is not None and self._is_empty(fq)]
+        if small and self._is_abi(small):  # Ignore samples stored as colorspace
             self.flags.add("abi_solid")
             return
 
@@ -91,14 +146,14 @@ class Fastq:
         if ~self._is_empty(self.R1) & self._is_empty(self.R2):  # R2 is empty treat as SE
             self.flags.add("keep_R1")
             self.R2 = None
-            yield from self._process_single_end()
+            yield from self._mate_reads(self._process_single_end())
             return
 
         if self._is_empty(self.R1) & ~self._is_empty(self.R2):  # R1 is empty treat as SE
             self.flags.add("keep_R2")
             self.R1 = self.R2
             self.R2 = None
-            yield from self._process_single_end()
+            yield from self._mate_reads(self._process_single_end())
             return
 
     def open_fastq(self, fastq: Union[str, bytes] = None):
@@ -122,84 +177,297 @@ class Fastq:
                 self._decode(h1), self._decode(seq), self._decode(h2), self._decode(qual),
             )
 
-    def _process_single_end(self):
+    def _reset_counts(self):
         self.libsize = 0
         self.unequal_len = 0
         self.bad_ecoding = 0
         self.incomplete_read = 0
-        total_len = 0
+        # Single-end counts of each mate of pair-end data
+        self._mates = [dict.fromkeys(("libsize", "total_len") + PROBLEMS, 0) for _ in range(2)]
+        self._mate_stats = [ReadStats(), ReadStats()] if self.collect_stats else None
+
+    def _add_counts(self, result: ChunkResult):
+        self.libsize += result.libsize
+        self.unequal_len += result.unequal_len
+        self.bad_ecoding += result.bad_ecoding
+        self.incomplete_read += result.incomplete_read
+
+    def _add_mate_counts(self, mates):
+        for mate, (counts, result) in enumerate(zip(self._mates, mates)):
+            counts["libsize"] += result.libsize
+            counts["total_len"] += result.total_len
+            for problem in PROBLEMS:
+                counts[problem] += getattr(result, problem)
+            self._add_stats(result, mate)
+
+    def _count_mate(self, mate: int, read: Read, problem: Optional[str]):
+        if problem:
+            self._mates[mate][problem] += 1
+        else:
+            self._mates[mate]["libsize"] += 1
+            self._mates[mate]["total_len"] += len(read.seq)
+            if self.collect_stats:
+                self._mate_stats[mate].add_read(read)
+
+    def _add_stats(self, result: ChunkResult, mate: int = 0):
+        if self.collect_stats:
+            self._mate_stats[mate].merge(result.stats)
+
+    def _set_avg_read_len(self, total_len: list):
+        avg = [length / self.libsize for length in total_len]
+        self.avgReadLen = avg if len(avg) > 1 else avg[0]
+        if self.collect_stats:
+            # The mate that was dropped has no statistics left
+            self.readstats = ReadStats()
+            for stats in self._mate_stats:
+                self.readstats.merge(stats)
+
+    def _process_single_end(self):
+        if self.engine == "vector":
+            return self._process_single_end_vector()
+        return self._process_single_end_python()
+
+    def _process_pair_end(self):
+        if self.engine == "vector":
+            return self._process_pair_end_vector()
+        return self._process_pair_end_python()
+
+    def _process_single_end_python(self):
+        self._reset_counts()
+        total_len = [0]
 
         with self.open_fastq(self.R1) as fh:
-            for read in self.iter_reads(fh):
-                if self._is_incomplete(read):
-                    # This should only happen if file was truncated.
-                    self.incomplete_read += 1
-                    continue
+            first, reads = self._peek(self.iter_reads(fh))
+            if self._is_abi_start([first]):
+                self.flags.add("abi_solid")
+                return
+            yield from self._check_reads(reads, total_len)
 
-                if self._is_wrong_encoding(read):
-                    self.bad_ecoding += 1
-                    continue
+        self._set_avg_read_len(total_len)
 
-                if self._is_unequal_seq_qual(read):
-                    self.unequal_len += 1
-                    continue
+    def _process_single_end_vector(self):
+        self._reset_counts()
+        total_len = [0]
 
-                self.libsize += 1
-                total_len += len(read.seq)
-                yield self._read_to_bytes(read)
+        with self.open_fastq(self.R1) as fh:
+            reader = ChunkReader(fh)
+            if self._is_abi_start([self._peek_read(reader)]):
+                self.flags.add("abi_solid")
+                return
+            yield from self._single_end_vector(reader, total_len)
+
+        self._set_avg_read_len(total_len)
+
+    def _single_end_vector(self, reader: ChunkReader, total_len: list, mate: int = 0):
+        tasks = ((chunk,) for chunk in reader)
+        for result in self._chunk_results(tasks, check_single_end_chunk, check_single_end_buffer):
+            self._add_counts(result)
+            self._add_stats(result, mate)
+            total_len[0] += result.total_len
+            yield from result.reads
+        # Trailing lines that do not make a whole record
+        yield from self._check_reads(self.iter_reads(reader.rest()), total_len, mate)
+
+    def _check_reads(self, reads, total_len: list, mate: int = 0):
+        for read in reads:
+            if self._is_incomplete(read):
+                # This should only happen if file was truncated.
+                self.incomplete_read += 1
+                continue
 
-        self.avgReadLen = total_len / self.libsize
+            if self._is_wrong_encoding(read):
+                self.bad_ecoding += 1
+                continue
 
-    def _process_pair_end(self):
-        self.libsize = 0
-        self.unequal_len = 0
-        self.bad_ecoding = 0
-        self.incomplete_read = 0
+            if self._is_unequal_seq_qual(read):
+                self.unequal_len += 1
+                continue
+
+            self.libsize += 1
+            total_len[0] += len(read.seq)
+            if self.collect_stats:
+                self._mate_stats[mate].add_read(read)
+            yield self._read_to_bytes(read)
+
+    def _process_pair_end_python(self):
+        self._reset_counts()
         total_len = [0, 0]
 
         with self.open_fastq(self.R1) as fh1, self.open_fastq(self.R2) as fh2:
-            for read1, read2 in zip_longest(self.iter_reads(fh1), self.iter_reads(fh2)):
-                if read1 is None:
-                    self.flags.remove("PE")
-                    self.flags.add("keep_R2")
-                    raise UnequalNumberReadsException
-
-                if read2 is None:
-                    self.flags.remove("PE")
-                    self.flags.add("keep_R1")
-                    raise UnequalNumberReadsException
-
-                if self._is_incomplete(read1) | self._is_incomplete(read2):
-                    # This should only happen if file was truncated.
-                    print("incomplete")
-                    self.incomplete_read += 1
-                    continue
-
-                if self._is_wrong_encoding(read1) | self._is_wrong_encoding(read2):
-                    print("wrong")
-                    self.bad_ecoding += 1
-                    continue
-
-                if self._is_unequal_seq_qual(read1) | self._is_unequal_seq_qual(read2):
-                    print("unequal")
-                    self.unequal_len += 1
-                    continue
-
-                if self._is_different_header(read1, read2):
-                    print("different")
-                    self.flags.remove("PE")
-                    if os.stat(self.R1).st_size < os.stat(self.R2).st_size:
-                        self.flags.add("keep_R2")
-                    else:
-                        self.flags.add("keep_R1")
-                    raise MixedUpReadsException
-
-                self.libsize += 1
-                total_len[0] += len(read1.seq)
-                total_len[1] += len(read2.seq)
-                yield self._read_to_bytes(read1), self._read_to_bytes(read2)
-
-        self.avgReadLen = [total_len[0] / self.libsize, total_len[1] / self.libsize]
+            firsts, reads = zip(*[self._peek(self.iter_reads(fh)) for fh in (fh1, fh2)])
+            if self._is_abi_start(firsts):
+                self.flags.add("abi_solid")
+                return
+            reads = list(reads)
+            yield from self._check_read_pairs(reads, total_len)
+            if "PE" not in self.flags:
+                keep = self._kept_mate()
+                yield from self._mate_reads(self._check_reads(reads[keep], total_len, keep))
+
+        self._set_avg_read_len(total_len)
+
+    def _process_pair_end_vector(self):
+        self._reset_counts()
+        total_len = [0, 0]
+
+        with self.open_fastq(self.R1) as fh1, self.open_fastq(self.R2) as fh2:
+            readers = [ChunkReader(fh1), ChunkReader(fh2)]
+            if self._is_abi_start([self._peek_read(reader) for reader in readers]):
+                self.flags.add("abi_solid")
+                return
+            issued = deque()
+            tasks = self._issue(self._pair_chunks(*readers), issued)
+            results = self._chunk_results(tasks, check_pair_end_chunk, check_pair_end_buffer)
+            for result in results:
+                chunks = issued.popleft()
+                self._add_counts(result)
+                self._add_mate_counts(result.mates)
+                total_len[0] += result.total_len[0]
+                total_len[1] += result.total_len[1]
+                yield from result.reads
+                yield from ((read, None) for read in result.mates[0].reads)
+                yield from ((None, read) for read in result.mates[1].reads)
+                if result.mixed_up:
+                    keep = self._larger_mate()
+                    self._fall_back(keep, total_len)
+                    # Reads of the kept mate that were not checked as pairs,
+                    # including the chunks still in flight, go back to its reader
+                    unchecked = [chunks[keep].tail_bytes(result.checked)]
+                    unchecked += [pending[keep].to_bytes() for pending in issued]
+                    results.close()
+                    readers[keep].unread(b"".join(unchecked))
+                    yield from self._mate_reads(self._single_end_vector(readers[keep], total_len, keep))
+                    break
+            else:
+                # Trailing lines and reads left over when one file is longer
+                rests = [reader.rest() for reader in readers]
+                reads = [self.iter_reads(rest) for rest in rests]
+                yield from self._check_read_pairs(reads, total_len)
+                if "PE" not in self.flags:
+                    keep = self._kept_mate()
+                    # The read that ended the pairs goes first, the rest of
+                    # the kept file is checked a chunk at a time again
+                    yield from self._mate_reads(self._check_reads([next(reads[keep])], total_len, keep))
+                    reader = ChunkReader(LineStream(rests[keep]))
+                    yield from self._mate_reads(self._single_end_vector(reader, total_len, keep))
+
+        self._set_avg_read_len(total_len)
+
+    @staticmethod
+    def _issue(tasks, issued: deque):
+        """Remember the tasks handed out, their results come back in the same order"""
+        for task in tasks:
+            issued.append(task)
+            yield task
+
+    @staticmethod
+    def _pair_chunks(reader1: ChunkReader, reader2: ChunkReader):
+        """Read R1 and R2 chunks in lockstep, both chunks hold the same reads
+
+        Stops at the first chunk where R2 runs short, the R1 records without
+        a mate are put back for the read by read check.
+        """
+        for chunk1 in reader1:
+            chunk2 = reader2.read(chunk1.n_records)
+            n_pairs = 0 if chunk2 is None else chunk2.n_records
+            if n_pairs < chunk1.n_records:
+                reader1.unread(chunk1.tail_bytes(n_pairs))
+                if n_pairs > 0:
+                    yield chunk1.head(n_pairs), chunk2
+                return
+            yield chunk1, chunk2
+
+    def _chunk_results(self, tasks, check, check_buffer):
+        """Check chunks in order, in a pool of worker processes if workers > 1
+
+        Workers get the raw buffers and return the accepted reads as bytes.
+        Only a few chunks per worker are in flight, so the reader does not run
+        ahead of the writer.
+        """
+        if self.workers <= 1:
+            for chunks in tasks:
+                yield check(*chunks, self.passthrough, self.collect_stats)
+            return
+
+        # forkserver is safe when check_fq itself runs in a thread
+        with get_context("forkserver").Pool(self.workers) as pool:
+            pending = deque()
+            for chunks in tasks:
+                buffers = [chunk.to_bytes() for chunk in chunks]
+                pending.append(pool.apply_async(check_buffer, (*buffers, self.passthrough, self.collect_stats)))
+                if len(pending) > 2 * self.workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def _check_read_pairs(self, reads: list, total_len: list):
+        """Check the reads of both mates pair by pair
+
+        A valid read whose mate is rejected is yielded on its own. Stops when
+        the files have an unequal number of reads or the pairs are mixed up,
+        then only the kept mate is left in `reads` and `total_len`, starting
+        with the read that was not checked.
+        """
+        for read1, read2 in zip_longest(*reads):
+            if read1 is None or read2 is None:
+                keep = 0 if read2 is None else 1
+            else:
+                problems = (self._read_problem(read1), self._read_problem(read2))
+                problem = next((name for name in PROBLEMS if name in problems), None)
+                if problem is None and self._is_different_header(read1, read2):
+                    keep = self._larger_mate()
+                else:
+                    keep = None
+            if keep is not None:
+                self._fall_back(keep, total_len)
+                reads[keep] = chain([(read1, read2)[keep]], reads[keep])
+                return
+
+            self._count_mate(0, read1, problems[0])
+            self._count_mate(1, read2, problems[1])
+            if problem:
+                setattr(self, problem, getattr(self, problem) + 1)
+                if problems[0] is None:
+                    yield self._read_to_bytes(read1), None
+                if problems[1] is None:
+                    yield None, self._read_to_bytes(read2)
+                continue
+
+            self.libsize += 1
+            total_len[0] += len(read1.seq)
+            total_len[1] += len(read2.seq)
+            yield self._read_to_bytes(read1), self._read_to_bytes(read2)
+
+    def _larger_mate(self) -> int:
+        """Mate to keep when the pairs are mixed up, the one in the larger file"""
+        if os.stat(self.R1).st_size < os.stat(self.R2).st_size:
+            return 1
+        return 0
+
+    def _fall_back(self, keep: int, total_len: list):
+        """Stop processing as PE, only mate `keep` (0 for R1) is kept as SE
+
+        The counts so far are replaced by the single-end counts of that mate.
+        """
+        self.flags.remove("PE")
+        self.flags.add(("keep_R1", "keep_R2")[keep])
+        counts = self._mates[keep]
+        self.libsize = counts["libsize"]
+        self.unequal_len = counts["unequal_len"]
+        self.bad_ecoding = counts["bad_ecoding"]
+        self.incomplete_read = counts["incomplete_read"]
+        total_len[:] = [counts["total_len"]]
+        if self.collect_stats:
+            self._mate_stats[1 - keep] = ReadStats()
+
+    def _kept_mate(self) -> int:
+        return 0 if "keep_R1" in self.flags else 1
+
+    def _mate_reads(self, reads):
+        """Tag the reads of the mate that is kept as single-end"""
+        if self._kept_mate() == 0:
+            return ((read, None) for read in reads)
+        return ((None, read) for read in reads)
 
     @staticmethod
     def _decode(value: Optional[bytes]):
@@ -226,21 +494,32 @@ class Fastq:
 
         return True
 
-    def _is_abi(self):
-        with self.open_fastq(self.R1) as fh:
-            for read in self.iter_reads(fh):
-                if self._is_abi_read(read):
-                    return True
-                break
-
-        if self.R2:
-            with self.open_fastq(self.R2) as fh:
+    def _is_abi(self, fastqs: Optional[list] = None):
+        for fastq in fastqs or [self.R1, self.R2]:
+            if fastq is None:
+                continue
+            with self.open_fastq(fastq) as fh:
                 for read in self.iter_reads(fh):
                     if self._is_abi_read(read):
                         return True
                     break
         return False
 
+    @staticmethod
+    def _peek(reads):
+        """Take the first read, returns it and all the reads"""
+        first = next(reads, None)
+        if first is None:
+            return None, reads
+        return first, chain([first], reads)
+
+    def _peek_read(self, reader: ChunkReader) -> Optional[Read]:
+        return next(self.iter_reads(reader.peek()), None)
+
+    def _is_abi_start(self, firsts) -> bool:
+        """Check the first read of each file for colorspace"""
+        return any(read is not None and read.seq is not None and self._is_abi_read(read) for read in firsts)
+
     @staticmethod
     def _is_abi_read(read: Read) -> bool:
         """Look at read and determine if using abi colorspace.
@@ -261,19 +540,31 @@ class Fastq:
             return True
         return False
 
-    def _is_wrong_encoding(self, read: Read) -> bool:
+    @staticmethod
+    def _is_wrong_encoding(read: Read) -> bool:
         """Determine if read is correctly encoded"""
-        if self._is_invaid_header(read.h1) | self._is_invaid_header(read.h1):
+        if Fastq._is_invaid_header(read.h1) | Fastq._is_invaid_header(read.h1):
             return True
 
-        if self._is_invalid_seq(read.seq):
+        if Fastq._is_invalid_seq(read.seq):
             return True
 
-        if self._is_invalid_qual(read.qual):
+        if Fastq._is_invalid_qual(read.qual):
             return True
 
         return False
 
+    @staticmethod
+    def _read_problem(read: Read) -> Optional[str]:
+        """Name the counter a read is rejected under, None if the read is valid"""
+        if Fastq._is_incomplete(read):
+            return "incomplete_read"
+        if Fastq._is_wrong_encoding(read):
+            return "bad_ecoding"
+        if Fastq._is_unequal_seq_qual(read):
+            return "unequal_len"
+        return None
+
     @staticmethod
     def _is_invaid_header(string: str):
         """Make sure only contains valid ascii characters
@@ -351,4 +642,184 @@ class Fastq:
             f"{'# Non-ASCII':<20} : {self.bad_ecoding or 0:,}\n"
             f"{'# Incomplete':<20} : {self.incomplete_read or 0:,}\n"
             f"{'Flags':<20} : {', '.join(self.flags)}\n"
-        )
\ No newline at end of file
+        )
+
+
+def _chunk_read(chunk: RecordChunk, idx: int) -> Read:
+    return Read(*[Fastq._decode(line) for line in chunk.lines(idx)])
+
+
+class _ChunkOutput:
+    """Collect the accepted reads of a chunk, or of a pair of chunks
+
+    With `passthrough` runs of records accepted as they are stay one slice of
+    the input buffer, otherwise every read is added on its own.
+    """
+    def __init__(self, chunks: list, passthrough: bool):
+        self.chunks = chunks
+        self.passthrough = passthrough
+        self.seq_len = [chunk.seq_len() for chunk in chunks]
+        self.reads = []
+        self.libsize = 0
+        self.total_len = [0] * len(chunks)
+        self.counts = dict.fromkeys(PROBLEMS, 0)
+
+    def _add(self, records: list):
+        self.reads.append(records[0] if len(records) == 1 else tuple(records))
+
+    def add_raw(self, first: int, last: int):
+        """Accept records `first` to `last` (exclusive) from their raw bytes"""
+        if last <= first:
+            return
+        self.libsize += last - first
+        for k, seq_len in enumerate(self.seq_len):
+            self.total_len[k] += int(seq_len[first:last].sum())
+        if self.passthrough:
+            self._add([chunk.span(first, last) for chunk in self.chunks])
+        else:
+            for idx in range(first, last):
+                self._add([chunk.record(idx) for chunk in self.chunks])
+
+    def add_reads(self, reads: list):
+        """Accept reads that were decoded and must be rebuilt"""
+        self.libsize += 1
+        for k, read in enumerate(reads):
+            self.total_len[k] += len(read.seq)
+        self._add([Fastq._read_to_bytes(read) for read in reads])
+
+    def result(self, mixed_up: bool = False) -> ChunkResult:
+        total_len = self.total_len[0] if len(self.chunks) == 1 else self.total_len
+        return ChunkResult(self.reads, self.libsize, total_len, mixed_up=mixed_up, **self.counts)
+
+
+def check_single_end_chunk(chunk: RecordChunk, passthrough: bool = False, readstats: bool = False) -> ChunkResult:
+    """Validate a chunk of single-end records
+
+    Clean records are accepted from their raw bytes, the others go through
+    the same per read checks as the python engine.
+    """
+    output = _ChunkOutput([chunk], passthrough)
+    clean = chunk.clean()
+    stats = ReadStats() if readstats else None
+    if stats is not None:
+        stats.add_records(chunk, clean)
+    first = 0
+    for idx in np.flatnonzero(~clean):
+        output.add_raw(first, idx)
+        first = idx + 1
+        read = _chunk_read(chunk, idx)
+        problem = Fastq._read_problem(read)
+        if problem:
+            output.counts[problem] += 1
+            continue
+        output.add_reads([read])
+        if stats is not None:
+            stats.add_read(read)
+    output.add_raw(first, chunk.n_records)
+    return output.result()._replace(stats=stats)
+
+
+class _MateOutput:
+    """Single-end view of one mate of a pair-end chunk
+
+    Counts the reads of the mate that pass the single-end checks, in case the
+    mate is kept on its own later. Only the valid reads whose mate was
+    rejected are collected, all others are written with their pair.
+    """
+    def __init__(self, chunk: RecordChunk, clean: np.ndarray, readstats: bool = False):
+        self.chunk = chunk
+        self.clean = clean
+        self.stats = ReadStats() if readstats else None
+        self.reads = []
+        self.normalized_len = 0
+        self.counts = dict.fromkeys(PROBLEMS, 0)
+
+    def add_read(self, idx: int, read: Read, problem: Optional[str]):
+        """Count a read of a pair that is not clean"""
+        if problem:
+            self.counts[problem] += 1
+        elif not self.clean[idx]:
+            self.normalized_len += len(read.seq)
+            if self.stats is not None:
+                self.stats.add_read(read)
+
+    def add_solo(self, idx: int, read: Read):
+        self.reads.append(self.chunk.record(idx) if self.clean[idx] else Fastq._read_to_bytes(read))
+
+    def result(self, checked: int) -> ChunkResult:
+        """Counts of the first `checked` reads, clean reads are counted from their raw bytes"""
+        clean = self.clean[:checked]
+        total_len = int(self.chunk.seq_len()[:checked][clean].sum()) + self.normalized_len
+        libsize = checked - sum(self.counts.values())
+        if self.stats is not None:
+            accepted = self.clean.copy()
+            accepted[checked:] = False
+            self.stats.add_records(self.chunk, accepted)
+        return ChunkResult(self.reads, libsize, total_len, mixed_up=False, stats=self.stats, **self.counts)
+
+
+def check_pair_end_chunk(chunk1: RecordChunk, chunk2: RecordChunk, passthrough: bool = False,
+                         readstats: bool = False) -> ChunkResult:
+    """Validate a chunk of pair-end records, both chunks hold the same reads
+
+    Stops at the first pair with different headers and sets `mixed_up`,
+    `checked` is the number of pairs before it.
+    """
+    clean1, clean2 = chunk1.clean(), chunk2.clean()
+    clean = clean1 & clean2
+    output = _ChunkOutput([chunk1, chunk2], passthrough)
+    mates = (_MateOutput(chunk1, clean1, readstats), _MateOutput(chunk2, clean2, readstats))
+
+    def finish(checked: int, mixed_up: bool = False) -> ChunkResult:
+        return output.result(mixed_up)._replace(
+            checked=checked, mates=tuple(mate.result(checked) for mate in mates)
+        )
+
+    first = 0
+    for idx in np.flatnonzero(~(clean & chunk1.matching_headers(chunk2))):
+        reads = (_chunk_read(chunk1, idx), _chunk_read(chunk2, idx))
+        if clean[idx]:
+            if Fastq._is_different_header(*reads):
+                output.add_raw(first, idx)
+                return finish(idx, mixed_up=True)
+            # Headers do match, keep the pair in the current run
+            continue
+
+        output.add_raw(first, idx)
+        first = idx + 1
+        problems = [Fastq._read_problem(read) for read in reads]
+        problem = next((name for name in PROBLEMS if name in problems), None)
+        if not problem and Fastq._is_different_header(*reads):
+            return finish(idx, mixed_up=True)
+        for mate, read, mate_problem in zip(mates, reads, problems):
+            mate.add_read(idx, read, mate_problem)
+        if problem:
+            output.counts[problem] += 1
+            for mate, read, mate_problem in zip(mates, reads, problems):
+                if mate_problem is None:
+                    mate.add_solo(idx, read)
+            continue
+        output.add_reads(list(reads))
+    output.add_raw(first, chunk1.n_records)
+    return finish(chunk1.n_records)
+
+
+def check_single_end_buffer(buf: bytes, passthrough: bool = False, readstats: bool = False) -> ChunkResult:
+    """check_single_end_chunk for a worker process, reads are returned as bytes"""
+    result = check_single_end_chunk(RecordChunk.from_bytes(buf), passthrough, readstats)
+    if not passthrough or not result.reads:
+        return result
+    return result._replace(reads=[b"".join(result.reads)])
+
+
+def check_pair_end_buffer(buf1: bytes, buf2: bytes, passthrough: bool = False,
+                          readstats: bool = False) -> ChunkResult:
+    """check_pair_end_chunk for a worker process, reads are returned as bytes"""
+    result = check_pair_end_chunk(RecordChunk.from_bytes(buf1), RecordChunk.from_bytes(buf2), passthrough,
+                                  readstats)
+    mates = tuple(mate._replace(reads=[b"".join(mate.reads)] if mate.reads else []) for mate in result.mates)
+    result = result._replace(mates=mates)
+    if not passthrough or not result.reads:
+        return result
+    reads1, reads2 = zip(*result.reads)
+    return result._replace(reads=[(b"".join(reads1), b"".join(reads2))])
@@ -0,0 +1,249 @@
+"""Byte-level helpers to validate FASTQ records a chunk at a time"""
+from io import BytesIO
+from itertools import chain
+from typing import BinaryIO, Iterator, Optional
+
+import numpy as np
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _bad_bytes(valid: bytes, bit: int) -> np.ndarray:
+    """Build a 256 entry lookup table that sets `bit` for bytes not in `valid`"""
+    table = np.full(256, bit, dtype=np.uint8)
+    table[np.frombuffer(valid, dtype=np.uint8)] = 0
+    return table
+
+
+# Header lines are only passed through untouched if they are printable ascii.
+# Sequence must be a nucleotide or N, quality must be between ascii 33-126.
+HEADER_BAD, SEQ_BAD, QUAL_BAD = 1, 2, 4
+BYTE_CODE = (
+    _bad_bytes(bytes(range(32, 127)), HEADER_BAD)
+    | _bad_bytes(b"ACGTNacgtn", SEQ_BAD)
+    | _bad_bytes(bytes(range(33, 127)), QUAL_BAD)
+)
+# Every line ends with a newline, it is not part of the line content
+BYTE_CODE[10] = 0
+
+# Character classes of the "length=\d+" pattern that is removed before two
+# headers are compared. Swapping a character for one of the same class can not
+# change what the pattern matches.
+HEADER_CLASS = np.zeros(256, dtype=np.uint8)
+HEADER_CLASS[np.frombuffer(b"0123456789", dtype=np.uint8)] = 1
+for _code, _char in enumerate(b"length=", start=2):
+    HEADER_CLASS[_char] = _code
+
+
+class RecordChunk:
+    """A block of whole FASTQ records sharing one buffer
+
+    Every line of the chunk ends with a newline. `starts` and `ends` hold the
+    offsets of each line (without the newline), four lines per record.
+    """
+    def __init__(self, buf: bytes, starts: np.ndarray, ends: np.ndarray):
+        self.buf = buf
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_bytes(cls, buf: bytes):
+        """Index a buffer holding only complete, newline terminated records"""
+        newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+        starts = np.concatenate([[0], newlines[:-1] + 1])[:len(newlines)].astype(np.int64)
+        return cls(buf, starts, newlines.astype(np.int64))
+
+    @property
+    def n_records(self) -> int:
+        return len(self.ends) // 4
+
+    def line(self, idx: int) -> bytes:
+        return self.buf[self.starts[idx]:self.ends[idx]]
+
+    def record(self, idx: int) -> bytes:
+        """Raw bytes of one record including the trailing newline"""
+        return self.buf[self.starts[4 * idx]:self.ends[4 * idx + 3] + 1]
+
+    def lines(self, idx: int):
+        return tuple(self.line(4 * idx + k) for k in range(4))
+
+    def seq_len(self) -> np.ndarray:
+        return self.ends[1::4] - self.starts[1::4]
+
+    def qual_len(self) -> np.ndarray:
+        return self.ends[3::4] - self.starts[3::4]
+
+    def span(self, first: int, last: int) -> memoryview:
+        """Raw bytes of records `first` to `last` (exclusive) without a copy"""
+        return memoryview(self.buf)[self.starts[4 * first]:self.ends[4 * last - 1] + 1]
+
+    def to_bytes(self) -> bytes:
+        """Raw bytes of all records, to send the chunk to another process"""
+        if self.n_records == 0:
+            return b""
+        if self.ends[-1] + 1 == len(self.buf):
+            return self.buf
+        return self.buf[:self.ends[-1] + 1]
+
+    def head(self, n_records: int) -> "RecordChunk":
+        """First `n_records` records, the buffer is not copied"""
+        return RecordChunk(self.buf, self.starts[:4 * n_records], self.ends[:4 * n_records])
+
+    def tail_bytes(self, n_records: int) -> bytes:
+        """Raw bytes following the first `n_records` records"""
+        if n_records >= self.n_records:
+            return b""
+        return self.buf[self.starts[4 * n_records]:self.ends[-1] + 1]
+
+    def clean(self) -> np.ndarray:
+        """Find the records that are valid and need no normalization
+
+        A clean record only holds printable ascii in its headers (without
+        leading or trailing space), a nucleotide sequence, a valid quality
+        string and equal length sequence and quality. These records are
+        accepted as they are. All others must be checked read by read.
+        """
+        if self.n_records == 0:
+            return np.zeros(0, dtype=bool)
+        arr = np.frombuffer(self.buf, dtype=np.uint8)[:self.ends[-1] + 1]
+        starts, ends = self.starts, self.ends
+        # OR the codes of all bytes of a line, each line has a newline so no
+        # line is empty for reduceat.
+        line_code = np.bitwise_or.reduceat(BYTE_CODE[arr], starts)
+
+        ok = (line_code[1::4] & SEQ_BAD) == 0
+        ok &= (line_code[3::4] & QUAL_BAD) == 0
+        ok &= self.seq_len() == self.qual_len()
+        for role in (0, 2):
+            s, e = starts[role::4], ends[role::4]
+            ok &= (line_code[role::4] & HEADER_BAD) == 0
+            filled = e > s
+            # A leading or trailing space would be stripped on decoding
+            edge = np.zeros(len(s), dtype=bool)
+            edge[filled] = (arr[s[filled]] == 32) | (arr[e[filled] - 1] == 32)
+            ok &= ~edge
+        return ok
+
+    def matching_headers(self, other: "RecordChunk") -> np.ndarray:
+        """Find the pairs whose headers are known to match
+
+        Headers that are identical, or of equal length and differ in a single
+        character of the same class, pass the pair header check. All other
+        pairs must be compared with the string check.
+        """
+        arr1 = np.frombuffer(self.buf, dtype=np.uint8)
+        arr2 = np.frombuffer(other.buf, dtype=np.uint8)
+        start1, start2 = self.starts[0::4], other.starts[0::4]
+        length = self.ends[0::4] - start1
+        equal_len = length == other.ends[0::4] - start2
+        length = np.where(equal_len, length, 0)
+
+        # Offsets of every header character of both chunks, pair by pair
+        offset = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+        idx1 = np.repeat(start1, length) + offset
+        idx2 = np.repeat(start2, length) + offset
+        diff = arr1[idx1] != arr2[idx2]
+        count = np.concatenate([[0], np.cumsum(diff, dtype=np.int64)])
+        bounds = np.concatenate([[0], np.cumsum(length)])
+        n_diff = count[bounds[1:]] - count[bounds[:-1]]
+
+        same_class = np.zeros(len(length), dtype=bool)
+        pair = np.repeat(np.arange(len(length)), length)[diff]
+        single = n_diff[pair] == 1
+        same_class[pair[single]] = (
+            HEADER_CLASS[arr1[idx1[diff][single]]] == HEADER_CLASS[arr2[idx2[diff][single]]]
+        )
+        return equal_len & ((n_diff == 0) | ((n_diff == 1) & same_class))
+
+
+class ChunkReader:
+    """Read a binary FASTQ stream as chunks of whole records
+
+    Lines that do not make a complete record at the end of the stream are
+    left for `rest`, so the caller can process them read by read.
+    """
+    def __init__(self, file_handle: BinaryIO, chunk_size: int = CHUNK_SIZE):
+        self.file_handle = file_handle
+        self.chunk_size = chunk_size
+        self._buffer = b""
+        self._eof = False
+
+    def __iter__(self) -> Iterator[RecordChunk]:
+        while True:
+            chunk = self.read()
+            if chunk is None:
+                return
+            yield chunk
+
+    def read(self, n_records: Optional[int] = None) -> Optional[RecordChunk]:
+        """Return the next chunk of records
+
+        Without `n_records` about `chunk_size` bytes are returned, otherwise
+        exactly `n_records` records unless the stream ends first. Returns None
+        when no complete record is left.
+        """
+        while not self._eof:
+            if n_records is None:
+                if len(self._buffer) >= self.chunk_size and self._buffer.count(b"\n") >= 4:
+                    break
+            elif self._buffer.count(b"\n") >= 4 * n_records:
+                break
+            data = self.file_handle.read(self.chunk_size)
+            if not data:
+                self._eof = True
+            else:
+                self._buffer += data
+
+        newlines = np.flatnonzero(np.frombuffer(self._buffer, dtype=np.uint8) == 10)
+        n_full = len(newlines) // 4
+        if n_records is not None:
+            n_full = min(n_full, n_records)
+        if n_full == 0:
+            return None
+        cut = newlines[4 * n_full - 1] + 1
+        buf, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        starts = np.concatenate([[0], newlines[:4 * n_full - 1] + 1]).astype(np.int64)
+        return RecordChunk(buf, starts, newlines[:4 * n_full].astype(np.int64))
+
+    def peek(self, n_lines: int = 4) -> list:
+        """Return the first `n_lines` lines of the stream without consuming them"""
+        while not self._eof and self._buffer.count(b"\n") < n_lines:
+            data = self.file_handle.read(self.chunk_size)
+            if not data:
+                self._eof = True
+            else:
+                self._buffer += data
+        return BytesIO(self._buffer).readlines()[:n_lines]
+
+    def unread(self, data: bytes) -> None:
+        """Put raw bytes back in front of the stream"""
+        self._buffer = data + self._buffer
+
+    def rest(self) -> Iterator[bytes]:
+        """Iterate over the lines that have not been returned as chunks"""
+        head, self._buffer = self._buffer, b""
+        if not self._eof:
+            head += self.file_handle.readline()
+        return chain(BytesIO(head), self.file_handle)
+
+
+class LineStream:
+    """Minimal binary file over an iterator of lines, to chunk what is left of
+    a stream that was read line by line"""
+    def __init__(self, lines: Iterator[bytes]):
+        self._lines = iter(lines)
+
+    def read(self, size: int = -1) -> bytes:
+        data, n_bytes = [], 0
+        for line in self._lines:
+            data.append(line)
+            n_bytes += len(line)
+            if 0 <= size <= n_bytes:
+                break
+        return b"".join(data)
+
+    def readline(self) -> bytes:
+        return next(self._lines, b"")
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self._lines
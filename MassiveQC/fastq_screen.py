@@ -2,12 +2,15 @@ from pathlib import Path
 import pandas as pd
 import logging
 from .command import run_command
-from .parser import parse_fastq_screen
+from .kmer_screen import kmer_screen
+from .parser import parse_fastq_screen, remove_file
+from .subset import SUBSET_READS
 
 logger = logging.getLogger("MassiveQC")
 
 
-def run_fastq_screen(config_file, feature_path, QC_dir, summary_file, SRR, THREADS=1):
+def run_fastq_screen(config_file, feature_path, QC_dir, summary_file, SRR, THREADS=1,
+                     engine="fastq_screen", index_dir=None):
     feature_screen = Path(feature_path) / "fastq_screen"
     layout_ = pd.read_parquet(summary_file).layout[0]
     QC_dir = Path(QC_dir)
@@ -16,23 +19,39 @@ def run_fastq_screen(config_file, feature_path, QC_dir, summary_file, SRR, THREA
         feature_file = feature_screen / f"{SRR}_1_screen.txt"
     elif layout_ == "keep_R2":
         fastq = QC_dir / f"{SRR}_2.fastq.gz"
-        feature_file = feature_screen / f"{SRR}_1_screen.txt"
+        feature_file = feature_screen / f"{SRR}_2_screen.txt"
     else:
         fastq = QC_dir / f"{SRR}.fastq.gz"
         feature_file = feature_screen / f"{SRR}_screen.txt"
 
-    screen(config_file, feature_screen, fastq, THREADS)
+    # check_fq leaves a sample of the reads, fastq_screen does not scan the whole file
+    subset = QC_dir / "screen" / fastq.name
+    n_reads = 0 if subset.exists() else SUBSET_READS
+    if subset.exists():
+        fastq = subset
+    elif not fastq.exists():
+        # check_fq streamed the reads to atropos, only the trimmed reads are left
+        fastq = fastq.with_name(fastq.name.replace(".fastq.gz", ".trim.fastq.gz"))
+        feature_file = feature_file.with_name(feature_file.name.replace("_screen", ".trim_screen"))
     output_file = feature_screen / f"{SRR}.parquet"
-    summarize(feature_file, output_file, SRR)
-    feature_file.unlink()
-    (feature_screen / f"{feature_file.stem}.html").unlink()
+    if engine == "kmer":
+        logger.info(f"Start k-mer screen of {fastq}")
+        counts = kmer_screen(config_file, fastq.as_posix(), index_dir, n_reads)
+        pct_reads_mapped(counts, SRR).to_parquet(output_file)
+    else:
+        screen(config_file, feature_screen, fastq, THREADS, n_reads=n_reads)
+        summarize(feature_file, output_file, SRR)
+        feature_file.unlink()
+        (feature_screen / f"{feature_file.stem}.html").unlink()
+    remove_file(subset.as_posix())
 
 
-def screen(config_file, feature_screen, fastq, THREADS: int) -> None:
+def screen(config_file, feature_screen, fastq, THREADS: int, n_reads: int = SUBSET_READS) -> None:
+    """Run fastq_screen on `n_reads` reads of `fastq`, all of them if 0"""
     cmd = f"fastq_screen --outdir {feature_screen} " \
           f"--force --aligner bowtie2 --threads {THREADS} " \
           f"--conf {config_file} " \
-          f"--subset 100000 " \
+          f"--subset {n_reads} " \
           f"{fastq} "
     logger.info(f"running {cmd}")
     log_info = run_command(cmd)
@@ -58,6 +77,12 @@ def summarize(feature_file: Path, output_file: Path, SRR: str) -> None:
     """
     logger.info(F"Start extract {SRR} fastq screen result")
     df = parse_fastq_screen(feature_file).set_index("reference").fillna(0)
+    pct_reads_mapped(df, SRR).to_parquet(output_file)
+    logger.info("Complete, remove fastq screen result files")
+
+
+def pct_reads_mapped(df: pd.DataFrame, SRR: str) -> pd.DataFrame:
+    """Percent of the reads mapped to one reference only, one column per reference"""
     summarized = (
         (
                 (df.one_hit_one_library_count + df.multiple_hits_one_library_count)
@@ -70,8 +95,7 @@ def summarize(feature_file: Path, output_file: Path, SRR: str) -> None:
             .T.rename_axis("srr")
     )
     summarized.columns = [f"{col}_pct_reads_mapped" for col in summarized.columns]
-    summarized.to_parquet(output_file)
-    logger.info("Complete, remove fastq screen result files")
+    return summarized
 
 
 
@@ -79,12 +103,12 @@ class FastqScreenException(Exception):
     """Fastq Screen Processing Exception"""
 
 
-def fastq_screen(SRR, QC_dir, feature_path, config_file, THREADS):
-    """Use fastqscreen to identify RNA seq quality"""
+def fastq_screen(SRR, QC_dir, feature_path, config_file, THREADS, engine="fastq_screen", index_dir=None):
+    """Use fastqscreen, or the k-mer screen, to identify RNA seq quality"""
     logger.info(f"Start fastq screen {SRR}")
     layout_file = Path(feature_path) / "layout" / f"{SRR}.parquet"
     try:
-        run_fastq_screen(config_file, feature_path, QC_dir, layout_file, SRR, THREADS)
+        run_fastq_screen(config_file, feature_path, QC_dir, layout_file, SRR, THREADS, engine, index_dir)
         logger.info(f"Complete fast_screen {SRR} fastq file")
     except FastqScreenException:
         logger.warning(f"{SRR}: fastq screen did not complete")
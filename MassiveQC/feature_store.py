@@ -6,6 +6,9 @@ from typing import Optional, Set, Tuple
 
 import pandas as pd
 
+from .count_store import count_store
+from .run_state import RunState
+
 
 def feature_store(done_samples: list, outdir: str):
     """Merge the features of each sample"""
@@ -19,19 +22,36 @@ def feature_store(done_samples: list, outdir: str):
         "markduplicates",
         "rnaseqmetrics",
         "strand",
-        "layout"
+        "layout",
+        "readstats"
     ]
     PREALN_OUTPUT = Path(outdir) / "Features"
-    for output in OUTPUTS:
-        print(f"Aggregating: {output:>20}", end="\t")
-        aggregate_data_store(
-            set(done_samples), PREALN_OUTPUT / output, PREALN_OUTPUT / f"{output}.parquet"
-        )
-
-
-def aggregate_data_store(workflow_samples: set, data_folder_pth: Path, data_store_pth: Path):
+    state = RunState(PREALN_OUTPUT.as_posix())
+    try:
+        recorded = state.outputs()
+        for output in OUTPUTS:
+            if not (PREALN_OUTPUT / output).exists():
+                # Output directories of older versions lack newer features
+                continue
+            print(f"Aggregating: {output:>20}", end="\t")
+            aggregate_data_store(
+                set(done_samples), PREALN_OUTPUT / output, PREALN_OUTPUT / f"{output}.parquet", state, recorded
+            )
+    finally:
+        state.close()
+    count_store(outdir)
+
+
+def aggregate_data_store(workflow_samples: set, data_folder_pth: Path, data_store_pth: Path,
+                         state: Optional[RunState] = None, recorded: Optional[Set[str]] = None):
     data_store, old_samples = load_data_store(data_store_pth)
-    new_samples = find_new_samples(workflow_samples, old_samples, data_folder_pth)
+    if data_store is not None and state is not None:
+        # Samples run again since the store was written are loaded again
+        rerun = old_samples.intersection(state.done_samples(since=data_store_pth.stat().st_mtime))
+        if rerun:
+            data_store = data_store[~data_store.index.isin(rerun)]
+            old_samples -= rerun
+    new_samples = find_new_samples(workflow_samples, old_samples, data_folder_pth, recorded)
 
     print(f"({len(new_samples):,})")
     new_data = load_data_folder(new_samples, data_folder_pth)
@@ -50,9 +70,18 @@ def load_data_store(data_store_pth: Path) -> Tuple[Optional[pd.DataFrame], Set[s
     return data_store, old_samples
 
 
-def find_new_samples(workflow_samples: set, old_samples: set, data_folder_pth: Path) -> Set[str]:
-    dir_content = {file_name.stem for file_name in data_folder_pth.iterdir()}
-    return workflow_samples.intersection(dir_content - old_samples)
+def find_new_samples(workflow_samples: set, old_samples: set, data_folder_pth: Path,
+                     recorded: Optional[Set[str]] = None) -> Set[str]:
+    if recorded is None:
+        dir_content = {file_name.stem for file_name in data_folder_pth.iterdir()}
+        return workflow_samples.intersection(dir_content - old_samples)
+    # Only the files the run database does not record are looked up
+    new_samples = set()
+    for sample in workflow_samples - old_samples:
+        data_file = data_folder_pth / f"{sample}.parquet"
+        if os.path.abspath(data_file) in recorded or data_file.exists():
+            new_samples.add(sample)
+    return new_samples
 
 
 def load_data_folder(samples: set, data_pth: Path) -> Optional[pd.DataFrame]:
@@ -72,8 +101,11 @@ def update_data_store(data_store: Optional[pd.DataFrame], new_data: pd.DataFrame
 
 def check_done_sample(outdir):
     done_sample_file = Path(outdir) / "Features" / "done_sample.txt"
-    done_sample_dir = Path(outdir) / "Features" / "DoneSample"
-    done_samples = os.listdir(done_sample_dir)
+    state = RunState((Path(outdir) / "Features").as_posix())
+    try:
+        done_samples = state.done_samples()
+    finally:
+        state.close()
     pd.DataFrame(done_samples, columns=["srr"]).to_csv(done_sample_file, sep ='\t')
     return done_samples
 
@@ -1,18 +1,26 @@
 import logging
 from pathlib import Path
 import pandas as pd
+from .bam_profile import BamProfile
+from .bamstats import bam_stats
 from .command import run_command
 from typing import Optional, Tuple
-from .parser import parse_hisat2, parse_samtools_stats, parse_bamtools_stats, remove_file
+from .parser import parse_hisat2, remove_file
 
 logger = logging.getLogger("MassiveQC")
 
 
 class Hisat2(object):
-    """This class can run hisat2 and extract the alignment summary"""
+    """This class can run hisat2 and extract the alignment summary
+
+    With `stream` the alignments are piped from hisat2 through the MAPQ
+    filter into samtools sort, no SAM file is written. `profile` sets how the
+    sorted BAM file is written, it is recorded in bam_profile/{SRR}.parquet.
+    """
     def __init__(self, feature_path: str, SRR: str, QC_dir: str, Bam_dir: str,
                  THREADS: int, reference: str, strand: Optional[str] = None,
-                 splice: Optional[str] = None):
+                 splice: Optional[str] = None, stream: bool = False,
+                 profile: Optional[BamProfile] = None):
         self.feature_path = Path(feature_path)
         self.layout = Path(feature_path) / "layout" / f"{SRR}.parquet"
         self.SRR = SRR
@@ -22,6 +30,8 @@ class Hisat2(object):
         self.reference = reference
         self.strand = strand
         self.splice = splice
+        self.stream = stream
+        self.profile = profile or BamProfile()
         self.r1 = None
         self.r2 = None
 
@@ -32,21 +42,26 @@ class Hisat2(object):
         if layout_ == "PE":
             self.r1 = self.QC_dir / f"{self.SRR}_1.trim.fastq.gz"
             self.r2 = self.QC_dir / f"{self.SRR}_2.trim.fastq.gz"
-        elif layout_ == "Keep_R1":
+        elif layout_ == "keep_R1":
             self.r1 = self.QC_dir / f"{self.SRR}_1.trim.fastq.gz"
-            r2 = None
-        elif layout_ == "Keep_R2":
+            self.r2 = None
+        elif layout_ == "keep_R2":
             self.r1 = self.QC_dir / f"{self.SRR}_2.trim.fastq.gz"
             self.r2 = None
         else:
             self.r1 = self.QC_dir / f"{self.SRR}.trim.fastq.gz"
             self.r2 = None
-        results, sam = self.run_hisat2()
-        # return results
         _hisat2 = self.feature_path / "hisat2" / f"{self.SRR}.parquet"
-        self.check_hisat(results, _hisat2, self.SRR)
-        bam, bai = self.compress_sort_and_index(sam)
-        remove_file(sam.as_posix())
+        if self.stream:
+            results, bam, bai = self.align_sort_and_index()
+            self.check_hisat(results, _hisat2, self.SRR)
+        else:
+            results, sam = self.run_hisat2()
+            # return results
+            self.check_hisat(results, _hisat2, self.SRR)
+            bam, bai = self.compress_sort_and_index(sam)
+            remove_file(sam.as_posix())
+        self.profile.save(self.feature_path / "bam_profile" / f"{self.SRR}.parquet", self.SRR)
         _alnStat = self.feature_path / "aln_stats" / f"{self.SRR}.parquet"
         self.alignment_stats(bam, _alnStat)
         trim_fqs.append(self.r1)
@@ -54,6 +69,15 @@ class Hisat2(object):
         return trim_fqs
 
     def run_hisat2(self):
+        sam = self.Bam_dir / f"{self.SRR}.sam"
+        cmd = self._hisat2_cmd(f"-S {sam}")
+        logger.info(f"{self.SRR} Start Hisat2 alignment")
+        logger.info(f"{cmd}")
+        results = run_command(cmd)
+        logger.info(f"{self.SRR} Complete Hisat2 alignment")
+        return results, sam
+
+    def _hisat2_cmd(self, output_param: str) -> str:
         if self.r2:
             fastqs = f"-1 {self.r1} -2 {self.r2}"
         else:
@@ -73,8 +97,7 @@ class Hisat2(object):
         splice_param = ""
         if self.splice:
             splice_param = f"--known-splicesite-infile {self.splice}"
-        sam = self.Bam_dir / f"{self.SRR}.sam"
-        cmd = (
+        return (
             "hisat2 "
             f"-x {self.reference} "
             f"{fastqs} "
@@ -82,37 +105,57 @@ class Hisat2(object):
             "--max-intronlen 300000 "
             f"{strand_param} "
             f"{splice_param} "
-            f"-S {sam} "
+            f"{output_param} "
         )
+
+    def align_sort_and_index(self) -> Tuple[str, Path, Path]:
+        """Align, filter, sort and index in one pipeline
+
+        hisat2 writes SAM to stdout and its summary to a file, as the log of
+        the pipeline also holds the samtools messages. The filtered reads are
+        passed to samtools sort as uncompressed BAM.
+        """
+        summary = self.Bam_dir / f"{self.SRR}.hisat2.txt"
+        sorted_bam = self.Bam_dir / f"{self.SRR}.sorted.bam"
+        sorted_bai = self.Bam_dir / f"{self.SRR}.sorted.bam.bai"
+        cmd = self._hisat2_cmd(f"--summary-file {summary}") + \
+              f"|samtools view -u -q 20 --threads {self.THREADS} - " \
+              f"|samtools sort {self.profile.sort_options(self.SRR)} --output-fmt BAM " \
+              f" --threads {self.THREADS} -o {sorted_bam} - && " \
+              f"samtools index {sorted_bam}"
         logger.info(f"{self.SRR} Start Hisat2 alignment")
-        logger.info(f"{cmd}")
-        results = run_command(cmd)
+        logger.info(cmd)
+        log = run_command(cmd)
+        if not summary.exists():
+            logger.warning(f"{self.SRR} hisat2 error")
+            logger.error(log)
+            raise Hisat2Exception("hisat2 error")
+        results = summary.read_text()
+        remove_file(summary.as_posix())
+        if "error" in log.lower():
+            logger.warning(f"{self.SRR} samtools error")
+            raise Hisat2Exception("samtools error")
         logger.info(f"{self.SRR} Complete Hisat2 alignment")
-        return results, sam
+        return results, sorted_bam, sorted_bai
 
     def compress_sort_and_index(self, sam: Path) -> Tuple[Path, Path]:
         sorted_bam = self.Bam_dir / f"{self.SRR}.sorted.bam"
         sorted_bai = self.Bam_dir / f"{self.SRR}.sorted.bam.bai"
         cmd = f"samtools view -Sb -q 20 --threads {self.THREADS} {sam} " \
-              f"|samtools sort -l 9 --output-fmt BAM " \
+              f"|samtools sort {self.profile.sort_options(self.SRR)} --output-fmt BAM " \
               f" --threads {self.THREADS} -o {sorted_bam} && " \
               f"samtools index {sorted_bam}"
         logger.info(cmd)
         results = run_command(cmd)
         if "error" in results.lower():
-            logger.warning(f"{self.SRR} samtoots error")
-            raise Exception(f"samtoots error")
+            logger.warning(f"{self.SRR} samtools error")
+            raise Hisat2Exception("samtools error")
         else:
             return sorted_bam, sorted_bai
 
     def alignment_stats(self, bam: Path, output_file: Path):
-        logger.info(f"samtools stats {bam}")
-        result1 = run_command(f"samtools stats {bam}", verbose=False)
-        logger.info(f"bamtools stats -in {bam}")
-        result2 = run_command(f"bamtools stats -in {bam}", verbose=False)
-        # Summarize
-        df = pd.concat([self._samtools(result1), self._bamtools(result2)], axis=1, sort=False)
-        df.index = pd.Index([self.SRR])
+        logger.info(f"{self.SRR} Start alignment stats of {bam}")
+        df = bam_stats(bam, self.SRR, self.THREADS)
         df.to_parquet(output_file)
 
     @staticmethod
@@ -153,23 +196,8 @@ class Hisat2(object):
         per_aligned = df.iloc[0, :]["per_alignment"]
 
         if (per_aligned < 1) | (uniquely_aligned < 1000):
-            raise Exception(f"Poor alignment: {uniquely_aligned:,} ({per_aligned}%)")
+            raise Hisat2Exception(f"Poor alignment: {uniquely_aligned:,} ({per_aligned}%)")
 
-    @staticmethod
-    def _samtools(stats_file: Path) -> pd.DataFrame:
-        return parse_samtools_stats(stats_file)[
-            [
-                "reads_MQ0",
-                "average_quality",
-                "insert_size_average",
-                "insert_size_standard_deviation",
-                "inward_oriented_pairs",
-                "outward_oriented_pairs",
-                "pairs_with_other_orientation",
-                "pairs_on_different_chromosomes",
-            ]
-        ]
 
-    @staticmethod
-    def _bamtools(stats_file: Path) -> pd.DataFrame:
-        return parse_bamtools_stats(stats_file)[["Percent Forward", "Percent Reverse"]]
+class Hisat2Exception(Exception):
+    """Basic exception for problems aligning the reads"""
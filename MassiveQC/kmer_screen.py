@@ -0,0 +1,296 @@
+"""Contamination screen with k-mer indexes of the fastq_screen references
+
+fastq_screen maps a sample of the reads to every reference of its conf file
+with bowtie2. The k-mer screen looks the k-mers of the reads up in a sorted
+array of the k-mers of each reference instead, in the same process. A read
+maps to a reference when enough of its k-mers are found there.
+
+Large references are sketched: only k-mers whose hash is a multiple of a
+power of two `scale` are kept, and only the same k-mers of the reads are
+looked up. The indexes are written once to a cache directory and memory
+mapped by the samples.
+"""
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+from glob import glob
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+from xopen import xopen
+
+from .fastq_chunk import ChunkReader, RecordChunk
+from .parser import remove_file
+from .subset import ReadSubset
+
+logger = logging.getLogger("MassiveQC")
+
+# Odd k, a k-mer is never its own reverse complement
+K = 21
+# References with more k-mers are sketched down to about this number, 1 GB of index
+MAX_INDEX_KMERS = 1 << 27
+# Bases of a reference, and reads of a sample, turned into k-mers at a time
+BLOCK_BASES = 1 << 24
+BLOCK_READS = 50_000
+# A read maps when at least this fraction of its looked up k-mers is found, and at least one
+MIN_HIT_FRACTION = 0.25
+FASTA_SUFFIXES = (".fa", ".fasta", ".fna", ".fa.gz", ".fasta.gz", ".fna.gz")
+# fastq_screen counts, the k-mer screen can not tell one hit from multiple hits in a reference
+COLUMNS = [
+    "reads_processed_count",
+    "unmapped_count",
+    "one_hit_one_library_count",
+    "multiple_hits_one_library_count",
+    "one_hit_multiple_libraries_count",
+    "multiple_hits_multiple_libraries_count",
+]
+
+# 2-bit code of each base, 4 for anything else
+BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate((b"Aa", b"Cc", b"Gg", b"Tt")):
+    BASE_CODE[np.frombuffer(_bases, dtype=np.uint8)] = _code
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def read_conf(config_file: str) -> Dict[str, str]:
+    """Bowtie2 index prefix of each DATABASE of a fastq_screen conf file"""
+    databases = {}
+    with open(config_file) as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == "DATABASE":
+                databases[fields[1]] = fields[2]
+    if not databases:
+        raise KmerScreenException(f"No DATABASE in {config_file}")
+    return databases
+
+
+def kmers(codes: np.ndarray) -> np.ndarray:
+    """Canonical k-mers of the 2-bit `codes`, except those covering a code 4"""
+    n = len(codes) - K + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    for j in range(K):
+        code = (codes[j:j + n] & 3).astype(np.uint64)
+        forward = (forward << np.uint64(2)) | code
+        reverse |= (np.uint64(3) - code) << np.uint64(2 * j)
+    bad = np.concatenate([[0], np.cumsum(codes >= 4, dtype=np.int64)])
+    valid = bad[K:] == bad[:n]
+    return np.minimum(forward, reverse)[valid]
+
+
+def _hash(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, spreads k-mers evenly over the sketch"""
+    x = values ^ (values >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def sampled(values: np.ndarray, scale: int) -> np.ndarray:
+    """Mask of the k-mers kept in a sketch of `scale`"""
+    if scale == 1:
+        return np.ones(len(values), dtype=bool)
+    return (_hash(values) & np.uint64(scale - 1)) == 0
+
+
+def reference_sequences(prefix: str) -> Iterator[bytes]:
+    """Sequences of a reference, from a FASTA file next to the bowtie2 index or from the index"""
+    fasta = next((prefix + suffix for suffix in FASTA_SUFFIXES if os.path.exists(prefix + suffix)), None)
+    if fasta is not None:
+        with xopen(fasta, "rb") as fh:
+            yield from _fasta_sequences(fh)
+        return
+    with subprocess.Popen(["bowtie2-inspect", prefix], stdout=subprocess.PIPE) as process:
+        yield from _fasta_sequences(process.stdout)
+    if process.returncode != 0:
+        raise KmerScreenException(f"bowtie2-inspect {prefix} exited with status {process.returncode}")
+
+
+def _fasta_sequences(fh) -> Iterator[bytes]:
+    lines = []
+    for line in fh:
+        if line.startswith(b">"):
+            if lines:
+                yield b"".join(lines)
+            lines = []
+        else:
+            lines.append(line.rstrip())
+    if lines:
+        yield b"".join(lines)
+
+
+def build_index(prefix: str, max_kmers: int = MAX_INDEX_KMERS) -> Tuple[np.ndarray, int]:
+    """Sorted unique k-mers of a reference, and the scale of the sketch
+
+    The scale doubles whenever more than `max_kmers` k-mers are kept.
+    """
+    scale = 1
+    index = np.empty(0, dtype=np.uint64)
+    pending, n_pending = [], 0
+    for sequence in reference_sequences(prefix):
+        codes = BASE_CODE[np.frombuffer(sequence, dtype=np.uint8)]
+        for start in range(0, max(len(codes) - K + 1, 1), BLOCK_BASES):
+            block = kmers(codes[start:start + BLOCK_BASES + K - 1])
+            block = np.unique(block[sampled(block, scale)])
+            pending.append(block)
+            n_pending += len(block)
+            if n_pending > max_kmers:
+                index, scale = _merge(index, pending, scale, max_kmers)
+                pending, n_pending = [], 0
+    return _merge(index, pending, scale, max_kmers)
+
+
+def _merge(index: np.ndarray, pending: List[np.ndarray], scale: int, max_kmers: int) -> Tuple[np.ndarray, int]:
+    index = np.unique(np.concatenate([index] + pending))
+    index = index[sampled(index, scale)]
+    while len(index) > max_kmers:
+        scale *= 2
+        index = index[sampled(index, scale)]
+    return index, scale
+
+
+def load_index(name: str, prefix: str, cache_dir: str) -> Tuple[np.ndarray, int]:
+    """Memory mapped k-mer index of a reference, built when it is not cached yet"""
+    with _lock:
+        stem = Path(cache_dir) / f"{name}.{_index_key(prefix)}.k{K}"
+        if stem in _indexes:
+            return _indexes[stem]
+        cached = glob(f"{stem}.s*.npy")
+        if not cached:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            logger.info(f"Build the k-mer index of {name} from {prefix}")
+            index, scale = build_index(prefix)
+            tmp = Path(f"{stem}.{os.getpid()}.tmp.npy")
+            try:
+                np.save(tmp, index)
+            except Exception:
+                remove_file(tmp.as_posix())
+                raise
+            # Other processes of the same run see a whole file or none
+            tmp.replace(f"{stem}.s{scale}.npy")
+            cached = [f"{stem}.s{scale}.npy"]
+            logger.info(f"{name} k-mer index has {len(index):,} k-mers, 1 in {scale} is kept")
+        scale = int(cached[0].rsplit(".s", 1)[1][:-len(".npy")])
+        _indexes[stem] = (np.load(cached[0], mmap_mode="r"), scale)
+        return _indexes[stem]
+
+
+def _index_key(prefix: str) -> str:
+    """Checksum of the paths, sizes and times of the reference files"""
+    digest = hashlib.sha1(os.path.abspath(prefix).encode())
+    for path in sorted(glob(f"{prefix}*")):
+        stat = os.stat(path)
+        digest.update(f"{path}\t{stat.st_size}\t{stat.st_mtime}".encode())
+    return digest.hexdigest()[:16]
+
+
+def read_kmers(chunk: RecordChunk) -> Tuple[np.ndarray, np.ndarray]:
+    """Canonical k-mers of the reads of a chunk and the read of each k-mer"""
+    seq_starts, seq_ends = chunk.starts[1::4], chunk.ends[1::4]
+    lengths = seq_ends - seq_starts
+    # Sequences one after the other, each followed by a code 4 separator
+    offsets = np.concatenate([[0], np.cumsum(lengths + 1)])
+    positions = np.repeat(seq_starts - offsets[:-1], lengths + 1) + np.arange(offsets[-1])
+    codes = BASE_CODE[np.frombuffer(chunk.buf, dtype=np.uint8)[np.minimum(positions, len(chunk.buf) - 1)]]
+    codes[offsets[1:] - 1] = 4
+    n = len(codes) - K + 1
+    values = kmers(codes)
+    if n <= 0:
+        return values, np.empty(0, dtype=np.int64)
+    bad = np.concatenate([[0], np.cumsum(codes >= 4, dtype=np.int64)])
+    windows = np.flatnonzero(bad[K:] == bad[:n])
+    return values, np.searchsorted(offsets, windows, side="right") - 1
+
+
+def screen_reads(chunk: RecordChunk, indexes: Dict[str, Tuple[np.ndarray, int]]) -> np.ndarray:
+    """Whether each read of the chunk maps to each reference, one column per reference"""
+    values, reads = read_kmers(chunk)
+    n_reads = chunk.n_records
+    mapped = np.zeros((n_reads, len(indexes)), dtype=bool)
+    for column, (index, scale) in enumerate(indexes.values()):
+        keep = sampled(values, scale)
+        query, query_reads = values[keep], reads[keep]
+        if len(index) == 0 or len(query) == 0:
+            continue
+        found = index[np.minimum(np.searchsorted(index, query), len(index) - 1)] == query
+        looked_up = np.bincount(query_reads, minlength=n_reads)
+        hits = np.bincount(query_reads[found], minlength=n_reads)
+        mapped[:, column] = (hits > 0) & (hits >= MIN_HIT_FRACTION * looked_up)
+    return mapped
+
+
+def sample_reads(fastq: str, n_reads: int) -> Iterator[RecordChunk]:
+    """Chunks of `n_reads` reads drawn from `fastq`, of all of them if 0"""
+    with xopen(fastq, "rb") as fh:
+        reader = ChunkReader(fh)
+        if not n_reads:
+            while True:
+                chunk = reader.read(BLOCK_READS)
+                if chunk is None:
+                    return
+                yield chunk
+        subset = ReadSubset(n_reads)
+        for chunk in reader:
+            subset.add(chunk.buf)
+    for start in range(0, len(subset.reads), BLOCK_READS):
+        yield RecordChunk.from_bytes(b"".join(subset.reads[start:start + BLOCK_READS]))
+
+
+def kmer_screen(config_file: str, fastq: str, cache_dir: str, n_reads: int = 0) -> pd.DataFrame:
+    """Screen the reads of `fastq` against the references of a fastq_screen conf file
+
+    **parameter**
+
+    config_file: str
+        fastq_screen conf file, its DATABASE lines give the references.
+
+    fastq: str
+        The reads to screen.
+
+    cache_dir: str
+        Directory of the k-mer indexes.
+
+    n_reads: int
+        Number of reads drawn from `fastq`, all of them if 0.
+
+    **return**
+
+    counts: DataFrame
+        The counts of fastq_screen for each reference.
+    """
+    indexes = {
+        name: load_index(name, prefix, cache_dir) for name, prefix in read_conf(config_file).items()
+    }
+    n_processed = 0
+    one_library = np.zeros(len(indexes), dtype=np.int64)
+    multiple_libraries = np.zeros(len(indexes), dtype=np.int64)
+    for chunk in sample_reads(fastq, n_reads):
+        mapped = screen_reads(chunk, indexes)
+        single = mapped.sum(axis=1) == 1
+        one_library += mapped[single].sum(axis=0)
+        multiple_libraries += mapped[~single].sum(axis=0)
+        n_processed += chunk.n_records
+    if n_processed == 0:
+        raise KmerScreenException(f"No reads in {fastq}")
+    return pd.DataFrame({
+        "reads_processed_count": n_processed,
+        "unmapped_count": n_processed - one_library - multiple_libraries,
+        "one_hit_one_library_count": one_library,
+        "multiple_hits_one_library_count": 0,
+        "one_hit_multiple_libraries_count": multiple_libraries,
+        "multiple_hits_multiple_libraries_count": 0,
+    }, index=pd.Index(list(indexes), name="reference"))[COLUMNS]
+
+
+class KmerScreenException(Exception):
+    """Basic exception for problems with the k-mer screen"""
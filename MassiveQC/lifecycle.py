@@ -0,0 +1,170 @@
+"""Intermediate files of the samples in progress, the disk they take and when they are removed
+
+Each intermediate, like the downloaded reads or the sorted BAM, is written by
+a stage and read by the stages after it. Its size is taken relative to the
+downloaded fastq files of the sample. The disk a sample still needs is the
+largest total of the intermediates present during one of its remaining
+stages, a new sample starts only when it fits in the disk budget. An
+intermediate is removed as soon as the last stage reading it is done, if it
+is not one the run keeps.
+"""
+import logging
+from collections import namedtuple
+from pathlib import Path
+from typing import List, Optional
+
+from .parser import remove_file
+
+logger = logging.getLogger("MassiveQC")
+
+GB = 1024 ** 3
+
+# An intermediate written by `producer` and read by the `consumers` stages. `ratio` is its size
+# relative to the downloaded reads, `paths` its files with {SRR}, and `remove` whether it is
+# removed once its consumers are done.
+Intermediate = namedtuple("Intermediate", ["name", "producer", "consumers", "ratio", "paths", "remove"])
+
+
+def intermediates(config) -> List[Intermediate]:
+    """The intermediates of a run with the settings of `config`, a RunConfig
+
+    The checked reads are recompressed, the SAM file holds the reads
+    uncompressed, the other files are about the size of the download.
+    """
+    download, QC_dir, Bam_dir = Path(config.download_path), Path(config.QC_dir), Path(config.Bam_dir)
+
+    def reads(directory, suffix):
+        return [(directory / f"{{SRR}}{mate}{suffix}").as_posix() for mate in ("", "_1", "_2")]
+
+    files = [
+        Intermediate("raw", "download", ["check_fq"], 1.0, reads(download, ".fastq.gz"), config.remove_fastq),
+    ]
+    if config.fuse_atropos:
+        # check_fq writes the trimmed reads
+        trimmed_producer = "check_fq"
+    else:
+        trimmed_producer = "atropos"
+        files.append(Intermediate("checked", "check_fq", ["fastq_screen", "atropos"], 1.0,
+                                  reads(QC_dir, ".fastq.gz"), True))
+    files.append(Intermediate("trimmed", trimmed_producer, ["fastq_screen", "hisat2"], 1.0,
+                              reads(QC_dir, ".trim.fastq.gz"), config.remove_fastq))
+    if not config.stream_alignment:
+        files.append(Intermediate("sam", "hisat2", ["hisat2"], 4.0, [(Bam_dir / "{SRR}.sam").as_posix()], True))
+    files.append(Intermediate("bam", "hisat2", ["strand", "collectrnaseqmetrics", "markduplicates", "FeatureCounts"],
+                              1.0, [(Bam_dir / "{SRR}.sorted.bam").as_posix(),
+                                    (Bam_dir / "{SRR}.sorted.bam.bai").as_posix()], config.remove_bam))
+    return files
+
+
+class Lifecycle:
+    """Count the stages reading each intermediate and the disk the samples in progress need
+
+    **parameter**
+
+    config: RunConfig
+        Settings of the run.
+
+    stages: list
+        The stages of a sample, in the order they run.
+
+    disk_budget: float or None
+        GB the samples in progress may take, no limit if None.
+    """
+    def __init__(self, config, stages: List[str], disk_budget: Optional[float] = None):
+        self.stages = list(stages)
+        self.intermediates = intermediates(config)
+        self.budget = disk_budget * GB if disk_budget else None
+        # Before a first download is measured, a sample is assumed to take the whole budget
+        self.default = self.budget or 0
+        self._admitted = set()
+        self._done = {}
+        self._download_size = {}
+        # Downloads measured in this run, for the samples not downloaded yet
+        self._measured = []
+
+    def admits(self, SRR: str, force: bool = False) -> bool:
+        """Whether the sample fits in what is left of the disk budget, it is then in progress until `sample_end`
+
+        With `force` the sample is admitted anyway, when no other sample runs.
+        """
+        if SRR in self._admitted:
+            return True
+        if SRR not in self._download_size:
+            # Reads downloaded by an earlier run, measured once
+            self._set_size(SRR)
+        if self.budget is not None and not force:
+            in_use = self.in_use()
+            if in_use + self.footprint(SRR) > self.budget:
+                logger.info(f"{SRR} waits for disk, {in_use / GB:.1f} GB of {self.budget / GB:.1f} GB are taken")
+                return False
+        self._admitted.add(SRR)
+        return True
+
+    def in_use(self) -> float:
+        """Bytes the samples in progress take at most"""
+        return sum(self.footprint(SRR) for SRR in self._admitted)
+
+    def footprint(self, SRR: str) -> float:
+        """Bytes the intermediates of the sample take at most during its remaining stages"""
+        size = self._download_size.get(SRR)
+        if size is None:
+            if not self._measured:
+                return self.default
+            size = sum(self._measured) / len(self._measured)
+        done = self._done.get(SRR, set())
+        peak = 0.0
+        for at, stage in enumerate(self.stages):
+            if stage not in done:
+                peak = max(peak, sum(file.ratio for file in self.intermediates if self._present(file, at, done)))
+        return peak * size
+
+    def stage_done(self, SRR: str, stage: str) -> None:
+        """Remove the intermediates of the sample that no remaining stage reads"""
+        done = self._done.setdefault(SRR, set())
+        done.add(stage)
+        if self._download_size.get(SRR) is None:
+            self._set_size(SRR)
+        for file in self.intermediates:
+            if file.remove and stage in file.consumers and all(consumer in done for consumer in file.consumers):
+                self._remove(SRR, file)
+
+    def sample_end(self, SRR: str, rejected: bool = False) -> None:
+        """The sample is no longer in progress, its intermediates are removed when it was rejected for its data
+
+        The intermediates of a sample that failed otherwise are kept for the next run.
+        """
+        if rejected:
+            for file in self.intermediates:
+                if file.remove:
+                    self._remove(SRR, file)
+        self._admitted.discard(SRR)
+        self._done.pop(SRR, None)
+        self._download_size.pop(SRR, None)
+
+    def _set_size(self, SRR: str) -> None:
+        size = self._download_size[SRR] = self._measure(SRR)
+        if size is not None:
+            self._measured.append(size)
+
+    def _present(self, file: Intermediate, at: int, done: set) -> bool:
+        """Whether the intermediate is on the disk during the `at`th stage"""
+        produced = file.producer not in self.stages or self.stages.index(file.producer) <= at
+        read_later = any(consumer not in done and consumer in self.stages and self.stages.index(consumer) >= at
+                         for consumer in file.consumers)
+        return produced and (read_later or not file.remove)
+
+    def _measure(self, SRR: str) -> Optional[float]:
+        """Size of the downloaded reads, from the first intermediate on the disk"""
+        for file in self.intermediates:
+            paths = [Path(path.format(SRR=SRR)) for path in file.paths]
+            sizes = [path.stat().st_size for path in paths if path.exists()]
+            if sizes:
+                return sum(sizes) / file.ratio
+        return None
+
+    def _remove(self, SRR: str, file: Intermediate) -> None:
+        for path in file.paths:
+            path = path.format(SRR=SRR)
+            if Path(path).exists():
+                logger.info(f"Remove {path}")
+                remove_file(path)
@@ -1,18 +1,37 @@
 import logging
 from pathlib import Path
 import pandas as pd
-from .command import run_command
+from .duplicates import duplicate_metrics
 from typing import Optional
 from .parser import parse_picard_markduplicate_metrics, remove_file
+from .picard_worker import run_picard
 import numpy as np
 
 logger = logging.getLogger("MassiveQC")
 
 
+ENGINES = ["picard", "stream", "validate"]
+DTYPES = {
+    "UNPAIRED_READS_EXAMINED": np.int64,
+    "READ_PAIRS_EXAMINED": np.int64,
+    "UNPAIRED_READ_DUPLICATES": np.int64,
+    "READ_PAIR_DUPLICATES": np.int64,
+    "PERCENT_DUPLICATION": np.float64,
+    "ESTIMATED_LIBRARY_SIZE": np.int64,
+}
+
+
 class MarkDuplicates(object):
-    """run picard MarkDuplicates and extract the result"""
+    """run picard MarkDuplicates and extract the result
+
+    engine: str
+        "picard" runs MarkDuplicates, which writes a deduplicated BAM only
+        to read its metrics. "stream" counts the duplicates from the sorted
+        BAM without writing anything. "validate" runs both, logs the
+        metrics that differ and keeps the Picard ones.
+    """
     def __init__(self, feature_path: str, SRR: str, Bam_dir: str,
-                 THREADS: int, picard: str, MEM: Optional[int] = 3):
+                 THREADS: int, picard: str, MEM: Optional[int] = 3, engine: str = "picard"):
         self.feature_path = Path(feature_path)
         self.layout = Path(feature_path) / f"{SRR}.parquet"
         self.SRR = SRR
@@ -20,44 +39,60 @@ class MarkDuplicates(object):
         self.THREADS = THREADS
         self.MEM = MEM
         self.picard = picard
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown duplicate engine {engine}, use one of {ENGINES}")
+        self.engine = engine
 
     def markduplicates(self):
         bam = self.Bam_dir / f"{self.SRR}.sorted.bam"
+        if self.engine == "stream":
+            logger.info(f"{self.SRR} Start counting duplicates")
+            self.save(duplicate_metrics(bam, self.THREADS))
+        elif self.engine == "validate":
+            self.save(self.validate(bam))
+        else:
+            metrics = self.run_markduplicates(bam)
+            self.summarize(metrics)
+
+    def validate(self, bam: Path) -> pd.DataFrame:
+        """Compare the streamed metrics of `bam` with Picard's and return Picard's"""
         metrics = self.run_markduplicates(bam)
-        self.summarize(metrics)
+        picard = parse_picard_markduplicate_metrics(metrics)[DTYPES.keys()].reset_index(drop=True)
+        remove_file(metrics.as_posix())
+        stream = duplicate_metrics(bam, self.THREADS)
+        differ = [col for col in DTYPES if not _same_value(picard[col].iloc[0], stream[col].iloc[0])]
+        if differ:
+            detail = ", ".join(f"{col} picard={picard[col].iloc[0]} stream={stream[col].iloc[0]}" for col in differ)
+            logger.warning(f"{self.SRR} duplicate metrics differ: {detail}")
+        else:
+            logger.info(f"{self.SRR} duplicate metrics match Picard")
+        return picard
 
     def run_markduplicates(self, bam: Path):
         dedup_bam = self.Bam_dir / f"{self.SRR}.dedup.bam"
         metrics = self.feature_path / f"{self.SRR}.metrics"
-        cmd = (
-            f"java -Xmx{self.MEM}g "
-            f"-jar {self.picard} MarkDuplicates "
-            f"INPUT={bam} "
-            f"OUTPUT={dedup_bam} "
-            f"METRICS_FILE={metrics}"
-        )
-        logger.info(f"{cmd}")
+        args = [
+            f"INPUT={bam}",
+            f"OUTPUT={dedup_bam}",
+            f"METRICS_FILE={metrics}",
+        ]
         logger.info(f"{self.SRR} Start markduplicates")
-        _result = run_command(cmd)
+        _result = run_picard(self.picard, "MarkDuplicates", args, self.MEM)
         self._check_log(_result, self.SRR)
         remove_file(dedup_bam.as_posix())
         return metrics
 
     def summarize(self, metrics: Path):
-        dtypes = {
-            "UNPAIRED_READS_EXAMINED": np.int64,
-            "READ_PAIRS_EXAMINED": np.int64,
-            "UNPAIRED_READ_DUPLICATES": np.int64,
-            "READ_PAIR_DUPLICATES": np.int64,
-            "PERCENT_DUPLICATION": np.float64,
-            "ESTIMATED_LIBRARY_SIZE": np.int64,
-        }
-        df = parse_picard_markduplicate_metrics(metrics)[dtypes.keys()].fillna(0).astype(dtypes)
+        df = parse_picard_markduplicate_metrics(metrics)
+        remove_file(metrics.as_posix())
+        self.save(df)
+
+    def save(self, metrics: pd.DataFrame):
+        df = metrics[DTYPES.keys()].fillna(0).astype(DTYPES)
         df.PERCENT_DUPLICATION = df.PERCENT_DUPLICATION * 100
         df.columns = [col.lower() for col in df.columns]
         df.index = pd.Index([self.SRR], name="srr")
         output_file = self.feature_path / "markduplicates" / f"{self.SRR}.parquet"
-        remove_file(metrics.as_posix())
         df.to_parquet(output_file)
 
     @staticmethod
@@ -66,5 +101,12 @@ class MarkDuplicates(object):
             raise PicardException(f"{SRR} not complete")
 
 
+def _same_value(picard, stream) -> bool:
+    """Missing values match each other, Picard prints fractions with 6 digits"""
+    if pd.isna(picard) or pd.isna(stream):
+        return pd.isna(picard) and pd.isna(stream)
+    return abs(float(picard) - float(stream)) < 1e-6
+
+
 class PicardException(Exception):
     """Picard Processing Exception"""
@@ -0,0 +1,209 @@
+"""Long-lived Picard JVM shared by the samples of a run
+
+Every `java -jar picard.jar` call pays the JVM startup and class loading.
+The worker is a single JVM that runs Picard tools sent over its stdin, the
+jobs of different threads run concurrently in it. When the worker can not
+start or crashes, the tools run with one-shot `java -jar` calls.
+"""
+import itertools
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+from .command import run_command
+
+logger = logging.getLogger("MassiveQC")
+
+# Runs with the source-file mode of Java 11 and later, so nothing is compiled.
+# Tool output goes to stderr, stdout only carries "<job id>\t<exit status>".
+WORKER_SOURCE = """\
+import java.io.*;
+import java.nio.charset.StandardCharsets;
+import java.util.Arrays;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import picard.cmdline.PicardCommandLine;
+
+public class PicardWorker {
+    public static void main(String[] args) throws IOException {
+        final PrintStream replies = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+        final ExecutorService pool = Executors.newCachedThreadPool();
+        final BufferedReader jobs = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        replies.println("READY");
+        String line;
+        while ((line = jobs.readLine()) != null) {
+            final String[] fields = line.split("\\t");
+            pool.submit(() -> {
+                int status;
+                try {
+                    status = new PicardCommandLine().instanceMain(Arrays.copyOfRange(fields, 1, fields.length));
+                } catch (Throwable t) {
+                    t.printStackTrace();
+                    status = 1;
+                }
+                synchronized (replies) {
+                    replies.println(fields[0] + "\\t" + status);
+                }
+            });
+        }
+        pool.shutdown();
+    }
+}
+"""
+
+# Picard tools a sample runs at the same time, CollectRnaSeqMetrics and MarkDuplicates
+JOBS_PER_SAMPLE = 2
+
+_worker = None
+
+
+class PicardWorker:
+    """A JVM running Picard jobs sent as tab separated lines
+
+    **parameter**
+
+    picard: str
+        Path to picard.jar.
+
+    MEM: int
+        Heap of the JVM in GB, shared by the concurrent jobs.
+
+    log_file: str or None
+        File receiving the output of the tools.
+    """
+    def __init__(self, picard: str, MEM: int, log_file: Optional[str] = None):
+        self.picard = picard
+        self.MEM = MEM
+        self.log_file = log_file
+        self.process = None
+        self._source_dir = None
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reader = None
+        self._crashed = False
+
+    def start(self) -> None:
+        self._source_dir = tempfile.mkdtemp(prefix="picard_worker.")
+        source = Path(self._source_dir) / "PicardWorker.java"
+        source.write_text(WORKER_SOURCE)
+        stderr = open(self.log_file, "ab") if self.log_file else subprocess.DEVNULL
+        cmd = ["java", f"-Xmx{self.MEM}g", "-cp", self.picard, source.as_posix()]
+        try:
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        except OSError as error:
+            raise PicardWorkerException(f"Unable to run java: {error}")
+        finally:
+            if self.log_file:
+                stderr.close()
+        if self.process.stdout.readline().strip() != b"READY":
+            self.close()
+            raise PicardWorkerException("Picard worker did not start, it needs Java 11 or later")
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+        logger.info(f"Picard worker started, pid {self.process.pid}")
+
+    def run(self, args: List[str]) -> int:
+        """Run a Picard tool with its `args` and wait for its exit status"""
+        job = [threading.Event(), None]
+        with self._lock:
+            if self._crashed or not self.alive():
+                raise PicardWorkerException("Picard worker is not running")
+            job_id = str(next(self._ids))
+            self._pending[job_id] = job
+            try:
+                self.process.stdin.write(("\t".join([job_id] + args) + "\n").encode())
+                self.process.stdin.flush()
+            except OSError:
+                del self._pending[job_id]
+                raise PicardWorkerException("Picard worker crashed")
+        job[0].wait()
+        if job[1] is None:
+            raise PicardWorkerException("Picard worker crashed")
+        return job[1]
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def _read_replies(self) -> None:
+        for line in self.process.stdout:
+            job_id, status = line.decode().rstrip("\n").split("\t")
+            with self._lock:
+                job = self._pending.pop(job_id)
+            job[1] = int(status)
+            job[0].set()
+        # The JVM is gone, release the jobs it did not answer
+        with self._lock:
+            self._crashed = True
+            for job in self._pending.values():
+                job[0].set()
+            self._pending = {}
+
+    def close(self) -> None:
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._source_dir:
+            shutil.rmtree(self._source_dir, ignore_errors=True)
+
+
+def start_worker(picard: str, MEM: int, log_file: Optional[str] = None) -> Optional[PicardWorker]:
+    """Start the shared worker, Picard runs one-shot if it fails"""
+    global _worker
+    worker = PicardWorker(picard, MEM, log_file)
+    try:
+        worker.start()
+    except PicardWorkerException as error:
+        logger.warning(f"{error}, running Picard with java -jar")
+        return None
+    _worker = worker
+    return worker
+
+
+def stop_worker() -> None:
+    global _worker
+    if _worker is not None:
+        _worker.close()
+        _worker = None
+
+
+def run_picard(picard: str, tool: str, args: List[str], MEM: int) -> str:
+    """Run a Picard tool on the shared worker, or with java -jar without one
+
+    **return**
+
+    log: str
+        The log of the one-shot run. Jobs of the worker only log whether the
+        tool is done, so the check of the one-shot log applies to both. Jobs
+        failing in the worker are run again with java -jar.
+    """
+    worker = _worker
+    if worker is not None:
+        try:
+            status = worker.run([tool] + args)
+        except PicardWorkerException as error:
+            logger.warning(f"{error}, running {tool} with java -jar")
+        else:
+            if status == 0:
+                return f"{tool} done"
+            # The one-shot run gives the log of the failure
+            logger.warning(f"{tool} exited with status {status} in the Picard worker, running it with java -jar")
+    cmd = f"java -Xmx{MEM}g -jar {picard} {tool} " + " ".join(args)
+    logger.info(cmd)
+    return run_command(cmd)
+
+
+class PicardWorkerException(Exception):
+    """Basic exception for problems with the Picard worker"""
@@ -0,0 +1,153 @@
+"""Quick look at downloaded FASTQs to reject hopeless samples before the full check"""
+import logging
+import os
+import zlib
+from collections import namedtuple
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .fastq import Fastq, _chunk_read, check_single_end_chunk
+from .fastq_chunk import RecordChunk
+
+logger = logging.getLogger("MassiveQC")
+
+HEAD_BYTES = 4 * 1024 * 1024
+FEED_BYTES = 16 * 1024
+# Uncompressed files are also sampled in blocks spread over the file
+N_BLOCKS = 8
+BLOCK_BYTES = 256 * 1024
+# Only samples estimated to have less than MIN_READS / MARGIN valid reads are
+# rejected, the estimate is rough and the full check decides the rest.
+MIN_READS = 100_000
+MARGIN = 2
+
+Sample = namedtuple("Sample", "n_records,valid,est_records,exact,abi")
+
+
+def prescreen_fastq(r1: str, r2: Optional[str] = None) -> Optional[str]:
+    """Find samples check_fq would reject from a small part of their files
+
+    Looks at the first records of each file, and for uncompressed files also
+    at blocks spread over the file, to find ABI SOLiD colorspace and
+    libraries far below 100,000 valid reads. The number of reads of a gzip
+    file is extrapolated from the compressed size of its first records.
+
+    **parameter**
+
+    r1: str
+        The first fastq file
+
+    r2: str or None
+        The second fastq file
+
+    **return**
+
+    reason: str or None
+        "abi_solid" or "small_library", None if the sample needs the full
+        check.
+    """
+    fastqs = [fq for fq in (r1, r2) if fq is not None and not Fastq._is_empty(fq)]
+    try:
+        samples = [sample_fastq(fq) for fq in fastqs]
+    except (OSError, EOFError, zlib.error) as error:
+        logger.warning(f"Pre-screen could not read the fastq files: {error}")
+        return None
+    if any(sample.abi for sample in samples):
+        return "abi_solid"
+    if not samples:
+        # Small files are cheap to check in full
+        return None
+    # A broken pair-end sample falls back to its better mate
+    est_valid = max(estimate_valid(sample) for sample in samples)
+    logger.info(f"Pre-screen estimates {est_valid:,.0f} valid reads")
+    if est_valid < MIN_READS / MARGIN:
+        return "small_library"
+    return None
+
+
+def estimate_valid(sample: Sample) -> float:
+    """Number of valid reads expected in the whole file"""
+    if sample.n_records == 0:
+        return 0.0
+    if sample.exact:
+        return float(sample.valid)
+    return sample.est_records * sample.valid / sample.n_records
+
+
+def sample_fastq(fastq: str) -> Sample:
+    """Check the records of the sampled parts of a fastq file"""
+    file_size = os.stat(fastq).st_size
+    if fastq.endswith(".gz"):
+        head, consumed, eof = _read_gzip_head(fastq, HEAD_BYTES)
+        blocks = []
+    else:
+        with open(fastq, "rb") as fh:
+            head = fh.read(HEAD_BYTES)
+            eof = fh.read(1) == b""
+            blocks = [] if eof else _read_blocks(fh, file_size)
+        consumed = len(head)
+
+    chunk = _whole_records(head)
+    if chunk.n_records == 0:
+        return Sample(0, 0, 0.0, eof, False)
+    abi = Fastq._is_abi_read(_chunk_read(chunk, 0))
+
+    n_records, valid = 0, 0
+    for sampled in [chunk] + blocks:
+        n_records += sampled.n_records
+        valid += int(check_single_end_chunk(sampled).libsize)
+
+    # Bytes a record takes in the file, compressed or not
+    record_size = consumed / len(head) * len(chunk.to_bytes()) / chunk.n_records
+    return Sample(n_records, valid, file_size / record_size, eof, abi)
+
+
+def _read_gzip_head(fastq: str, n_bytes: int) -> Tuple[bytes, int, bool]:
+    """Decompress the start of a gzip file
+
+    Returns at least `n_bytes` of data unless the file is shorter, the number
+    of compressed bytes read for it and whether the whole file was read.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    data, size, consumed = [], 0, 0
+    with open(fastq, "rb") as fh:
+        while size < n_bytes:
+            block = fh.read(FEED_BYTES)
+            if not block:
+                return b"".join(data), consumed, True
+            consumed += len(block)
+            while block:
+                out = decompressor.decompress(block)
+                data.append(out)
+                size += len(out)
+                if not decompressor.eof:
+                    break
+                # Files written by pigz or bgzip hold several gzip members
+                block = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    return b"".join(data), consumed, False
+
+
+def _read_blocks(fh, file_size: int) -> list:
+    """Read whole records from blocks spread over an uncompressed file"""
+    blocks = []
+    for k in range(1, N_BLOCKS + 1):
+        fh.seek(file_size * k // (N_BLOCKS + 1))
+        lines = fh.read(BLOCK_BYTES).split(b"\n")
+        # The first line is likely partial. A record starts at a header line
+        # that is followed by a sequence and a "+" line.
+        for start in range(1, len(lines) - 2):
+            if lines[start].startswith(b"@") and lines[start + 2].startswith(b"+"):
+                blocks.append(_whole_records(b"\n".join(lines[start:])))
+                break
+    return blocks
+
+
+def _whole_records(data: bytes) -> RecordChunk:
+    """Index the complete records at the start of `data`"""
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+    n_full = len(newlines) // 4
+    if n_full == 0:
+        return RecordChunk.from_bytes(b"")
+    return RecordChunk.from_bytes(data[:newlines[4 * n_full - 1] + 1])
@@ -0,0 +1,161 @@
+"""Read-level QC statistics collected while check_fq validates the reads
+
+The statistics are stored in a long table with one row per value, indexed by
+srr. Per cycle and histogram metrics use `position` for the cycle (0-based),
+the read length or the GC percent. Summary metrics have position 0.
+"""
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .fastq_chunk import RecordChunk
+
+# Valid quality bytes are below 127, cycles after MAX_CYCLES are only counted
+# in the read length histogram.
+QUAL_RANGE = 128
+MAX_CYCLES = 1000
+GC_BINS = 101
+# Decoded reads are added in batches
+BATCH_SIZE = 4096
+QUANTILES = {
+    "quality_q10": 0.1,
+    "quality_q25": 0.25,
+    "quality_median": 0.5,
+    "quality_q75": 0.75,
+    "quality_q90": 0.9,
+}
+
+
+class ReadStats:
+    """Array-backed accumulators of the accepted reads
+
+    Keeps the read length histogram, the GC content histogram, the quality
+    histogram of every cycle and the number of N of every cycle. Accumulators
+    of different chunks or processes are combined with `merge`.
+    """
+    def __init__(self):
+        self.length_hist = np.zeros(1, dtype=np.int64)
+        self.gc_hist = np.zeros(GC_BINS, dtype=np.int64)
+        self.qual_hist = np.zeros((0, QUAL_RANGE), dtype=np.int64)
+        self.n_count = np.zeros(0, dtype=np.int64)
+        self._pending = []
+
+    def add_records(self, chunk: RecordChunk, mask: np.ndarray):
+        """Add the records of a chunk selected by `mask` from their raw bytes"""
+        if not mask.any():
+            return
+        arr = np.frombuffer(chunk.buf, dtype=np.uint8)
+        self._add(arr, chunk.starts[1::4][mask], chunk.starts[3::4][mask], chunk.seq_len()[mask])
+
+    def add_read(self, read):
+        """Add a decoded read, reads are kept until a batch is full"""
+        self._pending.append(read)
+        if len(self._pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        seqs = [read.seq.encode("ascii") for read in self._pending]
+        quals = [read.qual.encode("ascii") for read in self._pending]
+        self._pending = []
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        arr = np.frombuffer(b"".join(seqs) + b"".join(quals), dtype=np.uint8)
+        self._add(arr, starts, starts + lengths.sum(), lengths)
+
+    def merge(self, other: Optional["ReadStats"]):
+        """Add the counts of another accumulator"""
+        if other is None:
+            return
+        self.flush()
+        other.flush()
+        self._grow(len(other.length_hist) - 1)
+        self.length_hist[:len(other.length_hist)] += other.length_hist
+        self.gc_hist += other.gc_hist
+        self.qual_hist[:len(other.qual_hist)] += other.qual_hist
+        self.n_count[:len(other.n_count)] += other.n_count
+
+    def _grow(self, max_len: int):
+        if max_len >= len(self.length_hist):
+            self.length_hist = np.pad(self.length_hist, (0, max_len + 1 - len(self.length_hist)))
+        cycles = min(max_len, MAX_CYCLES)
+        if cycles > len(self.qual_hist):
+            self.qual_hist = np.pad(self.qual_hist, ((0, cycles - len(self.qual_hist)), (0, 0)))
+            self.n_count = np.pad(self.n_count, (0, cycles - len(self.n_count)))
+
+    def _add(self, arr: np.ndarray, seq_starts: np.ndarray, qual_starts: np.ndarray, lengths: np.ndarray):
+        """Add reads whose sequence and quality start at the given offsets of `arr`"""
+        if len(lengths) == 0:
+            return
+        lengths = lengths.astype(np.int64)
+        self._grow(int(lengths.max()))
+        counts = np.bincount(lengths)
+        self.length_hist[:len(counts)] += counts
+        total = int(lengths.sum())
+        if total == 0:
+            return
+
+        # Cycle of every base of every read
+        offsets = np.cumsum(lengths) - lengths
+        cycle = np.arange(total) - np.repeat(offsets, lengths)
+        base = arr[np.repeat(seq_starts, lengths) + cycle] & 0xDF  # upper case
+        qual = arr[np.repeat(qual_starts, lengths) + cycle]
+
+        filled = lengths > 0
+        gc = np.add.reduceat((base == ord("G")) | (base == ord("C")), offsets[filled], dtype=np.int64)
+        gc_pct = np.rint(100 * gc / lengths[filled]).astype(np.int64)
+        self.gc_hist += np.bincount(gc_pct, minlength=GC_BINS)
+
+        counted = cycle < MAX_CYCLES
+        n_cycles = len(self.qual_hist)
+        cells = np.bincount(cycle[counted] * QUAL_RANGE + qual[counted], minlength=n_cycles * QUAL_RANGE)
+        self.qual_hist += cells.reshape(n_cycles, QUAL_RANGE)
+        self.n_count += np.bincount(cycle[counted & (base == ord("N"))], minlength=n_cycles)
+
+    def phred_offset(self) -> Optional[int]:
+        """Phred offset of the qualities, 64 when no score below ";" was seen"""
+        seen = np.flatnonzero(self.qual_hist.sum(axis=0))
+        if len(seen) == 0:
+            return None
+        return 33 if seen[0] < 59 else 64
+
+    def to_frame(self, SRR: str) -> pd.DataFrame:
+        """Summarize the accumulators as a long table"""
+        self.flush()
+        rows = []
+        offset = self.phred_offset()
+        n_reads = self.length_hist.sum()
+        if offset is None or n_reads == 0:
+            return pd.DataFrame(rows, columns=["metric", "position", "value"],
+                                index=pd.Index([], name="srr"))
+
+        scores = np.arange(QUAL_RANGE) - offset
+        coverage = self.qual_hist.sum(axis=1)
+        covered = coverage > 0
+        cycles = np.flatnonzero(covered)
+        quality_mean = (self.qual_hist[covered] * scores).sum(axis=1) / coverage[covered]
+        rows += [("quality_mean", k, v) for k, v in zip(cycles, quality_mean)]
+        cumulative = np.cumsum(self.qual_hist[covered], axis=1)
+        for metric, fraction in QUANTILES.items():
+            score = scores[np.argmax(cumulative >= fraction * coverage[covered, None], axis=1)]
+            rows += [(metric, k, v) for k, v in zip(cycles, score)]
+        n_rate = self.n_count[covered] / coverage[covered]
+        rows += [("n_rate_per_cycle", k, v) for k, v in zip(cycles, n_rate)]
+
+        lengths = np.flatnonzero(self.length_hist)
+        rows += [("read_length", k, v) for k, v in zip(lengths, self.length_hist[lengths])]
+        gc = np.flatnonzero(self.gc_hist)
+        rows += [("gc_content", k, v) for k, v in zip(gc, self.gc_hist[gc] / self.gc_hist.sum())]
+
+        rows += [
+            ("phred_offset", 0, offset),
+            ("mean_quality", 0, (self.qual_hist.sum(axis=0) * scores).sum() / coverage.sum()),
+            ("mean_read_length", 0, (self.length_hist * np.arange(len(self.length_hist))).sum() / n_reads),
+            ("mean_gc", 0, (self.gc_hist * np.arange(GC_BINS)).sum() / max(self.gc_hist.sum(), 1)),
+            ("n_rate", 0, self.n_count.sum() / coverage.sum()),
+        ]
+        df = pd.DataFrame(rows, columns=["metric", "position", "value"],
+                          index=pd.Index([SRR] * len(rows), name="srr"))
+        return df.astype({"position": np.int64, "value": np.float64})
@@ -0,0 +1,122 @@
+"""Settings of a MultiQC run, passed to the stages instead of module globals"""
+import os
+from collections import namedtuple
+from pathlib import Path
+
+from .bam_profile import BamProfile
+from .compression import OutputCompression
+from .picard_worker import JOBS_PER_SAMPLE
+
+FIELDS = [
+    "outdir",
+    "download_path",
+    "ascp_key",
+    "gtf",
+    "fastq_screen_config",
+    "reference",
+    "splice",
+    "picard",
+    "ref_flat",
+    "workers",
+    "THREADS",
+    "only_download",
+    "skip_download",
+    "remove_fastq",
+    "remove_bam",
+    "fastq_engine",
+    "compression",
+    "no_prescreen",
+    "fuse_atropos",
+    "screen_engine",
+    "max_reads",
+    "stream_alignment",
+    "bam_profile",
+    "duplicates_engine",
+    "picard_worker",
+    "count_batch",
+    "remove_counts",
+    "network_slots",
+    "cores",
+    "jvm_memory",
+    "scratch_samples",
+    "disk_budget",
+    "executor",
+    "retries",
+    "retry_delay",
+]
+
+
+class RunConfig(namedtuple("RunConfig", FIELDS)):
+    """The settings of a run, fixed once the arguments are parsed
+
+    It can be pickled, so the stages can run in worker processes, and runs
+    with different settings can share an interpreter. The directories of
+    the run are derived from `outdir`.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_args(cls, args) -> "RunConfig":
+        """Settings from the parsed arguments of MultiQC"""
+        outdir = args.outdir.strip('"')
+        return cls(
+            outdir=outdir,
+            download_path=args.download or os.path.join(outdir, "download"),
+            ascp_key=args.ascp_key.strip('"'),
+            gtf=args.gtf.strip('"'),
+            fastq_screen_config=args.fastq_screen_config.strip('"'),
+            reference=args.ht2_idx.strip('"'),
+            splice=args.known_splicesite_infile.strip('"'),
+            picard=args.picard.strip('"'),
+            ref_flat=args.ref_flat.strip('"'),
+            workers=args.workers,
+            THREADS=args.THREADS,
+            only_download=args.only_download,
+            skip_download=args.skip_download,
+            remove_fastq=args.remove_fastq,
+            remove_bam=args.remove_bam,
+            fastq_engine=args.fastq_engine,
+            compression=OutputCompression(args.qc_compression, args.qc_compresslevel, args.THREADS),
+            no_prescreen=args.no_prescreen,
+            fuse_atropos=args.fuse_atropos,
+            screen_engine=args.screen_engine,
+            max_reads=args.max_reads,
+            stream_alignment=args.stream_alignment,
+            bam_profile=BamProfile.choose(args.bam_profile, args.remove_bam, args.sort_memory, args.sort_tmpdir),
+            duplicates_engine=args.duplicates_engine,
+            picard_worker=args.picard_worker,
+            count_batch=args.count_batch,
+            remove_counts=args.remove_counts,
+            network_slots=args.network_slots or args.workers,
+            cores=args.cores or args.workers * args.THREADS,
+            jvm_memory=args.jvm_memory or 3 * args.workers * JOBS_PER_SAMPLE,
+            scratch_samples=args.scratch_samples or 2 * args.workers,
+            disk_budget=args.disk_budget,
+            executor=args.executor,
+            retries=args.retries,
+            retry_delay=args.retry_delay,
+        )
+
+    @property
+    def QC_dir(self) -> str:
+        return os.path.join(self.outdir, "QC_dir")
+
+    @property
+    def Bam_dir(self) -> str:
+        return os.path.join(self.outdir, "Bam")
+
+    @property
+    def Count_dir(self) -> str:
+        return os.path.join(self.outdir, "Count")
+
+    @property
+    def screen_index(self) -> str:
+        return os.path.join(self.outdir, "screen_index")
+
+    @property
+    def feature_path(self) -> Path:
+        return Path(self.outdir) / "Features"
+
+    @property
+    def done_sample(self) -> Path:
+        return self.feature_path / "done_sample.txt"
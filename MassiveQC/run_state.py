@@ -0,0 +1,248 @@
+"""State of the stages of the samples of a run, in a SQLite database
+
+Each stage of each sample has a row with its status, the number of times it
+was started, when it started and ended, the class and message of its last
+error and the feature files it wrote. A sample whose stages are all done
+has a row for the stage "sample". Resuming a run reads the database instead
+of listing the output directories and checking every output file.
+
+Samples that failed for their data are kept in the rejects table, later runs
+skip them.
+
+The database is written by the processes of one host, MultiQC and the
+feature store. SingleQC jobs may run on other hosts of a cluster, whose
+shared filesystem does not lock SQLite reliably, so they leave a marker file
+in Features/DoneSample or Features/Rejected instead. The markers are
+recorded each time the database is opened.
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from .parser import remove_file
+
+logger = logging.getLogger("MassiveQC")
+
+RUN_STATE = "run_state.sqlite"
+# Stage recorded when every stage of a sample is done
+SAMPLE = "sample"
+RUNNING, DONE, FAILED = "running", "done", "failed"
+# Marker directories of the samples done or rejected by SingleQC
+DONE_SAMPLE, REJECTED = "DoneSample", "Rejected"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    srr TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    ended REAL,
+    error_class TEXT,
+    error TEXT,
+    outputs TEXT,
+    PRIMARY KEY (srr, stage)
+);
+CREATE TABLE IF NOT EXISTS rejects (
+    srr TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    error_class TEXT,
+    error TEXT,
+    rejected REAL
+);
+"""
+
+
+def mark_done(feature_path: str, SRR: str) -> None:
+    """Leave the marker of a sample whose stages are all done"""
+    marker = Path(feature_path) / DONE_SAMPLE / SRR
+    marker.parent.mkdir(exist_ok=True)
+    marker.touch()
+
+
+def mark_rejected(feature_path: str, SRR: str, stage: str, error: BaseException) -> None:
+    """Leave the marker of a sample that fails for its data, with the stage and the error"""
+    marker = Path(feature_path) / REJECTED / SRR
+    marker.parent.mkdir(exist_ok=True)
+    marker.write_text(f"{stage}\n{type(error).__name__}\n{error}")
+
+
+def marked_rejected(feature_path: str, SRR: str) -> Optional[str]:
+    """The error of the sample if it has a reject marker"""
+    marker = Path(feature_path) / REJECTED / SRR
+    if not marker.exists():
+        return None
+    stage, error_class, error = _read_marker(marker)
+    return f"{stage}: {error_class} {error}".rstrip()
+
+
+def _read_marker(marker: Path):
+    stage, error_class, error = (marker.read_text().split("\n", 2) + ["", ""])[:3]
+    return stage, error_class, error
+
+
+class RunState:
+    """The run database of a Features directory
+
+    The connection belongs to the thread that opens the database. The
+    samples of the DoneSample directory not recorded yet are recorded as
+    done when their marker was written, those of the Rejected directory as
+    rejected.
+
+    **parameter**
+
+    feature_path: str
+        The Features directory.
+    """
+    def __init__(self, feature_path: str):
+        self.feature_path = Path(feature_path)
+        self.path = self.feature_path / RUN_STATE
+        self.connection = sqlite3.connect(self.path.as_posix(), timeout=60)
+        # A rollback journal, the database of an older version may be in WAL mode
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+        self._import_markers()
+
+    def _import_markers(self) -> None:
+        done_sample_dir = self.feature_path / DONE_SAMPLE
+        if done_sample_dir.exists():
+            SRRs = set(os.listdir(done_sample_dir)).difference(self.done_samples())
+            if SRRs:
+                logger.info(f"Record the {len(SRRs):,} samples of {done_sample_dir} in {self.path}")
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT INTO stages (srr, stage, status, attempts, ended) VALUES (?, ?, ?, 1, ?) "
+                        "ON CONFLICT (srr, stage) DO UPDATE SET status = excluded.status, ended = excluded.ended",
+                        [(SRR, SAMPLE, DONE, (done_sample_dir / SRR).stat().st_mtime) for SRR in SRRs],
+                    )
+        rejected_dir = self.feature_path / REJECTED
+        if rejected_dir.exists():
+            SRRs = set(os.listdir(rejected_dir)).difference(self.rejected())
+            with self.connection:
+                for SRR in SRRs:
+                    marker = rejected_dir / SRR
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO rejects (srr, stage, error_class, error, rejected) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (SRR, *_read_marker(marker), marker.stat().st_mtime),
+                    )
+
+    def start(self, SRR: str, stage: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO stages (srr, stage, status, attempts, started) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (srr, stage) DO UPDATE SET status = excluded.status, attempts = attempts + 1, "
+                "started = excluded.started, ended = NULL",
+                (SRR, stage, RUNNING, time.time()),
+            )
+
+    def done(self, SRR: str, stage: str, outputs: Iterable[str] = ()) -> None:
+        outputs = json.dumps([os.path.abspath(output) for output in outputs])
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO stages (srr, stage, status, attempts, ended, outputs) VALUES (?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT (srr, stage) DO UPDATE SET status = excluded.status, ended = excluded.ended, "
+                "error_class = NULL, error = NULL, outputs = excluded.outputs",
+                (SRR, stage, DONE, time.time(), outputs),
+            )
+
+    def fail(self, SRR: str, stage: str, error: BaseException) -> None:
+        with self.connection:
+            self.connection.execute(
+                "UPDATE stages SET status = ?, ended = ?, error_class = ?, error = ? WHERE srr = ? AND stage = ?",
+                (FAILED, time.time(), type(error).__name__, str(error), SRR, stage),
+            )
+
+    def reject(self, SRR: str, stage: str, error: BaseException) -> None:
+        """Record that the sample fails for its data, whenever it is run, SingleQC sees its marker"""
+        mark_rejected(self.feature_path.as_posix(), SRR, stage, error)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO rejects (srr, stage, error_class, error, rejected) VALUES (?, ?, ?, ?, ?)",
+                (SRR, stage, type(error).__name__, str(error), time.time()),
+            )
+
+    def rejected(self) -> Dict[str, str]:
+        """The error of each rejected sample"""
+        return {SRR: f"{stage}: {error_class} {error}".rstrip() for SRR, stage, error_class, error
+                in self.connection.execute("SELECT srr, stage, error_class, error FROM rejects")}
+
+    def unreject(self, SRRs: Iterable[str]) -> None:
+        """Forget the rejects of the samples, so they run again"""
+        SRRs = list(SRRs)
+        for SRR in SRRs:
+            remove_file((self.feature_path / REJECTED / SRR).as_posix())
+        with self.connection:
+            self.connection.executemany("DELETE FROM rejects WHERE srr = ?", [(SRR,) for SRR in SRRs])
+
+    def sample_done(self, SRRs: Iterable[str]) -> None:
+        """Record that every stage of the samples is done"""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO stages (srr, stage, status, attempts, ended) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (srr, stage) DO UPDATE SET status = excluded.status, ended = excluded.ended",
+                [(SRR, SAMPLE, DONE, now) for SRR in SRRs],
+            )
+
+    def done_stages(self) -> Dict[str, Set[str]]:
+        """The stages done of each sample"""
+        stages = {}
+        for SRR, stage in self.connection.execute("SELECT srr, stage FROM stages WHERE status = ?", (DONE,)):
+            stages.setdefault(SRR, set()).add(stage)
+        return stages
+
+    def done_samples(self, since: Optional[float] = None) -> List[str]:
+        """The samples whose stages are all done, only those done after `since` if given"""
+        query = "SELECT srr FROM stages WHERE stage = ? AND status = ?"
+        params = [SAMPLE, DONE]
+        if since is not None:
+            query += " AND ended > ?"
+            params.append(since)
+        return [SRR for SRR, in self.connection.execute(query, params)]
+
+    def outputs(self) -> Set[str]:
+        """The feature files written by the stages that are done"""
+        files = set()
+        for outputs, in self.connection.execute("SELECT outputs FROM stages WHERE status = ?", (DONE,)):
+            files.update(json.loads(outputs or "[]"))
+        return files
+
+    def reset(self, stages: Iterable[str], SRRs: Optional[Iterable[str]] = None) -> List[str]:
+        """Forget the stages of the samples, all samples if None, so they run again
+
+        The samples are no longer done, their DoneSample markers are removed. Returns the feature files the stages
+        wrote, which must be removed before they run again.
+        """
+        stages = list(stages)
+        where = f"stage IN ({', '.join('?' * len(stages))})"
+        if SRRs is None:
+            return self._reset(where, stages)
+        SRRs = list(SRRs)
+        files = []
+        # SQLite limits the number of parameters of a statement
+        for start in range(0, len(SRRs), 500):
+            batch = SRRs[start:start + 500]
+            files += self._reset(f"{where} AND srr IN ({', '.join('?' * len(batch))})", stages + batch)
+        return files
+
+    def _reset(self, where: str, params: list) -> List[str]:
+        files = []
+        with self.connection:
+            rows = self.connection.execute(f"SELECT srr, outputs FROM stages WHERE {where}", params).fetchall()
+            for SRR, outputs in rows:
+                files += json.loads(outputs or "[]")
+                remove_file((self.feature_path / DONE_SAMPLE / SRR).as_posix())
+            self.connection.execute(f"DELETE FROM stages WHERE {where}", params)
+            self.connection.executemany(
+                "DELETE FROM stages WHERE srr = ? AND stage = ?", [(SRR, SAMPLE) for SRR, _ in rows]
+            )
+        return files
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,273 @@
+"""Run the stages of many samples against shared pools of resources
+
+Each sample is a small graph of stage tasks. A task starts as soon as the
+stages it comes after are done and the pools have what it needs, so a
+download, a single-threaded Picard job and a multi-threaded alignment of
+different samples run side by side instead of each sample holding its
+share of the machine from the download to the counts.
+"""
+import logging
+import queue
+import time
+from concurrent import futures
+from multiprocessing import get_context
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .failures import PERMANENT, TRANSIENT, backoff, classify
+from .lifecycle import Lifecycle
+from .run_state import RunState
+
+logger = logging.getLogger("MassiveQC")
+
+
+class Task:
+    """A stage of a sample
+
+    **parameter**
+
+    SRR: str
+        The sample.
+
+    name: str
+        The stage, unique within the sample.
+
+    run: callable
+        Runs the stage, without arguments.
+
+    needs: dict
+        Amount of each pool held while the stage runs, like {"cpu": 4}.
+
+    after: list
+        Names of the stages of the same sample that must be done first.
+
+    in_thread: bool
+        Run in a thread even with the process executor, for stages that wait
+        on the network or on resources of this process. Others must be picklable.
+
+    outputs: list
+        Feature files written by the stage, recorded in the run database.
+
+    record: bool
+        Whether the task is a stage of the sample, recorded in the run
+        database and skipped when it is recorded as done.
+    """
+    def __init__(self, SRR: str, name: str, run: Callable[[], None], needs: Optional[Dict[str, int]] = None,
+                 after: Iterable[str] = (), in_thread: bool = False, outputs: Iterable[str] = (),
+                 record: bool = True):
+        self.SRR = SRR
+        self.name = name
+        self.run = run
+        self.needs = dict(needs or {})
+        self.after = set(after)
+        self.in_thread = in_thread
+        self.outputs = [str(output) for output in outputs]
+        self.record = record
+
+
+class Scheduler:
+    """Dispatch the tasks of the samples against resource pools
+
+    A task that needs more than a pool holds is capped to the whole pool, it
+    runs alone instead of never. At most `max_samples` samples have started
+    and are not over, and with a lifecycle the intermediate files they may
+    still write fit in its disk budget. Earlier samples get the free
+    resources first, so samples are finished rather than all started.
+
+    A stage failing for a transient reason is tried again `retries` times,
+    after `retry_delay` seconds doubling each time, the sample keeps its place
+    meanwhile. When a stage fails for good, the stages that come after it are
+    dropped and the sample is over. Its outputs are kept for the next run,
+    unless it was rejected for its data, see `failures`.
+
+    **parameter**
+
+    pools: dict
+        Capacity of each pool, like {"network": 2, "cpu": 16, "jvm": 24}.
+
+    max_samples: int
+        Number of samples in progress at once.
+
+    on_sample_done: callable or None
+        Called in the dispatching thread with the SRR and whether all its
+        stages were done, it may add tasks.
+
+    executor: str
+        "thread" runs every stage in a thread, "process" runs the stages
+        that are not `in_thread` in worker processes, past the GIL.
+
+    state: RunState or None
+        Run database. The stages it records as done are not run again, the
+        others are recorded as they start and end, and rejected samples too.
+
+    retries: int
+        Number of times a stage failing for a transient reason is tried again.
+
+    retry_delay: float
+        Seconds before the first retry of a stage.
+
+    lifecycle: Lifecycle or None
+        Intermediate files of the samples. A sample starts once it fits in
+        the disk budget, and the intermediates are removed as the stages
+        reading them are done.
+    """
+    def __init__(self, pools: Dict[str, int], max_samples: int,
+                 on_sample_done: Optional[Callable[[str, bool], None]] = None, executor: str = "thread",
+                 state: Optional[RunState] = None, retries: int = 0, retry_delay: float = 60.0,
+                 lifecycle: Optional[Lifecycle] = None):
+        if executor not in ("thread", "process"):
+            raise SchedulerException(f"Unknown executor {executor}")
+        self.pools = dict(pools)
+        self.free = dict(pools)
+        self.max_samples = max(1, max_samples)
+        self.on_sample_done = on_sample_done
+        self.executor = executor
+        self.state = state
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lifecycle = lifecycle
+        self.failed = {}
+        self._recorded = state.done_stages() if state is not None else {}
+        # Tasks waiting, by sample in the order the samples were added
+        self._waiting = {}
+        self._done = {}
+        self._running = {}
+        self._started = set()
+        # Failures of each stage, and the tasks waiting to be tried again with the time they can start
+        self._attempts = {}
+        self._delayed = []
+        self._finished = queue.Queue()
+
+    def add(self, tasks: List[Task]) -> None:
+        """Add the tasks of a sample, or more tasks of a sample already added"""
+        SRRs = []
+        for task in tasks:
+            self._done.setdefault(task.SRR, set())
+            if task.SRR not in SRRs:
+                SRRs.append(task.SRR)
+            if task.record and task.name in self._recorded.get(task.SRR, ()):
+                self._done[task.SRR].add(task.name)
+                if self.lifecycle is not None:
+                    self.lifecycle.stage_done(task.SRR, task.name)
+            else:
+                self._waiting.setdefault(task.SRR, {})[task.name] = task
+        for SRR in SRRs:
+            # Every stage was done in an earlier run
+            if not self._waiting.get(SRR) and not self._pending(SRR):
+                self._end(SRR, SRR not in self.failed)
+
+    def run(self) -> None:
+        """Run every task added, including those added while they run"""
+        max_workers = sum(self.pools.values()) or 1
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as threads:
+            processes = None
+            if self.executor == "process":
+                # Workers are started from a threaded process, fork is not safe
+                processes = futures.ProcessPoolExecutor(max_workers=self.pools.get("cpu") or 1,
+                                                        mp_context=get_context("forkserver"))
+            try:
+                while True:
+                    self._dispatch(threads, processes)
+                    if not self._running and not self._delayed:
+                        break
+                    try:
+                        # Wake up for the next retry when nothing finishes before it
+                        timeout = min(ready for ready, _ in self._delayed) - time.monotonic() if self._delayed else None
+                        task, error = self._finished.get(timeout=None if timeout is None else max(timeout, 0))
+                    except queue.Empty:
+                        continue
+                    self._finish(task, error)
+            finally:
+                if processes is not None:
+                    processes.shutdown()
+        for SRR, tasks in list(self._waiting.items()):
+            # Only tasks coming after missing stages can be left
+            logger.error(f"{SRR} {', '.join(tasks)} can not run, the stages they need are missing")
+            self._end(SRR, False)
+
+    def _dispatch(self, threads: futures.Executor, processes: Optional[futures.Executor]) -> None:
+        now = time.monotonic()
+        for ready, task in [delayed for delayed in self._delayed if delayed[0] <= now]:
+            self._delayed.remove((ready, task))
+            self._waiting.setdefault(task.SRR, {})[task.name] = task
+        admitting = True
+        for SRR in list(self._waiting):
+            # Tasks that are not stages of a sample, like a featureCounts batch, start without admission
+            if SRR not in self._started and any(task.record for task in self._waiting[SRR].values()):
+                if not admitting or len(self._started) >= self.max_samples:
+                    continue
+                # The first sample is admitted whatever its size, the samples are admitted in order
+                if self.lifecycle is not None and not self.lifecycle.admits(SRR, force=not self._started):
+                    admitting = False
+                    continue
+            for task in list(self._waiting[SRR].values()):
+                if not task.after <= self._done[SRR] or not self._fits(task.needs):
+                    continue
+                for pool, amount in self._capped(task.needs).items():
+                    self.free[pool] -= amount
+                del self._waiting[SRR][task.name]
+                self._started.add(SRR)
+                if self.state is not None and task.record:
+                    self.state.start(SRR, task.name)
+                self._running[(SRR, task.name)] = task
+                logger.info(f"{SRR} Start {task.name} step")
+                executor = threads if processes is None or task.in_thread else processes
+                try:
+                    future = executor.submit(task.run)
+                except Exception as error:
+                    # A worker process died, the pool takes no more tasks
+                    self._finished.put((task, error))
+                else:
+                    future.add_done_callback(lambda future, task=task: self._finished.put((task, future.exception())))
+
+    def _finish(self, task: Task, error: Optional[Exception]) -> None:
+        del self._running[(task.SRR, task.name)]
+        for pool, amount in self._capped(task.needs).items():
+            self.free[pool] += amount
+        if error is None:
+            logger.info(f"{task.SRR} {task.name} step is done")
+            self._done[task.SRR].add(task.name)
+            if self.state is not None and task.record:
+                self.state.done(task.SRR, task.name, task.outputs)
+            if self.lifecycle is not None and task.record:
+                self.lifecycle.stage_done(task.SRR, task.name)
+        else:
+            failure = classify(error)
+            if self.state is not None and task.record:
+                self.state.fail(task.SRR, task.name, error)
+            attempt = self._attempts[(task.SRR, task.name)] = self._attempts.get((task.SRR, task.name), 0) + 1
+            if failure == TRANSIENT and attempt <= self.retries and task.SRR not in self.failed:
+                delay = backoff(attempt, self.retry_delay)
+                logger.warning(f"{task.SRR} {task.name} step failed: {type(error).__name__} {error}, "
+                               f"try again in {delay:.0f} s")
+                self._delayed.append((time.monotonic() + delay, task))
+                return
+            logger.error(f"{task.SRR} {task.name} step failed ({failure}): {type(error).__name__} {error}")
+            self.failed[task.SRR] = error
+            if failure == PERMANENT and self.state is not None and task.record:
+                self.state.reject(task.SRR, task.name, error)
+            # The stages of the sample that are not running yet are dropped
+            self._waiting.pop(task.SRR, None)
+            self._delayed = [delayed for delayed in self._delayed if delayed[1].SRR != task.SRR]
+        if not self._waiting.get(task.SRR) and not self._pending(task.SRR):
+            self._end(task.SRR, task.SRR not in self.failed)
+
+    def _pending(self, SRR: str) -> bool:
+        """Whether a stage of the sample is running or waiting to be tried again"""
+        return any(running == SRR for running, _ in self._running) or any(
+            task.SRR == SRR for _, task in self._delayed)
+
+    def _end(self, SRR: str, done: bool) -> None:
+        self._waiting.pop(SRR, None)
+        self._started.discard(SRR)
+        if self.on_sample_done is not None:
+            self.on_sample_done(SRR, done)
+
+    def _capped(self, needs: Dict[str, int]) -> Dict[str, int]:
+        return {pool: min(amount, self.pools[pool]) for pool, amount in needs.items()}
+
+    def _fits(self, needs: Dict[str, int]) -> bool:
+        return all(self.free[pool] >= amount for pool, amount in self._capped(needs).items())
+
+
+class SchedulerException(Exception):
+    """Basic exception for problems scheduling the stages"""
@@ -0,0 +1,41 @@
+"""Run the independent stages of a sample concurrently"""
+import logging
+from concurrent import futures
+from typing import Callable, Dict
+
+logger = logging.getLogger("MassiveQC")
+
+
+def run_stages(SRR: str, stages: Dict[str, Callable[[], None]]) -> None:
+    """Run each stage in its own thread and wait for all of them
+
+    A failing stage does not stop the others, so their outputs are kept for
+    the next run. The failures are raised together once every stage ended.
+
+    **parameter**
+
+    SRR: str
+        The sample, used in the messages.
+
+    stages: dict
+        Callables without arguments, keyed by the stage name.
+    """
+    if not stages:
+        return
+    failed = {}
+    with futures.ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        tasks = {executor.submit(stage): name for name, stage in stages.items()}
+        for task in futures.as_completed(tasks):
+            name = tasks[task]
+            error = task.exception()
+            if error is None:
+                logger.info(f"{SRR} {name} step is done")
+            else:
+                logger.error(f"{SRR} {name} step failed: {error}")
+                failed[name] = error
+    if failed:
+        raise StageException(f"{SRR} failed in {', '.join(failed)}") from next(iter(failed.values()))
+
+
+class StageException(Exception):
+    """Basic exception for failed stages"""
@@ -0,0 +1,147 @@
+"""Infer the strandness of a library from a sample of its aligned reads"""
+import bisect
+import logging
+import os
+import random
+import subprocess
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger("MassiveQC")
+
+# Reads are taken from the genes of a random sample of genes, until MAX_READS
+# reads overlapping them are seen.
+N_GENES = 2000
+MAX_READS = 200_000
+# Same fraction as the PCT_CORRECT_STRAND_READS cutoff of Picard
+STRANDED = 0.75
+# Unmapped, secondary, QC fail, supplementary and second of pair reads
+EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x800 | 0x80
+
+
+@lru_cache(maxsize=4)
+def load_genes(ref_flat: str) -> Dict[str, Tuple[List[int], List[int], List[str]]]:
+    """Gene spans of a refFlat file that do not overlap a gene of the other strand
+
+    **parameter**
+
+    ref_flat: str
+        Path to the refFlat file.
+
+    **return**
+
+    genes: dict
+        Starts, ends and strands of the gene spans of each chromosome,
+        sorted by start.
+    """
+    spans = {}
+    with open(ref_flat) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 6 or fields[3] not in ("+", "-"):
+                continue
+            spans.setdefault(fields[2], []).append((int(fields[4]), int(fields[5]), fields[3]))
+
+    genes = {}
+    for chrom, intervals in spans.items():
+        intervals.sort()
+        # Merge the transcripts of a strand, drop spans overlapping the other strand
+        merged = []
+        for start, end, strand in intervals:
+            if merged and start < merged[-1][1]:
+                if merged[-1][2] == strand:
+                    merged[-1][1] = max(merged[-1][1], end)
+                    continue
+                merged[-1][2] = None
+                merged[-1][1] = max(merged[-1][1], end)
+                continue
+            merged.append([start, end, strand])
+        kept = [span for span in merged if span[2] is not None]
+        genes[chrom] = ([s[0] for s in kept], [s[1] for s in kept], [s[2] for s in kept])
+    return genes
+
+
+def infer_strand(bam: Path, ref_flat: str, THREADS: int = 1, seed: int = 0) -> Tuple[str, float]:
+    """Infer the strandness from the reads of a sample of genes
+
+    The first read of each pair, or each single-end read, is compared to the
+    strand of the gene it starts in. Libraries with at least 75% of these
+    reads on the gene strand are "same_strand", with at most 25%
+    "opposite_strand", the others "unstranded".
+
+    **parameter**
+
+    bam: Path
+        The sorted and indexed BAM file.
+
+    ref_flat: str
+        Path to the refFlat file.
+
+    THREADS: int
+        Number of samtools decompression threads.
+
+    seed: int
+        Seed of the gene sample.
+
+    **return**
+
+    strand: str
+        "same_strand", "opposite_strand" or "unstranded".
+
+    fraction: float
+        Fraction of the reads on the gene strand.
+    """
+    genes = load_genes(ref_flat)
+    spans = [(chrom, k) for chrom, (starts, _, _) in genes.items() for k in range(len(starts))]
+    rng = random.Random(seed)
+    sampled = sorted(rng.sample(spans, min(N_GENES, len(spans))))
+
+    same, opposite = 0, 0
+    stopped = False
+    with tempfile.NamedTemporaryFile("w", suffix=".bed", dir=Path(bam).parent, delete=False) as bed:
+        for chrom, k in sampled:
+            starts, ends, _ = genes[chrom]
+            bed.write(f"{chrom}\t{starts[k]}\t{ends[k]}\n")
+    try:
+        cmd = ["samtools", "view", "-F", str(EXCLUDE_FLAGS), "-@", str(THREADS), "-M", "-L", bed.name, str(bam)]
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+            for line in process.stdout:
+                fields = line.split(b"\t", 4)
+                chrom, position = fields[2].decode(), int(fields[3]) - 1
+                starts, ends, strands = genes.get(chrom, ([], [], []))
+                k = bisect.bisect_right(starts, position) - 1
+                if k < 0 or position >= ends[k]:
+                    continue
+                reverse = int(fields[1]) & 0x10
+                if (strands[k] == "-") == bool(reverse):
+                    same += 1
+                else:
+                    opposite += 1
+                if same + opposite >= MAX_READS:
+                    stopped = True
+                    process.kill()
+                    break
+    finally:
+        os.unlink(bed.name)
+    # A missing index or a truncated BAM would look like a sample without reads
+    if not stopped and process.returncode != 0:
+        raise StrandException(f"samtools view exited with status {process.returncode}")
+
+    if same + opposite == 0:
+        logger.warning(f"No reads in the genes of {bam}, treating it as unstranded")
+        return "unstranded", 0.5
+    fraction = same / (same + opposite)
+    if fraction >= STRANDED:
+        strand = "same_strand"
+    elif fraction <= 1 - STRANDED:
+        strand = "opposite_strand"
+    else:
+        strand = "unstranded"
+    logger.info(f"{bam}: {fraction:.1%} of {same + opposite:,} reads on the gene strand, {strand}")
+    return strand, fraction
+
+
+class StrandException(Exception):
+    """Basic exception for problems inferring the strand"""
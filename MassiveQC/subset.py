@@ -0,0 +1,88 @@
+"""Uniform sample of the reads of a FASTQ stream, drawn in a single pass"""
+import random
+from math import exp, log
+from typing import Optional
+
+import numpy as np
+
+from .compression import OutputCompression
+
+# fastq_screen draws 100,000 reads
+SUBSET_READS = 100_000
+
+
+class ReadSubset:
+    """Reservoir sample of `n_reads` reads
+
+    Reads are added as they stream by, either one record or a run of whole
+    records at a time. Skips between the replaced reads are drawn with
+    algorithm L, so records that are not sampled cost no random numbers.
+
+    **parameter**
+
+    n_reads: int
+        Number of reads to keep.
+
+    seed: int
+        Seed of the random generator, the same stream gives the same sample.
+    """
+    def __init__(self, n_reads: int = SUBSET_READS, seed: int = 0):
+        self.n_reads = n_reads
+        self.reads = []
+        self.seen = 0
+        self._next = 0
+        self._w = None
+        self._rng = random.Random(seed)
+
+    def add(self, data) -> None:
+        """Add one or more whole records of raw bytes"""
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+        n_records = len(newlines) // 4
+        while self._next < self.seen + n_records:
+            idx = self._next - self.seen
+            start = newlines[4 * idx - 1] + 1 if idx else 0
+            record = bytes(data[start:newlines[4 * idx + 3] + 1])
+            if len(self.reads) < self.n_reads:
+                self.reads.append(record)
+            else:
+                self.reads[self._rng.randrange(self.n_reads)] = record
+            self._advance()
+        self.seen += n_records
+
+    def _advance(self) -> None:
+        """Find the index of the next record that enters the sample"""
+        if len(self.reads) < self.n_reads:
+            self._next += 1
+            return
+        w = exp(log(self._uniform()) / self.n_reads)
+        self._w = w if self._w is None else self._w * w
+        self._next += int(log(self._uniform()) / log(1 - self._w)) + 1
+
+    def _uniform(self) -> float:
+        """Random number in the open interval (0, 1)"""
+        value = self._rng.random()
+        while value == 0.0:
+            value = self._rng.random()
+        return value
+
+    @classmethod
+    def merge(cls, first: "ReadSubset", second: "ReadSubset", seed: int = 0) -> "ReadSubset":
+        """Sample of the reads of both streams, as if they were added to a single subset
+
+        The number of reads taken from each sample follows the hypergeometric
+        distribution of the reads seen by each subset.
+        """
+        merged = cls(first.n_reads, seed)
+        merged.seen = first.seen + second.seen
+        n_reads = min(merged.n_reads, merged.seen)
+        rng = np.random.default_rng(seed)
+        n_first = int(rng.hypergeometric(first.seen, second.seen, n_reads)) if n_reads else 0
+        merged.reads = merged._rng.sample(first.reads, n_first) + \
+            merged._rng.sample(second.reads, n_reads - n_first)
+        return merged
+
+    def write(self, path: str, compression: Optional[OutputCompression] = None) -> None:
+        """Write the sampled reads to `path`"""
+        compression = compression or OutputCompression()
+        with compression.open(path) as out:
+            out.write(b"".join(self.reads))
@@ -0,0 +1,103 @@
+"""Compare the single pass BAM features with the tools they replace
+
+The alignment stats of bamstats are compared with `samtools stats`, and
+with `bamtools stats` when it is installed. With --picard, the streamed
+duplicate metrics are compared with those of Picard MarkDuplicates, which
+is what `--duplicates_engine validate` does for every sample of a run.
+
+    python example/check_bam_features.py sample.sorted.bam --picard picard.jar
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MassiveQC.bamstats import bam_stats  # noqa: E402
+from MassiveQC.command import run_command  # noqa: E402
+from MassiveQC.duplicates import duplicate_metrics  # noqa: E402
+from MassiveQC.markduplicates import DTYPES  # noqa: E402
+from MassiveQC.parser import (  # noqa: E402
+    parse_bamtools_stats,
+    parse_picard_markduplicate_metrics,
+    parse_samtools_stats,
+)
+from MassiveQC.picard_worker import run_picard  # noqa: E402
+
+SAMTOOLS_COLUMNS = [
+    "reads_MQ0",
+    "average_quality",
+    "insert_size_average",
+    "insert_size_standard_deviation",
+    "inward_oriented_pairs",
+    "outward_oriented_pairs",
+    "pairs_with_other_orientation",
+    "pairs_on_different_chromosomes",
+]
+BAMTOOLS_COLUMNS = ["Percent Forward", "Percent Reverse"]
+
+
+def same_value(expected, found, tolerance: float) -> bool:
+    if pd.isna(expected) or pd.isna(found):
+        return pd.isna(expected) and pd.isna(found)
+    return abs(float(expected) - float(found)) <= tolerance
+
+
+def report(title: str, expected, found, columns: list, tolerance: float) -> bool:
+    """Print the columns side by side, returns whether they all match"""
+    print(title)
+    same = True
+    for column in columns:
+        a, b = expected[column].iloc[0], found[column].iloc[0]
+        match = same_value(a, b, tolerance)
+        same &= match
+        print(f"  {column:<32} {a!s:>14} {b!s:>14} {'' if match else 'DIFFERS'}")
+    return same
+
+
+def check_alignment_stats(bam: str, THREADS: int) -> bool:
+    found = bam_stats(Path(bam), "bam", THREADS)
+    # samtools prints the averages with one decimal
+    same = report("samtools stats / bamstats", parse_samtools_stats(run_command(f"samtools stats {bam}")),
+                  found, SAMTOOLS_COLUMNS, 0.05)
+    if shutil.which("bamtools"):
+        same &= report("bamtools stats / bamstats", parse_bamtools_stats(run_command(f"bamtools stats -in {bam}")),
+                       found, BAMTOOLS_COLUMNS, 1e-6)
+    else:
+        print("bamtools is not installed, Percent Forward and Percent Reverse are not compared")
+    return same
+
+
+def check_duplicates(bam: str, picard: str, THREADS: int, MEM: int) -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        metrics = Path(directory) / "duplicates.metrics"
+        args = [f"INPUT={bam}", f"OUTPUT={Path(directory) / 'dedup.bam'}", f"METRICS_FILE={metrics}"]
+        log = run_picard(picard, "MarkDuplicates", args, MEM)
+        if "MarkDuplicates done" not in log:
+            print(log)
+            return False
+        expected = parse_picard_markduplicate_metrics(metrics)
+    found = duplicate_metrics(Path(bam), THREADS)
+    # Picard prints fractions with six digits
+    return report("Picard MarkDuplicates / duplicates", expected, found, list(DTYPES), 1e-6)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bam", type=str, help="Coordinate sorted BAM file")
+    parser.add_argument("--picard", type=str, help="Path to picard.jar, the duplicates are compared with it")
+    parser.add_argument("-t", "--THREADS", type=int, default=2, help="Number of samtools threads")
+    parser.add_argument("--mem", type=int, default=3, help="Heap of Picard in GB")
+    args = parser.parse_args()
+    same = check_alignment_stats(args.bam, args.THREADS)
+    if args.picard:
+        same &= check_duplicates(args.bam, args.picard, args.THREADS, args.mem)
+    return 0 if same else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""Check that the count store gives back the counts written by featureCounts
+
+Count files in the featureCounts format are generated for a few samples,
+appended to a store and read back before and after the parts are merged
+into chunks, for all samples and genes and for subsets of them.
+
+    python example/check_count_store.py --samples 30 --genes 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MassiveQC.count_store import JUNCTION_COLUMNS, CountStore  # noqa: E402
+
+
+def write_counts(directory: Path, SRR: str, genes: list, rng: np.random.Generator):
+    """Write the counts and jcounts files of a sample, returns its gene counts"""
+    counts = rng.negative_binomial(1, 0.05, len(genes)) * (rng.random(len(genes)) < 0.6)
+    bam = f"{directory}/{SRR}.sorted.bam"
+    df = pd.DataFrame({
+        "Geneid": genes, "Chr": "chr1", "Start": 1, "End": 100, "Strand": "+", "Length": 100, bam: counts,
+    })
+    counts_file = directory / f"{SRR}.counts"
+    with open(counts_file, "w") as out:
+        out.write('# Program:featureCounts v2.0.1; Command:"featureCounts"\n')
+        df.to_csv(out, sep="\t", index=False)
+    n_junctions = int(rng.integers(1, 50))
+    junctions = pd.DataFrame({
+        "PrimaryGene": rng.choice(genes + [""], n_junctions),
+        "SecondaryGenes": "",
+        "Site1_chr": "chr1",
+        "Site1_location": rng.integers(1, 10_000, n_junctions),
+        "Site1_strand": "+",
+        "Site2_chr": "chr1",
+        "Site2_location": rng.integers(10_000, 20_000, n_junctions),
+        "Site2_strand": "+",
+        bam: rng.integers(1, 100, n_junctions),
+    })
+    junctions.to_csv(directory / f"{SRR}.counts.jcounts", sep="\t", index=False)
+    return counts_file, directory / f"{SRR}.counts.jcounts", counts
+
+
+def check(store: CountStore, expected: pd.DataFrame, rng: np.random.Generator) -> list:
+    errors = []
+    if not store.read().equals(expected):
+        errors.append("all counts")
+    samples = list(rng.choice(expected.columns, 5, replace=False))
+    genes = list(rng.choice(expected.index, 50, replace=False))
+    subset = expected.loc[expected.index.isin(genes), samples]
+    if not store.read(samples, genes).equals(subset):
+        errors.append("subset of samples and genes")
+    if not store.read(samples, genes, sparse=True).sparse.to_dense().equals(subset):
+        errors.append("sparse subset")
+    return errors
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=30, help="Number of samples")
+    parser.add_argument("--genes", type=int, default=2000, help="Number of genes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated counts")
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    genes = [f"FBgn{i:07d}" for i in range(args.genes)]
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        store = CountStore((directory / "matrix").as_posix())
+        expected, junctions = {}, {}
+        for k in range(args.samples):
+            SRR = f"SRR{k:06d}"
+            counts_file, jcounts_file, expected[SRR] = write_counts(directory, SRR, genes, rng)
+            store.append(SRR, counts_file, jcounts_file)
+            junctions[SRR] = pd.read_table(jcounts_file, keep_default_na=False).iloc[:, -1].sum()
+        expected = pd.DataFrame(expected, index=pd.Index(genes, name="gene_id"))
+        for step in ("parts", "chunks"):
+            if step == "chunks":
+                store.compact(samples_per_chunk=max(1, args.samples // 4))
+            errors = check(store, expected, rng)
+            long = store.read_long("junctions")
+            if list(long.columns) != ["srr"] + JUNCTION_COLUMNS + ["count"]:
+                errors.append("junction columns")
+            elif not long.groupby("srr")["count"].sum().equals(pd.Series(junctions).rename_axis("srr")):
+                errors.append("junction counts")
+            failed |= bool(errors)
+            print(f"{args.samples} samples in {step}: {'differs in ' + ', '.join(errors) if errors else 'same counts'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
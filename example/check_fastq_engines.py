@@ -0,0 +1,141 @@
+"""Compare the FASTQ validation engines on small corrupted FASTQ files
+
+The python engine checks read by read, the vector engine checks chunks of
+reads, alone or in a pool of worker processes. They must accept the same
+reads and report the same counts, flags and read statistics. Single-end,
+pair-end and mixed up pair-end files are generated with reads that are
+badly encoded, have unequal sequence and quality, or are cut at the end.
+
+Reads whose mate is rejected may come in another order with the vector
+engine, they are compared as sets of reads.
+
+    python example/check_fastq_engines.py --reads 60000
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MassiveQC.fastq import Fastq  # noqa: E402
+
+# engine, workers, passthrough
+ENGINES = [
+    ("python", 1, False),
+    ("vector", 1, False),
+    ("vector", 1, True),
+    ("vector", 3, True),
+]
+COUNTS = ["flags", "libsize", "avgReadLen", "unequal_len", "bad_ecoding", "incomplete_read"]
+
+
+def make_read(rng: random.Random, name: str, mate: int) -> str:
+    length = rng.choice([50, 75, 100])
+    seq = "".join(rng.choice("ACGTN") for _ in range(length))
+    qual = "".join(chr(rng.randint(35, 74)) for _ in range(length))
+    damage = rng.random()
+    if damage < 0.01:
+        qual = qual[:-3]
+    elif damage < 0.015:
+        seq = seq[:10] + "X" + seq[11:]
+    elif damage < 0.02:
+        qual = qual[:10] + "\t" + qual[11:]
+    return f"@{name} {mate}:N:0:1\n{seq}\n+\n{qual}\n"
+
+
+def write_fastq(path: str, reads) -> None:
+    with gzip.open(path, "wt") as fh:
+        fh.writelines(reads)
+
+
+def make_samples(directory: str, n_reads: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    samples = {}
+    se = [make_read(rng, f"SE.{i}", 1) for i in range(n_reads)]
+    # The last read is cut short
+    se.append("@SE.last 1:N:0:1\nACGT\n")
+    samples["single-end"] = [os.path.join(directory, "SE.fastq.gz")]
+    write_fastq(samples["single-end"][0], se)
+
+    r1 = [make_read(rng, f"PE.{i}", 1) for i in range(n_reads)]
+    r2 = [make_read(rng, f"PE.{i}", 2) for i in range(n_reads)]
+    samples["pair-end"] = [os.path.join(directory, "PE_1.fastq.gz"), os.path.join(directory, "PE_2.fastq.gz")]
+    write_fastq(samples["pair-end"][0], r1)
+    write_fastq(samples["pair-end"][1], r2)
+
+    # R2 misses reads after the first third, R1 is kept as single-end
+    skip = set(range(n_reads // 3, n_reads, 7))
+    r2 = [read for i, read in enumerate(r2) if i not in skip]
+    mixed = [os.path.join(directory, "MX_1.fastq.gz"), os.path.join(directory, "MX_2.fastq.gz")]
+    write_fastq(mixed[0], r1)
+    write_fastq(mixed[1], r2)
+    samples["mixed up pair-end"] = mixed
+    return samples
+
+
+def run_engine(fastqs: list, engine: str, workers: int, passthrough: bool) -> dict:
+    fq = Fastq(*fastqs, engine=engine, passthrough=passthrough, workers=workers, readstats=True)
+    # Reads of both mates of valid pairs, or of single-end files
+    outputs = [[], []]
+    # Reads whose mate was rejected
+    solos = [[], []]
+    for read in fq.process():
+        if not isinstance(read, tuple):
+            outputs[0].append(bytes(read))
+        elif read[0] is not None and read[1] is not None:
+            outputs[0].append(bytes(read[0]))
+            outputs[1].append(bytes(read[1]))
+        else:
+            mate = 0 if read[1] is None else 1
+            solos[mate].append(bytes(read[mate]))
+    result = {name: getattr(fq, name) for name in COUNTS}
+    result["reads"] = [b"".join(output) for output in outputs]
+    result["solo reads"] = [sorted(records(b"".join(solo))) for solo in solos]
+    result["readstats"] = fq.readstats.to_frame("sample")
+    return result
+
+
+def records(data: bytes) -> list:
+    lines = data.splitlines(keepends=True)
+    return [b"".join(lines[i:i + 4]) for i in range(0, len(lines), 4)]
+
+
+def compare(reference: dict, result: dict) -> list:
+    differences = []
+    for name in COUNTS + ["reads", "solo reads"]:
+        if reference[name] != result[name]:
+            differences.append(name)
+    if not reference["readstats"].equals(result["readstats"]):
+        differences.append("readstats")
+    return differences
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=60000, help="Number of reads of each file")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated reads")
+    args = parser.parse_args()
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for sample, fastqs in make_samples(directory, args.reads, args.seed).items():
+            results = {setup: run_engine(fastqs, *setup) for setup in ENGINES}
+            reference = results[ENGINES[0]]
+            print(f"{sample}: flags {sorted(reference['flags'])}, {reference['libsize']:,} reads, "
+                  f"{reference['unequal_len']} unequal, {reference['bad_ecoding']} badly encoded, "
+                  f"{reference['incomplete_read']} incomplete")
+            for setup in ENGINES[1:]:
+                differences = compare(reference, results[setup])
+                engine, workers, passthrough = setup
+                name = f"{engine}, {workers} workers{', passthrough' if passthrough else ''}"
+                if differences:
+                    failed = True
+                    print(f"  {name}: differs in {', '.join(differences)}")
+                else:
+                    print(f"  {name}: same as python")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())